@@ -33,5 +33,7 @@ setup(name='supervisor-haproxy',
       entry_points = """\
       [console_scripts]
       supervisor-haproxy = supervisor_haproxy.command:main
+      supervisor-haproxy-drain = supervisor_haproxy.drain:main
+      supervisor-haproxy-restart = supervisor_haproxy.rolling_restart:main
       """,
 )
@@ -0,0 +1,107 @@
+from supervisor_haproxy.haproxy_control import STATUS_DRAIN
+from supervisor_haproxy.haproxy_control import STATUS_MAINT
+from supervisor_haproxy.haproxy_control import STATUS_READY
+import SocketServer
+import socket
+import threading
+
+
+AGENT_REPLIES = {
+    STATUS_READY: 'ready',
+    STATUS_DRAIN: 'drain',
+    STATUS_MAINT: 'maint',
+}
+
+
+class AgentRequestHandler(SocketServer.BaseRequestHandler):
+    """Answers one agent check. haproxy identifies the server with its
+    ``agent-send`` string, which is "backend/server":
+
+        server plone0401 127.0.0.1:8081 check agent-check agent-port 8899
+            agent-addr 127.0.0.1 agent-send "plone04/plone0401\\n"
+
+    Without the newline, the string is complete after ``read_timeout``.
+    """
+
+    def handle(self):
+        self.request.settimeout(self.server.read_timeout)
+        data = ''
+        try:
+            while '\n' not in data and len(data) < 1024:
+                chunk = self.request.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+
+        backend, _, server = data.strip().partition('/')
+        reply = self.server.get_reply((backend, server))
+        if reply:
+            self.request.sendall(reply + '\n')
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A TCP server answering haproxy's agent checks with the state
+    (``ready``, ``drain`` or ``maint``) and the weight of the servers,
+    so that haproxy pulls the states instead of the event listener pushing
+    them to the stats socket.
+
+    Servers with an unknown state get an empty reply, haproxy leaves them
+    as they are.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, read_timeout=1, log=None):
+        SocketServer.TCPServer.__init__(self, address, AgentRequestHandler)
+        self.read_timeout = read_timeout
+        self.log = log or (lambda msg: None)
+        self.lock = threading.Lock()
+        # The states and weights (percent) by (backend, server).
+        self.states = {}
+        self.weights = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.1,),
+                                       name='supervisor-haproxy-agent')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def set_state(self, key, state):
+        """Set the state of a server. A server which is not READY loses
+        its weight, it is set again when it is READY.
+        """
+        with self.lock:
+            self.states[key] = state
+            if state != STATUS_READY:
+                self.weights.pop(key, None)
+
+    def set_weight(self, key, weight):
+        with self.lock:
+            self.weights[key] = weight
+
+    def get_reply(self, key):
+        with self.lock:
+            state = self.states.get(key)
+            weight = self.weights.get(key)
+
+        if state is None:
+            return ''
+        reply = AGENT_REPLIES[state]
+        if state == STATUS_READY and weight is not None:
+            reply += ' {}%'.format(weight)
+        return reply
+
+    def handle_error(self, request, client_address):
+        self.log('ERROR: agent check from {} failed.'.format(
+            client_address[0]))
@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import random
+import time
+
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """The circuit breaker stops sending commands to haproxy after too many
+    consecutive failures.
+
+    While the circuit is open, changes are kept in a bounded retry queue,
+    which only contains the latest change per key (e.g. per server).
+    After a delay, which grows exponentially with each failed retry and has
+    some random jitter, the circuit becomes half-open: the caller should
+    probe haproxy and report the result with ``success`` or ``failure``.
+    When the circuit is closed again, the queue can be flushed with ``drain``.
+    """
+
+    def __init__(self, threshold=4, min_delay=1, max_delay=60, jitter=0.2,
+                 queue_size=1000):
+        self.threshold = threshold
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.queue_size = queue_size
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.retries = 0
+        self.retry_at = None
+        self.queue = OrderedDict()
+
+    def allow_request(self):
+        """Returns whether a request may be sent to haproxy.
+        When the delay of an open circuit has passed, the circuit becomes
+        half-open and the request should be a probe.
+        """
+        if self.state == STATE_OPEN and time.time() >= self.retry_at:
+            self.state = STATE_HALF_OPEN
+        return self.state != STATE_OPEN
+
+    @property
+    def half_open(self):
+        return self.state == STATE_HALF_OPEN
+
+    @property
+    def retry_in(self):
+        """Seconds until the next retry of an open circuit.
+        """
+        if self.retry_at is None:
+            return 0
+        return max(0, self.retry_at - time.time())
+
+    def success(self):
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.retries = 0
+        self.retry_at = None
+
+    def failure(self):
+        """Record a failed request.
+        Returns ``True`` when the circuit is open because of this failure.
+        """
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN or self.failures > self.threshold:
+            delay = min(self.max_delay, self.min_delay * 2 ** self.retries)
+            delay *= 1 - self.jitter * random.random()
+            self.retries += 1
+            self.retry_at = time.time() + delay
+            self.state = STATE_OPEN
+            return True
+        return False
+
+    def enqueue(self, key, value):
+        """Queue a change for retrying. An older change with the same key is
+        replaced, the oldest change is dropped when the queue is full.
+        """
+        self.queue.pop(key, None)
+        if len(self.queue) >= self.queue_size:
+            self.queue.popitem(last=False)
+        self.queue[key] = value
+
+    def drain(self):
+        """Remove and return all queued changes as list of (key, value).
+        """
+        items = self.queue.items()
+        self.queue.clear()
+        return items
@@ -1,16 +1,25 @@
 from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.worker import OVERFLOW_FAIL
+from supervisor_haproxy.worker import OVERFLOW_POLICIES
 import argparse
 import re
 
 
 def socket(value):
-    if not re.match(r'^tcp://[^:]+:\d+$', value):
-        raise argparse.ArgumentTypeError(
-            'Invalid socket {!r}, must be of form "tcp://127.0.0.1:9902"'.format(
-                value))
+    for part in value.split(','):
+        if not re.match(r'^(tcp://[^:]+:\d+|unix://.+)$', part):
+            raise argparse.ArgumentTypeError(
+                'Invalid socket {!r}, must be of form "tcp://127.0.0.1:9902"'
+                ' or "unix:///run/haproxy/admin.sock"'.format(part))
     return value
 
 
+def stats_socket(value):
+    if value == 'none':
+        return None
+    return socket(value)
+
+
 def program_info(value):
     match = re.match(r'^([^:]+):([^/]+)/(.*)$', value)
     if not match:
@@ -23,6 +32,16 @@ def program_info(value):
                     match.groups()))
 
 
+def warmup_url(value):
+    match = re.match(r'^([^=]+)=(https?://.+)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            'Invalid warm-up URL {!r}. Must be of form'
+            ' "supervisorProgram=URL",'
+            ' e.g. "instance2=http://localhost:8082/Plone"'.format(value))
+    return match.groups()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=('Supervisor event listener for updating HaProxy'
@@ -32,21 +51,316 @@ def main():
     parser.add_argument(
         'haproxy_socket',
         metavar='SOCKET',
-        type=socket,
-        help=(u'The haproxy stats socket (required).'
-              u' Only TCP sockets (AF_INET) are supported at the moment, e.g.:'
-              u' tcp://localhost:8800'))
+        type=stats_socket,
+        help=(u'The haproxy stats socket (required), either a TCP socket,'
+              u' e.g. tcp://localhost:8800, or a UNIX socket, e.g.'
+              u' unix:///run/haproxy/admin.sock. When haproxy runs multiple'
+              u' processes with a socket each, pass all sockets separated by'
+              u' commas; changes are sent to all of them in parallel.'
+              u' With --agent-port, "none" disables the stats socket.'))
 
     parser.add_argument(
         'programs',
         type=program_info,
         metavar='PROGRAMS',
-        nargs='+',
+        nargs='*',
         help=(u'Mapping of the supervisor programs to the haproxy'
               ' backend and server configuration.'
               ' Multiple programs may be configured at once.'
               ' Must be of form "supervisorProgram:HaProxyBackend/HaProxyServer",'
               ' e.g. "instance2:plone04/plone0402"'))
 
+    parser.add_argument(
+        '--mapping-file',
+        metavar='PATH',
+        help=(u'A file with rules mapping the supervisor programs to the'
+              u' haproxy backends and servers, one "PATTERN BACKEND/SERVER"'
+              u' per line. PATTERN is a program name, "glob:worker*" or'
+              u' "re:instance(\\d+)"; groups and "{name}" are substituted'
+              u' in BACKEND/SERVER. The file is reloaded on SIGHUP.'))
+
+    parser.add_argument(
+        '--target',
+        dest='targets',
+        type=socket,
+        metavar='SOCKET',
+        action='append',
+        default=[],
+        help=(u'The stats socket of an additional haproxy load balancer,'
+              u' e.g. of a standby node. All load balancers are updated'
+              u' in parallel, each with its own connection and retry queue.'
+              u' May be given multiple times.'))
+
+    parser.add_argument(
+        '--agent-port',
+        type=int,
+        metavar='PORT',
+        help=(u'Answer haproxy\'s agent checks on that port with the state'
+              u' and weight of the server, which haproxy identifies with'
+              u' agent-send "BACKEND/SERVER\\n".'))
+
+    parser.add_argument(
+        '--agent-host',
+        default='0.0.0.0',
+        metavar='HOST',
+        help=(u'The address the agent check responder listens on'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--quorum',
+        type=int,
+        help=(u'The number of load balancers which must have applied a'
+              u' change, otherwise the event fails and is sent again by'
+              u' supervisor. The others retry the change later'
+              u' (default: all).'))
+
+    parser.add_argument(
+        '--persistent',
+        action='store_true',
+        help=(u'Keep the connection to the haproxy stats socket open'
+              u' (interactive mode) instead of connecting for each command.'))
+
+    parser.add_argument(
+        '--connect-timeout',
+        type=float,
+        metavar='SECONDS',
+        help=u'Timeout for connecting to the haproxy stats socket.')
+
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='SECONDS',
+        help=(u'Timeout for each send and receive operation on the haproxy'
+              u' stats socket.'))
+
+    parser.add_argument(
+        '--event-timeout',
+        type=float,
+        metavar='SECONDS',
+        help=(u'Maximum total time spent communicating with haproxy'
+              u' for one event.'))
+
+    parser.add_argument(
+        '--retry-min-delay',
+        type=float,
+        default=1,
+        metavar='SECONDS',
+        help=(u'When haproxy is not reachable, changes are queued and'
+              u' retried after this delay, which is doubled for each'
+              u' failed retry (default: %(default)s).'))
+
+    parser.add_argument(
+        '--retry-max-delay',
+        type=float,
+        default=60,
+        metavar='SECONDS',
+        help=u'The maximum delay between retries (default: %(default)s).')
+
+    parser.add_argument(
+        '--retry-queue-size',
+        type=int,
+        default=1000,
+        help=(u'The maximum number of servers with queued changes'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--metrics-file',
+        metavar='PATH',
+        help=(u'Write metrics in the Prometheus text format to this file,'
+              u' e.g. for the textfile collector of the node exporter.'
+              u' The metrics are also written to stderr on SIGUSR1.'))
+
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=15,
+        metavar='SECONDS',
+        help=u'Interval for rewriting the metrics file (default: %(default)s).')
+
+    parser.add_argument(
+        '--slow-start',
+        type=float,
+        metavar='SECONDS',
+        help=(u'When a program is running, set its server to READY with a'
+              u' low weight and raise the weight to 100%% within that many'
+              u' seconds, so that it gets the full traffic only when its'
+              u' caches are warm.'))
+
+    parser.add_argument(
+        '--slow-start-weight',
+        type=int,
+        default=10,
+        metavar='PERCENT',
+        help=(u'The initial weight of a slow start in percent of the'
+              u' configured weight (default: %(default)s).'))
+
+    parser.add_argument(
+        '--slow-start-steps',
+        type=int,
+        default=10,
+        help=(u'The number of steps for raising the weight'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--warmup-url',
+        dest='warmup_urls',
+        type=warmup_url,
+        metavar='PROGRAM=URL',
+        action='append',
+        default=[],
+        help=(u'Request this URL of the program, when it is running, before'
+              u' its server is set to READY; it stays in MAINT meanwhile.'
+              u' May be given multiple times, the URLs are requested'
+              u' concurrently, e.g. "instance2=http://localhost:8082/Plone".'))
+
+    parser.add_argument(
+        '--warmup-min-success',
+        type=int,
+        metavar='NUM',
+        help=(u'The number of warm-up URLs which must succeed'
+              u' (default: all URLs of the program).'))
+
+    parser.add_argument(
+        '--warmup-max-latency',
+        type=float,
+        metavar='SECONDS',
+        help=(u'A warm-up request only succeeds when it responds within'
+              u' that many seconds. The URLs are requested again until'
+              u' enough succeed.'))
+
+    parser.add_argument(
+        '--warmup-time-limit',
+        type=float,
+        default=60,
+        metavar='SECONDS',
+        help=(u'When the warm-up did not pass within that many seconds,'
+              u' the server stays in MAINT (default: %(default)s).'))
+
+    parser.add_argument(
+        '--warmup-ready-on-timeout',
+        action='store_true',
+        help=(u'Set the server to READY anyway, when the warm-up did not'
+              u' pass within the time limit.'))
+
+    parser.add_argument(
+        '--adaptive-weights',
+        action='store_true',
+        help=(u'On each TICK event (e.g. TICK_5), lower the weight of servers'
+              u' whose queue or response time is much higher than the median'
+              u' of their backend, and restore it gradually afterwards.'
+              u' The listener must be subscribed to a TICK event.'))
+
+    parser.add_argument(
+        '--adaptive-min-weight',
+        type=int,
+        default=10,
+        metavar='PERCENT',
+        help=u'The lowest adaptive weight (default: %(default)s).')
+
+    parser.add_argument(
+        '--adaptive-max-weight',
+        type=int,
+        default=100,
+        metavar='PERCENT',
+        help=u'The highest adaptive weight (default: %(default)s).')
+
+    parser.add_argument(
+        '--adaptive-factor',
+        type=float,
+        default=2.0,
+        help=(u'A server is overloaded when its queue or response time is'
+              u' more than that many times the median of its backend'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--adaptive-step',
+        type=int,
+        default=10,
+        metavar='PERCENT',
+        help=(u'The weight of a recovered server is raised by that much per'
+              u' TICK event (default: %(default)s).'))
+
+    parser.add_argument(
+        '--background',
+        action='store_true',
+        help=(u'Acknowledge events immediately and apply the changes to'
+              u' haproxy in a background thread.'))
+
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=1000,
+        help=(u'Maximum number of changes queued in background mode'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--queue-overflow',
+        choices=OVERFLOW_POLICIES,
+        default=OVERFLOW_FAIL,
+        help=(u'What to do with an event when the queue is full:'
+              u' "fail" rejects the event so that supervisor sends it again,'
+              u' "drop" drops the oldest queued change,'
+              u' "block" waits until there is space in the queue'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--coalesce-window',
+        type=float,
+        default=0,
+        metavar='SECONDS',
+        help=(u'Hold back changes for that many seconds and only apply the'
+              u' last state of each server, e.g. when a program is flapping.'
+              u' Implies --background.'))
+
+    parser.add_argument(
+        '--state-cache-ttl',
+        type=float,
+        metavar='SECONDS',
+        help=(u'Remember the states sent to haproxy and skip commands which'
+              u' would not change anything. The remembered states are'
+              u' synchronized with haproxy ("show servers state") after that'
+              u' many seconds.'))
+
+    parser.add_argument(
+        '--reconcile',
+        action='store_true',
+        help=(u'At startup, compare the states of all programs in supervisor'
+              u' with the server states in haproxy and apply the'
+              u' differences.'))
+
+    parser.add_argument(
+        '--reconcile-on-tick',
+        action='store_true',
+        help=(u'Reconcile on each TICK event (e.g. TICK_60), the listener'
+              u' must be subscribed to it.'))
+
+    parser.add_argument(
+        '--server-state-file',
+        metavar='PATH',
+        help=(u'Keep a haproxy server-state-file with the states and weights'
+              u' set by the event listener, so that haproxy keeps them when'
+              u' it is reloaded ("load-server-state-from-file"). The file is'
+              u' replaced atomically when a state changes and synchronized'
+              u' with haproxy on each TICK event.'))
+
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help=(u'Check the replies of haproxy for errors, failing the event'
+              u' when a change is rejected (e.g. unknown server), and'
+              u' confirm the applied states with a "show stat" snapshot.'))
+
+    parser.add_argument(
+        '--trace-file',
+        metavar='PATH',
+        help=(u'Append a JSON record for each change applied to haproxy'
+              u' to the file, with the timestamps of receiving the event,'
+              u' sending the command, receiving the reply and verifying the'
+              u' state.'))
+
     args = parser.parse_args()
+    if not args.programs and not args.mapping_file:
+        parser.error('either PROGRAMS or --mapping-file is required')
+    if args.haproxy_socket is None and args.agent_port is None:
+        parser.error('SOCKET "none" requires --agent-port')
     HaProxyEventListener(**vars(args)).runforever()
@@ -0,0 +1,75 @@
+from supervisor_haproxy.command import socket
+from supervisor_haproxy.haproxy_control import create_control
+from supervisor_haproxy.haproxy_control import STATUS_DRAIN
+import argparse
+import re
+import sys
+
+
+def server(value):
+    match = re.match(r'^([^/]+)/(.+)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            'Invalid server {!r}. Must be of form "HaProxyBackend/HaProxyServer",'
+            ' e.g. "plone04/plone0402"'.format(value))
+    return match.groups()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Wait until a haproxy server has no sessions anymore,'
+                     ' e.g. before stopping its program. Exits with 0 when'
+                     ' the server is drained and with 1 otherwise.'),
+        epilog=('>> %(prog)s --drain --timeout 60 tcp://localhost:8800'
+                ' plone04/plone0401 && supervisorctl stop instance1'))
+
+    parser.add_argument(
+        'haproxy_socket',
+        metavar='SOCKET',
+        type=socket,
+        help=(u'The haproxy stats socket, e.g. tcp://localhost:8800 or'
+              u' unix:///run/haproxy/admin.sock; multiple sockets of a'
+              u' multi-process haproxy are separated by commas.'))
+
+    parser.add_argument(
+        'server',
+        type=server,
+        metavar='BACKEND/SERVER',
+        help=u'The haproxy server, e.g. "plone04/plone0402".')
+
+    parser.add_argument(
+        '--drain',
+        action='store_true',
+        help=u'Set the server to DRAIN before waiting.')
+
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='SECONDS',
+        help=u'Give up after that many seconds (default: wait forever).')
+
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=0.5,
+        metavar='SECONDS',
+        help=u'Interval for polling the sessions (default: %(default)s).')
+
+    args = parser.parse_args()
+    backend, server_name = args.server
+    control = create_control(args.haproxy_socket, timeout=10)
+    try:
+        if args.drain:
+            control.set_server_status(backend, server_name, STATUS_DRAIN)
+        if control.wait_until_drained(backend, server_name,
+                                      timeout=args.timeout,
+                                      interval=args.interval):
+            return
+        sessions = control.get_server_sessions(backend, server_name)
+    except Exception, exc:
+        sys.stderr.write('ERROR: {!r}\n'.format(exc))
+        sys.exit(1)
+
+    sys.stderr.write('{}/{} still has {} sessions after {} seconds.\n'.format(
+        backend, server_name, sessions, args.timeout))
+    sys.exit(1)
@@ -1,16 +1,28 @@
 from datetime import datetime
-from datetime import timedelta
+from functools import partial
 from supervisor import childutils
-from supervisor_haproxy.exceptions import HaProxyConnectionRefused
-from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.agent import AgentServer
+from supervisor_haproxy.haproxy_control import call_parallel
+from supervisor_haproxy.haproxy_control import create_control
 from supervisor_haproxy.haproxy_control import STATUS_DRAIN
 from supervisor_haproxy.haproxy_control import STATUS_MAINT
 from supervisor_haproxy.haproxy_control import STATUS_READY
+from supervisor_haproxy.log_writer import LogWriter
+from supervisor_haproxy.mapping import ProgramMapping
+from supervisor_haproxy.metrics import Metrics
+from supervisor_haproxy.metrics import MetricsExporter
+from supervisor_haproxy.slow_start import SlowStart
+from supervisor_haproxy.state_file import ServerStateFile
+from supervisor_haproxy.warmup import WarmUp
+from supervisor_haproxy.target import HaProxyTarget
+from supervisor_haproxy.tracing import Tracer
+from supervisor_haproxy.weight_controller import WeightController
+from supervisor_haproxy.worker import HaProxyWorker
+from supervisor_haproxy.worker import OVERFLOW_FAIL
+import os
+import signal
 import sys
-
-
-MAX_CONSECUTIVE_CONNECTION_REFUSED = 4
-SKIP_TIMEOUT_AFTER_CONNECTION_REFUSED = timedelta(seconds=60)
+import threading
 
 
 class HaProxyEventListener(object):
@@ -26,36 +38,258 @@ class HaProxyEventListener(object):
         'PROCESS_STATE_UNKNOWN': STATUS_MAINT,
     }
 
-    def __init__(self, programs, haproxy_socket=None, haproxy_control=None):
-        self.haproxy_control = haproxy_control or HaProxyControl(haproxy_socket)
-        self.programs = {program['supervisor_program']: program
-                         for program in programs}
+    def __init__(self, programs, haproxy_socket=None, haproxy_control=None,
+                 persistent=False, connect_timeout=None, timeout=None,
+                 event_timeout=None, background=False, queue_size=1000,
+                 queue_overflow=OVERFLOW_FAIL, coalesce_window=0,
+                 state_cache_ttl=None, reconcile=False,
+                 reconcile_on_tick=False, rpc=None, retry_min_delay=1,
+                 retry_max_delay=60, retry_queue_size=1000,
+                 metrics_file=None, metrics_interval=15, targets=(),
+                 quorum=None, slow_start=None, slow_start_weight=10,
+                 slow_start_steps=10, warmup_urls=(), warmup_min_success=None,
+                 warmup_max_latency=None, warmup_time_limit=60,
+                 warmup_ready_on_timeout=False,
+                 adaptive_weights=False, adaptive_min_weight=10,
+                 adaptive_max_weight=100, adaptive_factor=2.0,
+                 adaptive_step=10, mapping_file=None, server_state_file=None,
+                 agent_port=None, agent_host='0.0.0.0', verify=False,
+                 trace_file=None):
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # The programs are looked up by process name, either in the given
+        # programs or with the rules of the mapping file, which is reloaded
+        # on SIGHUP.
+        self.mapping_file = mapping_file
+        if mapping_file:
+            self.programs = ProgramMapping.from_file(mapping_file, programs)
+        else:
+            self.programs = ProgramMapping(programs)
+        # Log messages are written in the background, so that a slow reader
+        # of stderr does not block the handling of events.
+        self.log_writer = LogWriter(sys.stderr).start()
         self.stdin = sys.stdin
         self.stdout = sys.stdout
         self.stderr = sys.stderr
+        self.tracer = None
+        if trace_file:
+            self.tracer = Tracer(LogWriter(open(trace_file, 'a')).start())
         self.running = False
-        self.consecutive_refused_connections = 0
-        self.skip_until = None
+        self.metrics_exporter = None
+
+        # Each haproxy load balancer is a target with its own connection,
+        # circuit breaker and state cache. Additional targets are given as
+        # sockets or as controls.
+        control_options = dict(persistent=persistent,
+                               connect_timeout=connect_timeout,
+                               timeout=timeout,
+                               metrics=self.metrics)
+        controls = [haproxy_control or haproxy_socket] + list(targets)
+        if controls[0] is None:
+            # Without a stats socket the states are only available to
+            # haproxy's agent checks.
+            controls.pop(0)
+            if agent_port is None:
+                raise ValueError('haproxy_socket is required without'
+                                 ' agent_port')
+        # Each stats socket of a multi-process haproxy (comma-separated) is
+        # a target of its own, so that a failing process does not open the
+        # circuit breaker of the others.
+        controls = [create_control(haproxy_socket, **control_options)
+                    if isinstance(control, basestring) else control
+                    for control in controls
+                    for haproxy_socket in (
+                        control.split(',') if isinstance(control, basestring)
+                        else [control])]
+        self.targets = []
+        for index, control in enumerate(controls):
+            log = self.log
+            if len(controls) > 1:
+                log = partial(self.log_target, control)
+            weight_controller = None
+            if adaptive_weights:
+                weight_controller = WeightController(
+                    min_weight=adaptive_min_weight,
+                    max_weight=adaptive_max_weight,
+                    factor=adaptive_factor,
+                    step=adaptive_step)
+            state_file = None
+            if server_state_file and index == 0:
+                # The state file is read by the local haproxy, which is the
+                # first target.
+                state_file = ServerStateFile(server_state_file)
+            self.targets.append(HaProxyTarget(
+                control, self.programs, self.metrics, log,
+                event_timeout=event_timeout,
+                state_cache_ttl=state_cache_ttl,
+                retry_min_delay=retry_min_delay,
+                retry_max_delay=retry_max_delay,
+                retry_queue_size=retry_queue_size,
+                weight_controller=weight_controller,
+                state_file=state_file,
+                verify=verify,
+                tracer=self.tracer))
+        self.adaptive_weights = adaptive_weights
+        # The number of targets which must have handled a change, otherwise
+        # the event fails and supervisor sends it again.
+        self.quorum = quorum or len(self.targets)
+        if self.targets and not 0 < self.quorum <= len(self.targets):
+            raise ValueError('quorum must be between 1 and {}, got {!r}'.format(
+                len(self.targets), quorum))
+
+        # Reconciliation compares the process states in supervisor with the
+        # server states in haproxy and applies the differences, at startup
+        # and / or on TICK events.
+        self.reconcile_on_startup = reconcile
+        self.reconcile_on_tick = reconcile_on_tick
+        self._rpc = rpc
+        self.slow_start = None
+        if slow_start:
+            # Servers which became READY get a low weight at first, which is
+            # raised step by step within slow_start seconds.
+            self.slow_start = SlowStart(self.set_server_weight,
+                                        duration=slow_start,
+                                        initial_weight=slow_start_weight,
+                                        steps=slow_start_steps,
+                                        log=self.log)
+            self.slow_start.start()
+        self.warmup = None
+        if warmup_urls:
+            # Programs with warm-up URLs stay in MAINT when they are running,
+            # until the URLs respond quickly enough.
+            urls = {}
+            for program_name, url in warmup_urls:
+                urls.setdefault(program_name, []).append(url)
+            self.warmup = WarmUp(urls, self.warmed_up,
+                                 min_success=warmup_min_success,
+                                 max_latency=warmup_max_latency,
+                                 time_limit=warmup_time_limit,
+                                 ready_on_timeout=warmup_ready_on_timeout,
+                                 log=self.log)
+        self.agent = None
+        if agent_port is not None:
+            # haproxy pulls the states and weights with agent checks.
+            self.agent = AgentServer((agent_host, agent_port),
+                                     log=self.log).start()
+        self.worker = None
+        self.tick_thread = None
+        if background or coalesce_window:
+            # Events are acknowledged immediately and the changes are applied
+            # to haproxy in the background, so that supervisor never waits
+            # for haproxy.
+            self.worker = HaProxyWorker(self.process_change_in_background,
+                                        maxsize=queue_size,
+                                        overflow=queue_overflow,
+                                        log=self.log,
+                                        coalesce_window=coalesce_window,
+                                        apply_batch=(
+                                            self.process_changes_in_background))
+            self.worker.start()
+
+    @property
+    def haproxy_control(self):
+        return self.targets[0].haproxy_control if self.targets else None
+
+    @property
+    def breaker(self):
+        return self.targets[0].breaker if self.targets else None
+
+    @property
+    def stderr(self):
+        return self.log_writer.stream
+
+    @stderr.setter
+    def stderr(self, stream):
+        # The buffered messages are written to the previous stream.
+        self.log_writer.flush()
+        self.log_writer.stream = stream
+
+    @property
+    def rpc(self):
+        if self._rpc is None:
+            self._rpc = childutils.getRPCInterface(os.environ)
+        return self._rpc
 
     def runforever(self, test=False):
-        while True:
-            self.handle(*childutils.listener.wait(self.stdin, self.stdout))
-            if test:
-                return
+        if not self.running:
+            self.running = True
+            signal.signal(signal.SIGUSR1, self.dump_metrics)
+            signal.signal(signal.SIGHUP, self.reload_mapping)
+            # Restart reading from stdin after a signal, so that no event
+            # is lost.
+            signal.siginterrupt(signal.SIGUSR1, False)
+            signal.siginterrupt(signal.SIGHUP, False)
+            if self.metrics_file:
+                self.metrics_exporter = MetricsExporter(
+                    self.metrics, self.metrics_file,
+                    interval=self.metrics_interval,
+                    update=self.update_metrics,
+                    log=self.log)
+                self.metrics_exporter.start()
+            if self.reconcile_on_startup:
+                self.reconcile()
+            if self.targets and self.targets[0].state_file is not None:
+                self.targets[0].sync_state_file()
+
+        try:
+            while True:
+                headers, payload = childutils.listener.wait(self.stdin,
+                                                            self.stdout)
+                self.metrics.inc('events_received_total')
+                with self.metrics.timer('event_duration_seconds'):
+                    self.handle(headers, payload)
+                if test:
+                    return
+        finally:
+            self.log_writer.flush()
 
     def handle(self, headers, payload):
-        event = headers.get('eventname')
+        event = headers.get('eventname') or ''
+        if event.startswith('TICK_'):
+            if self.worker is None:
+                self.tick()
+            elif self.tick_thread is None or not self.tick_thread.is_alive():
+                # The tick waits for haproxy and for the changes applied by
+                # the worker, therefore it runs in its own thread and the
+                # event is acknowledged immediately. A tick is skipped while
+                # the previous one is still running.
+                self.tick_thread = threading.Thread(
+                    target=self.tick_in_background,
+                    name='supervisor-haproxy-tick')
+                self.tick_thread.daemon = True
+                self.tick_thread.start()
+            return self.ok()
+
         action = self.STATE_ACTIONS.get(event, None)
         if action is None:
             # Event is not supported.
+            self.metrics.inc('events_ignored_total')
             return self.ok()
 
         data = childutils.get_headers(payload)
         program_info = self.programs.get(data.get('processname'), None)
         if program_info is None:
             # We are not watching this program.
+            self.metrics.inc('events_ignored_total')
             return self.ok()
 
+        if self.tracer is not None:
+            self.tracer.receive((program_info['haproxy_backend'],
+                                 program_info['haproxy_server']),
+                                event, program_info['supervisor_program'])
+
+        if self.slow_start is not None and action != STATUS_READY:
+            # Stop raising the weight immediately, even when the change is
+            # queued in the background.
+            self.slow_start.cancel((program_info['haproxy_backend'],
+                                    program_info['haproxy_server']))
+
+        warmup = self.warmup is not None \
+            and program_info['supervisor_program'] in self.warmup
+        if warmup:
+            self.warmup.cancel(program_info['supervisor_program'])
+
         self.log('{date} Received {event} (from {from_state})'
                  ' for {supervisor_program},'
                  ' sending {action} for '
@@ -66,44 +300,244 @@ class HaProxyEventListener(object):
                      action=action,
                      **program_info))
 
-        if self.skip_until is not None:
-            if self.skip_until < datetime.now():
-                self.consecutive_refused_connections = 0
-                self.skip_until = None
-                self.log('WARNING: resuming event handling.')
+        if warmup and action == STATUS_READY:
+            # The server stays in MAINT until the warm-up is done, the
+            # event is acknowledged immediately.
+            self.log('Warming up {} before sending READY.'.format(
+                program_info['supervisor_program']))
+            self.warmup.begin(program_info)
+            return self.ok()
 
-            else:
-                self.log('WARNING: skipping event handling because too many'
-                         ' connections were refused previously.')
+        if self.worker is not None:
+            key = (program_info['haproxy_backend'],
+                   program_info['haproxy_server'])
+            if self.worker.put(key, program_info, action):
                 return self.ok()
 
-        try:
-            self.haproxy_control.set_server_status(
-                program_info['haproxy_backend'],
-                program_info['haproxy_server'],
-                action)
-
-        except HaProxyConnectionRefused, exc:
-            self.consecutive_refused_connections += 1
-            if MAX_CONSECUTIVE_CONNECTION_REFUSED \
-               >= self.consecutive_refused_connections:
-                self.log('ERROR: connection to HaProxy stats socket refused')
-                return self.fail()
-
-            self.log('WARNING: too many connections were refused,'
-                     ' therefore this and all future events will be'
-                     ' skipped unhandled for the next {} seconds.'.format(
-                         SKIP_TIMEOUT_AFTER_CONNECTION_REFUSED.seconds))
-            self.skip_until = datetime.now() \
-                              + SKIP_TIMEOUT_AFTER_CONNECTION_REFUSED
+            self.log('ERROR: queue is full, rejecting event.')
+            return self.fail()
+
+        if self.process_change(program_info, action):
             return self.ok()
+        else:
+            return self.fail()
+
+    def tick(self):
+        """Retry the queued changes, reconcile and adjust the weights,
+        depending on the options.
+        """
+        self.call_targets(lambda target: target.tick())
+        if self.reconcile_on_tick:
+            self.reconcile()
+        if self.adaptive_weights:
+            # The slow start raises the weight of these servers.
+            ramping = set()
+            if self.slow_start is not None:
+                ramping = self.slow_start.ramping()
+            self.call_targets(lambda target: target.adjust_weights(ramping))
 
+    def tick_in_background(self):
+        try:
+            self.tick()
         except Exception, exc:
             self.log('ERROR: {!r}'.format(exc))
-            return self.fail()
 
-        self.consecutive_refused_connections = 0
-        return self.ok()
+    def stop(self):
+        """Stop the background threads. The warm-ups are cancelled, the
+        queued changes are applied and the log is written.
+        """
+        if self.warmup is not None:
+            self.warmup.stop()
+        if self.tick_thread is not None:
+            self.tick_thread.join()
+        if self.worker is not None:
+            self.worker.stop()
+        if self.slow_start is not None:
+            self.slow_start.stop()
+        if self.agent is not None:
+            self.agent.stop()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+        for target in self.targets:
+            target.haproxy_control.close()
+        if self.tracer is not None:
+            self.tracer.writer.stop()
+            self.tracer.writer.stream.close()
+        self.log_writer.stop()
+
+    def warmed_up(self, program_info):
+        """Set the server READY when the warm-up is done. There is no event
+        which could fail, therefore failing changes are queued for retrying.
+        """
+        if self.worker is not None:
+            key = (program_info['haproxy_backend'],
+                   program_info['haproxy_server'])
+            if not self.worker.put(key, program_info, STATUS_READY):
+                self.log('ERROR: queue is full, dropping READY for'
+                         ' {haproxy_backend}/{haproxy_server}.'.format(
+                             **program_info))
+            return
+
+        self.process_change(program_info, STATUS_READY, can_fail=False)
+
+    def process_change(self, program_info, action, can_fail=True):
+        """Apply a change to all targets in parallel.
+        Returns ``False`` when fewer targets than the quorum handled the
+        change (applied or queued it for retrying).
+        """
+        return self.process_changes([(program_info, action)], can_fail)
+
+    def process_changes(self, changes, can_fail=True):
+        """Apply a list of ``(program_info, action)`` changes to all targets
+        in parallel, in one batch per target.
+        """
+        changes = [((program_info['haproxy_backend'],
+                     program_info['haproxy_server']), action)
+                   for program_info, action in changes]
+        for key, action in changes:
+            if self.slow_start is not None:
+                if action == STATUS_READY:
+                    # Set the initial weight before the server gets traffic.
+                    self.slow_start.begin(key)
+                else:
+                    self.slow_start.cancel(key)
+
+            if self.agent is not None:
+                self.agent.set_state(key, action)
+        if not self.targets:
+            return True
+
+        handled = self.call_targets(
+            lambda target: target.process_changes(changes, can_fail))
+        if len(self.targets) == 1:
+            return handled[0]
+
+        num = len(filter(None, handled))
+        if num < self.quorum and can_fail:
+            self.log('ERROR: change handled by {} of {} load balancers,'
+                     ' quorum is {}.'.format(num, len(self.targets),
+                                            self.quorum))
+            return False
+
+        # The quorum is reached, the event will not be sent again, therefore
+        # the targets which failed retry the change later.
+        for target, target_handled in zip(self.targets, handled):
+            if not target_handled:
+                for key, action in changes:
+                    target.enqueue(key, action)
+        return True
+
+    def process_change_in_background(self, program_info, action):
+        self.process_change(program_info, action, can_fail=False)
+
+    def process_changes_in_background(self, changes):
+        self.process_changes(changes, can_fail=False)
+
+    def set_server_weight(self, key, weight):
+        """Set the weight (percent) of a server on all targets.
+        """
+        if self.agent is not None:
+            self.agent.set_weight(key, weight)
+        return all(self.call_targets(
+            lambda target: target.set_weight(key, weight)))
+
+    def call_targets(self, func):
+        """Call the function with each target, in parallel when there are
+        multiple targets, and return the results.
+        """
+        if len(self.targets) <= 1:
+            return [func(target) for target in self.targets]
+
+        results, errors = call_parallel(
+            [partial(func, target) for target in self.targets])
+        for exc in errors:
+            if exc is not None:
+                raise exc
+        return results
+
+    def reconcile(self):
+        """Apply the differences between the process states in supervisor
+        and the server states in haproxy in one batch.
+        """
+        try:
+            process_infos = self.rpc.supervisor.getAllProcessInfo()
+        except Exception, exc:
+            self.metrics.inc('failures_total')
+            self.log('ERROR: reconciliation failed: {!r}'.format(exc))
+            return False
+
+        desired = {}
+        for info in process_infos:
+            program_info = self.programs.get(info['name'], None)
+            action = self.STATE_ACTIONS.get(
+                'PROCESS_STATE_{}'.format(info['statename']), None)
+            if program_info is None or action is None:
+                continue
+            if action == STATUS_READY and self.warmup is not None \
+               and self.warmup.warming_up(program_info['supervisor_program']):
+                # The warm-up sets the server READY when it is done.
+                continue
+            desired[program_info['haproxy_backend'],
+                    program_info['haproxy_server']] = action
+
+        on_ready = None
+        if self.slow_start is not None:
+            for key, action in desired.items():
+                if action != STATUS_READY:
+                    self.slow_start.cancel(key)
+            on_ready = self.begin_slow_start()
+
+        if self.agent is not None:
+            for key, action in desired.items():
+                self.agent.set_state(key, action)
+        return all(self.call_targets(
+            lambda target: target.reconcile(desired, on_ready)))
+
+    def begin_slow_start(self):
+        """Return a function beginning the slow start of the servers set
+        READY by the targets, once per server.
+        """
+        lock = threading.Lock()
+        begun = set()
+
+        def on_ready(keys):
+            with lock:
+                keys = [key for key in keys if key not in begun]
+                begun.update(keys)
+            for key in keys:
+                self.slow_start.begin(key)
+        return on_ready
+
+    def update_metrics(self):
+        if self.worker is not None:
+            self.metrics.set('queue_length', len(self.worker.queue))
+            self.metrics.set('changes_coalesced_total', self.worker.coalesced)
+        self.metrics.set('retry_queue_length',
+                         sum(len(target.breaker.queue)
+                             for target in self.targets))
+
+    def dump_metrics(self, signum=None, frame=None):
+        self.update_metrics()
+        self.log(self.metrics.render())
+
+    def reload_mapping(self, signum=None, frame=None):
+        """Reload the rules of the mapping file. The rules are replaced at
+        once, events which are processed meanwhile use the old rules.
+        When the file is invalid, the old rules are kept.
+        """
+        if not self.mapping_file:
+            return False
+
+        try:
+            self.programs.load(self.mapping_file)
+        except (IOError, ValueError), exc:
+            self.log('ERROR: reloading {} failed, keeping the old rules:'
+                     ' {}'.format(self.mapping_file, exc))
+            return False
+
+        self.log('{date} Reloaded {path}.'.format(
+            date=datetime.now().isoformat(), path=self.mapping_file))
+        return True
 
     def ok(self):
         childutils.listener.ok(self.stdout)
@@ -111,5 +545,8 @@ class HaProxyEventListener(object):
     def fail(self):
         childutils.listener.fail(self.stdout)
 
+    def log_target(self, haproxy_control, msg):
+        self.log('[{}] {}'.format(haproxy_control.haproxy_socket, msg))
+
     def log(self, msg):
-        self.stderr.write(msg.rstrip('\n') + '\n')
+        self.log_writer.write(msg.rstrip('\n') + '\n')
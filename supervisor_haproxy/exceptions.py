@@ -7,3 +7,49 @@ class HaProxyConnectionRefused(Exception):
 
     def __init__(self, exception):
         super(HaProxyConnectionRefused, self).__init__(*exception.args)
+
+
+class HaProxyTimeout(Exception):
+    """This exception indicates that the communication with the haproxy stats
+    socket timed out.
+    """
+
+
+class HaProxyConnectTimeout(HaProxyTimeout):
+    """Connecting to the haproxy stats socket timed out.
+    """
+
+
+class HaProxySendTimeout(HaProxyTimeout):
+    """Sending a command to the haproxy stats socket timed out.
+    """
+
+
+class HaProxyReceiveTimeout(HaProxyTimeout):
+    """Receiving the reply from the haproxy stats socket timed out.
+    """
+
+
+class HaProxyDeadlineExceeded(HaProxyTimeout):
+    """The time available for communicating with haproxy is used up.
+    """
+
+
+class RollingRestartError(Exception):
+    """The rolling restart was aborted, since continuing would reduce the
+    capacity of a backend too much or supervisor failed to restart a
+    program.
+    """
+
+
+class HaProxyCommandError(Exception):
+    """haproxy rejected a command, e.g. because the server is unknown.
+    """
+
+    def __init__(self, cmd, reply):
+        super(HaProxyCommandError, self).__init__(cmd, reply)
+        self.cmd = cmd
+        self.reply = reply
+
+    def __str__(self):
+        return '{!r} was rejected: {}'.format(self.cmd, self.reply)
@@ -1,18 +1,140 @@
+from collections import namedtuple
+from collections import OrderedDict
 from contextlib import contextmanager
+from functools import partial
+from supervisor_haproxy.exceptions import HaProxyConnectTimeout
 from supervisor_haproxy.exceptions import HaProxyConnectionRefused
+from supervisor_haproxy.exceptions import HaProxyDeadlineExceeded
+from supervisor_haproxy.exceptions import HaProxyReceiveTimeout
+from supervisor_haproxy.exceptions import HaProxySendTimeout
+from supervisor_haproxy.exceptions import HaProxyTimeout
+from supervisor_haproxy.metrics import Metrics
 import csv
 import errno
+import select
 import socket
+import threading
+import time
 
 
 STATUS_DOWN = 'DOWN'
 STATUS_DRAIN = 'DRAIN'
 STATUS_FAILED = 'FAILED'
 STATUS_MAINT = 'MAINT'
+# The first word of "no check", the status of servers without health check.
+STATUS_NO_CHECK = 'no'
 STATUS_READY = 'READY'
 STATUS_STOPPED = 'STOPPED'
 STATUS_UP = 'UP'
 
+TYPE_FRONTEND = 1
+TYPE_BACKEND = 2
+TYPE_SERVER = 4
+
+# Flags of srv_admin_state in "show servers state".
+ADMIN_FMAINT = 0x01
+ADMIN_FDRAIN = 0x08
+
+CHUNK_SIZE = 16384
+
+# The maximum length of a ";"-separated command line, which must fit into
+# haproxy's buffer (tune.bufsize).
+MAX_BATCH_LENGTH = 4096
+
+# The columns of "show stat" kept in a snapshot.
+ServerStat = namedtuple('ServerStat', (
+    'pxname', 'svname', 'status', 'weight', 'qcur', 'scur', 'rtime', 'ttime'))
+
+# In interactive mode ("prompt"), haproxy terminates each reply with a prompt.
+PROMPT = '\n> '
+
+
+def call_parallel(funcs):
+    """Call the functions in parallel threads and wait for all of them.
+    Returns the list of results and the list of errors, which contain
+    ``None`` for each function which did not fail.
+    """
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+
+    def call(index):
+        try:
+            results[index] = funcs[index]()
+        except Exception, exc:
+            errors[index] = exc
+
+    threads = [threading.Thread(target=call, args=(index,))
+               for index in range(1, len(funcs))]
+    for thread in threads:
+        thread.start()
+    if funcs:
+        # The first function is called in the current thread.
+        call(0)
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def batch_lines(cmds, max_length=MAX_BATCH_LENGTH):
+    """Join the commands with ";" into as few lines as possible, none
+    longer than ``max_length`` unless a single command is.
+    """
+    lines = []
+    line = None
+    for cmd in cmds:
+        cmd = cmd.strip()
+        if ';' in cmd:
+            raise ValueError('Commands must not contain ";", got {!r}'.format(
+                cmd))
+        if line is not None and len(line) + 1 + len(cmd) <= max_length:
+            line += ';' + cmd
+        else:
+            if line is not None:
+                lines.append(line)
+            line = cmd
+    if line is not None:
+        lines.append(line)
+    return lines
+
+
+def split_replies(reply, num_replies):
+    """Split the reply of a ";"-separated command line of a
+    non-interactive connection into the replies of the commands, which
+    are terminated by an empty line each.
+    Each reply keeps its terminating newline, as in interactive mode.
+    """
+    replies = []
+    current = ''
+    for line in reply.splitlines(True):
+        if line == '\n':
+            replies.append(current + '\n')
+            current = ''
+        else:
+            current += line
+    if len(replies) < num_replies:
+        raise socket.error(errno.ECONNRESET,
+                           'Incomplete reply from haproxy: {} of {}'
+                           ' replies'.format(len(replies), num_replies))
+    return replies[:num_replies]
+
+
+def wait_until_drained(control, backend, server_name, timeout=None,
+                       interval=0.5):
+    """Poll the sessions of a server until there are none or the timeout
+    has passed. Returns whether the server is drained.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while control.get_server_sessions(backend, server_name) != 0:
+        if deadline is None:
+            time.sleep(interval)
+            continue
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+    return True
+
 
 class HaProxyControl(object):
     """The purpose of HaProxyControl is to enable and disable haproxy backends as
@@ -23,60 +145,599 @@ class HaProxyControl(object):
 
         global
            stats socket ipv4@0.0.0.0:9902 level admin
+           stats socket /run/haproxy/admin.sock level admin
 
     Connect with:
 
         >>> control = HaProxyControl('tcp://127.0.0.1:9902')
+
+    or, with less latency, through the UNIX socket:
+
+        >>> control = HaProxyControl('unix:///run/haproxy/admin.sock')
         >>> control.get_server_status('plone01', 'plone0102')
         'UP'
 
+    By default a new connection is opened for each command.
+    With ``persistent=True`` the connection is kept open in haproxy's
+    interactive mode ("prompt") and reused for subsequent commands.
+    When haproxy closed the connection in the meantime (e.g. because of the
+    "stats timeout"), it is transparently reopened.
+
+    A snapshot of many servers is taken with one request:
+
+        >>> control.get_server_statuses([('plone01', 'plone0101'),
+        ...                              ('plone01', 'plone0102')])
+        {('plone01', 'plone0101'): 'UP', ('plone01', 'plone0102'): 'MAINT'}
+
+    With ``stat_ttl`` (seconds) snapshots are reused for that long.
+
+    ``connect_timeout`` and ``timeout`` limit connecting and each send or
+    receive operation (seconds). A deadline limits the total time of all
+    operations within a block:
+
+        >>> with control.deadline(2):
+        ...     control.set_server_status('plone01', 'plone0101', 'MAINT')
+
+    Multiple commands can be pipelined on one connection:
+
+        >>> control.commands(['set server plone01/plone0101 state drain',
+        ...                   'set server plone01/plone0102 state drain'])
+        ['\n', '\n']
+
     """
 
-    def __init__(self, haproxy_socket):
+    def __init__(self, haproxy_socket, persistent=False, stat_ttl=0,
+                 connect_timeout=None, timeout=None, metrics=None):
+        self.persistent = persistent
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self._local = threading.local()
+        self.stat_ttl = stat_ttl
+        self._stat_cache = {}
         self._sock = None
+        self._buffer = ''
+        self._lock = threading.RLock()
+        self.haproxy_socket = haproxy_socket
         if haproxy_socket.startswith('tcp://'):
             self.sock_family = socket.AF_INET
             host, port = haproxy_socket[len('tcp://'):].split(':')
             self.sock_address = host, int(port)
+        elif haproxy_socket.startswith('unix://'):
+            self.sock_family = socket.AF_UNIX
+            self.sock_address = haproxy_socket[len('unix://'):]
         else:
             raise ValueError('haproxy_socket unsupported {!r}'.format(
                 haproxy_socket))
 
+    def ping(self):
+        """Send a cheap command in order to check that haproxy responds.
+        """
+        self.command('show info')
+
     def get_server_status(self, backend, server_name):
-        for line in self.get_stat():
-            if line['svname'] == server_name and line['pxname'] == backend:
-                return line['status'].split()[0]
+        return self.get_server_statuses([(backend, server_name)])[
+            (backend, server_name)]
+
+    def get_server_statuses(self, servers):
+        """Return the status of multiple servers, given as list of
+        ``(backend, server_name)`` tuples, from one snapshot.
+        Unknown servers have the status ``None``.
+        """
+        backends = set(backend for backend, server_name in servers)
+        if len(backends) == 1:
+            index = self.get_stat_index(proxy=backends.pop())
+        else:
+            index = self.get_stat_index()
+
+        return {key: index[key].status if key in index else None
+                for key in servers}
+
+    def get_stat_index(self, proxy=-1, types=TYPE_SERVER):
+        """Return a snapshot of "show stat" as dict, mapping
+        ``(pxname, svname)`` to ``ServerStat`` tuples.
+        ``proxy`` is a proxy id or name; haproxy before 1.7 only filters
+        by id, therefore names are filtered here.
+        """
+        key = (proxy, types)
+        if self.stat_ttl:
+            timestamp, index = self._stat_cache.get(key, (None, None))
+            if timestamp is not None \
+               and time.time() - timestamp < self.stat_ttl:
+                return index
+
+        index = {}
+        by_name = isinstance(proxy, basestring)
+        for row in self.iter_stat(-1 if by_name else proxy, types):
+            if by_name and row['pxname'] != proxy:
+                continue
+            stat = ServerStat(
+                row['pxname'],
+                row['svname'],
+                row['status'].split()[0] if row['status'] else None,
+                *(int(row[name] or 0)
+                  for name in ('weight', 'qcur', 'scur', 'rtime', 'ttime')))
+            index[stat.pxname, stat.svname] = stat
+
+        if self.stat_ttl:
+            self._stat_cache[key] = (time.time(), index)
+        return index
 
     def set_server_status(self, backend, server_name, state):
+        self._stat_cache.clear()
+        return self.command(self._set_server_status_command(
+            backend, server_name, state))
+
+    def set_server_statuses(self, changes):
+        """Set the states of multiple servers, given as list of
+        ``(backend, server_name, state)`` tuples, in one batch.
+        Returns the list of replies.
+        """
+        return self.set_servers(states=changes)
+
+    def set_servers(self, states=(), weights=()):
+        """Set the states, a list of ``(backend, server_name, state)``, and
+        the weights, a list of ``(backend, server_name, weight)``, of multiple
+        servers in one batch (see ``batch``).
+        Returns the list of replies, the replies of the states first.
+        """
+        cmds = [self._set_server_status_command(*change) for change in states]
+        cmds.extend('set weight {}/{} {}'.format(*change) for change in weights)
+        self._stat_cache.clear()
+        return self.batch(cmds)
+
+    def _set_server_status_command(self, backend, server_name, state):
         valid_states = (STATUS_READY, STATUS_DRAIN, STATUS_MAINT)
         if state not in valid_states:
             raise ValueError('State must be one of {!r}, got {!r}'.format(
                 valid_states, state))
 
-        return self.command('set server {}/{} state {}'.format(
-            backend, server_name, state.lower()))
+        return 'set server {}/{} state {}'.format(
+            backend, server_name, state.lower())
+
+    def get_server_sessions(self, backend, server_name):
+        """Return the number of current sessions (``scur``) and queued
+        requests (``qcur``) of a server.
+        """
+        stat = self.get_stat_index(proxy=backend).get((backend, server_name))
+        if stat is None:
+            raise KeyError('Unknown server {}/{}'.format(backend, server_name))
+        return stat.scur + stat.qcur
+
+    def wait_until_drained(self, backend, server_name, timeout=None,
+                           interval=0.5):
+        """Wait until a server has no sessions anymore, e.g. after setting it
+        to DRAIN, or until ``timeout`` seconds have passed.
+        Returns whether the server is drained.
+        """
+        return wait_until_drained(self, backend, server_name, timeout,
+                                  interval)
+
+    def set_server_weight(self, backend, server_name, weight):
+        """Set the weight of a server, either absolute (e.g. ``50``) or
+        relative to the configured weight (e.g. ``'50%'``).
+        """
+        self._stat_cache.clear()
+        return self.command('set weight {}/{} {}'.format(
+            backend, server_name, weight))
+
+    def get_server_admin_states(self, backend=None):
+        """Return the state set by admins (``STATUS_READY``, ``STATUS_DRAIN``
+        or ``STATUS_MAINT``) of all servers, or the servers of one backend,
+        as dict mapping ``(backend, server_name)`` to the state.
+        This uses "show servers state", which is cheaper than "show stat".
+        """
+        states = {}
+        for row in self.get_servers_state(backend):
+            admin_state = int(row['srv_admin_state'])
+            if admin_state & ADMIN_FMAINT:
+                state = STATUS_MAINT
+            elif admin_state & ADMIN_FDRAIN:
+                state = STATUS_DRAIN
+            else:
+                state = STATUS_READY
+            states[row['be_name'], row['srv_name']] = state
+
+        return states
+
+    def get_servers_state(self, backend=None):
+        """Return the rows of "show servers state" as ordered dicts, with
+        the fields in the order of haproxy's reply.
+        """
+        cmd = 'show servers state'
+        if backend is not None:
+            cmd += ' ' + backend
+
+        rows = []
+        fieldnames = None
+        for line in self.iter_lines(cmd):
+            if line.startswith('# '):
+                fieldnames = line[2:].split()
+            elif fieldnames and line.strip():
+                rows.append(OrderedDict(zip(fieldnames, line.split())))
+        return rows
 
-    def get_stat(self):
-        data = self.command('show stat').lstrip('# ')
-        return list(csv.DictReader(data.splitlines()))
+    def get_stat(self, proxy=-1, types=-1, server_id=-1):
+        return list(self.iter_stat(proxy, types, server_id))
+
+    def iter_stat(self, proxy=-1, types=-1, server_id=-1):
+        """Yield the rows of "show stat" as dicts while they are received.
+
+        The rows can be filtered by haproxy: ``proxy`` is a proxy id (or a
+        name, from haproxy 1.7), ``types`` is a combination of
+        ``TYPE_FRONTEND``, ``TYPE_BACKEND`` and ``TYPE_SERVER`` and
+        ``server_id`` a server id; -1 matches everything.
+        """
+        cmd = 'show stat'
+        if (proxy, types, server_id) != (-1, -1, -1):
+            cmd += ' {} {} {}'.format(proxy, types, server_id)
+
+        lines = self.iter_lines(cmd)
+        try:
+            header = next(lines, '').lstrip('# ')
+            fieldnames = next(csv.reader([header]), [])
+            for row in csv.DictReader(lines, fieldnames=fieldnames):
+                yield row
+        finally:
+            lines.close()
+
+    def iter_lines(self, cmd):
+        """Send a command and yield the lines of the reply while they are
+        received.
+        """
+        rest = ''
+        for chunk in self.iter_command(cmd):
+            lines = (rest + chunk).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+
+        if rest:
+            yield rest
 
     def command(self, cmd):
-        with self.connect() as sock:
-            sock.send(cmd.rstrip() + '\n')
-            return sock.recv(4096)
+        return ''.join(self.iter_command(cmd))
+
+    def iter_command(self, cmd):
+        """Send a command and yield the reply in chunks while they are
+        received, until haproxy closes the connection or, in interactive
+        mode, until the prompt.
+        """
+        if not self.persistent:
+            with self.connect() as sock:
+                self._sendall(sock, cmd.rstrip() + '\n')
+                for chunk in iter(lambda: self._recv(sock), ''):
+                    yield chunk
+            return
+
+        with self._lock:
+            try:
+                self._send([cmd])
+                reply = self._iter_reply()
+                for chunk in reply:
+                    yield chunk
+
+            except GeneratorExit:
+                # Consume the rest of the reply, so that the connection
+                # can be reused.
+                try:
+                    for chunk in reply:
+                        pass
+                except socket.error:
+                    self.close()
+                raise
+
+            except:
+                self.close()
+                raise
+
+    def commands(self, cmds):
+        """Send multiple commands pipelined on one interactive connection
+        and return the list of replies.
+        """
+        return self._pipeline(cmds, len(cmds))
+
+    def batch(self, cmds):
+        """Send multiple commands as ";"-separated command lines, so that
+        haproxy executes them in one round-trip, and return the list of
+        replies, one per command.
+
+        Without persistent connection, a batch fitting into one line is
+        sent on a non-interactive connection and the replies are split at
+        the empty lines terminating them. The commands must therefore not
+        reply with empty lines, as "set" commands do.
+        """
+        if not cmds:
+            return []
+
+        lines = batch_lines(cmds)
+        if not self.persistent and len(lines) == 1:
+            return split_replies(self.command(lines[0]), len(cmds))
+        return self._pipeline(lines, len(cmds))
+
+    def _pipeline(self, lines, num_replies):
+        with self._lock:
+            completed = False
+            try:
+                self._send(lines)
+                replies = [''.join(self._iter_reply())
+                           for _ in range(num_replies)]
+                completed = True
+                return replies
+            finally:
+                if not completed or not self.persistent:
+                    self.close()
+
+    def close(self):
+        """Close the persistent connection, if there is one.
+        """
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+            self._sock = None
+            self._buffer = ''
+
+    def _send(self, cmds):
+        payload = ''.join(cmd.rstrip() + '\n' for cmd in cmds)
+        if self._sock is not None and not self._is_alive():
+            # haproxy closed the connection in the meantime,
+            # e.g. because of the "stats timeout".
+            self.close()
+
+        if self._sock is not None:
+            try:
+                return self._sendall(self._sock, payload)
+            except socket.error:
+                self.close()
+
+        self._sock = self._open()
+        self._sendall(self._sock, 'prompt\n' + payload)
+        ''.join(self._iter_reply())
+
+    def _is_alive(self):
+        if not select.select([self._sock], [], [], 0)[0]:
+            return True
+
+        self._sock.settimeout(0)
+
+        try:
+            return self._sock.recv(1, socket.MSG_PEEK) != ''
+        except socket.error:
+            return False
+
+    def _iter_reply(self):
+        buf, self._buffer = self._buffer, ''
+        while True:
+            index = buf.find(PROMPT)
+            if index != -1:
+                self._buffer = buf[index + len(PROMPT):]
+                yield buf[:index + 1]
+                return
+
+            # Keep the end, it may be the beginning of a prompt.
+            cut = len(buf) - len(PROMPT) + 1
+            if cut > 0:
+                yield buf[:cut]
+                buf = buf[cut:]
+
+            data = self._recv(self._sock)
+            if not data:
+                raise socket.error(errno.ECONNRESET,
+                                   'Connection closed by haproxy')
+            buf += data
+
+    @contextmanager
+    def deadline(self, seconds):
+        """Limit the total time of the communication with haproxy within
+        the block. ``None`` means no limit.
+        """
+        previous = getattr(self._local, 'deadline', None)
+        if seconds is not None:
+            self._local.deadline = time.time() + seconds
+            if previous is not None:
+                self._local.deadline = min(previous, self._local.deadline)
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def _get_timeout(self, timeout):
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return timeout
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise HaProxyDeadlineExceeded(
+                'The deadline for communicating with haproxy has passed.')
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def _sendall(self, sock, data):
+        sock.settimeout(self._get_timeout(self.timeout))
+        try:
+            with self.metrics.timer('haproxy_send_seconds'):
+                sock.sendall(data)
+        except socket.timeout, exc:
+            raise HaProxySendTimeout(*exc.args)
+
+    def _recv(self, sock):
+        sock.settimeout(self._get_timeout(self.timeout))
+        try:
+            with self.metrics.timer('haproxy_receive_seconds'):
+                return sock.recv(CHUNK_SIZE)
+        except socket.timeout, exc:
+            raise HaProxyReceiveTimeout(*exc.args)
 
     @contextmanager
     def connect(self):
+        sock = self._open()
+        try:
+            yield sock
+        finally:
+            sock.close()
+
+    def _open(self):
         sock = socket.socket(self.sock_family, socket.SOCK_STREAM)
         try:
-            sock.connect(self.sock_address)
+            sock.settimeout(self._get_timeout(self.connect_timeout))
+            with self.metrics.timer('haproxy_connect_seconds'):
+                sock.connect(self.sock_address)
+        except socket.timeout, exc:
+            sock.close()
+            raise HaProxyConnectTimeout(*exc.args)
+        except HaProxyDeadlineExceeded:
+            sock.close()
+            raise
         except socket.error, exc:
-            if exc.errno == errno.ECONNREFUSED:
+            sock.close()
+            # A missing UNIX socket usually means that haproxy is not
+            # running (or restarting), just like a refused connection.
+            if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):
                 raise HaProxyConnectionRefused(exc)
             else:
                 raise
 
+        return sock
+
+
+class MultiHaProxyControl(object):
+    """Controls multiple haproxy processes (e.g. with "nbproc"), each with
+    its own stats socket, as if it was one HaProxyControl.
+
+        >>> control = MultiHaProxyControl(['unix:///run/haproxy/admin1.sock',
+        ...                                'unix:///run/haproxy/admin2.sock'],
+        ...                               persistent=True)
+
+    Commands are sent to all sockets in parallel. A failing socket does not
+    prevent the others from receiving the command; the first error is
+    raised when all sockets are done, so that the caller can retry.
+    Setting a state is idempotent, therefore retrying on all sockets is safe.
+
+    Reads (status, stats) are answered by the first socket which responds.
+    """
+
+    def __init__(self, haproxy_sockets, **kwargs):
+        self.controls = [HaProxyControl(haproxy_socket, **kwargs)
+                         for haproxy_socket in haproxy_sockets]
+        self.haproxy_socket = ','.join(haproxy_sockets)
+        self._local = threading.local()
+
+    def ping(self):
+        self._call_all('ping')
+
+    def get_server_status(self, backend, server_name):
+        return self._call_first('get_server_status', backend, server_name)
+
+    def get_server_statuses(self, servers):
+        return self._call_first('get_server_statuses', servers)
+
+    def get_stat_index(self, proxy=-1, types=TYPE_SERVER):
+        return self._call_first('get_stat_index', proxy, types)
+
+    def get_server_admin_states(self, backend=None):
+        return self._call_first('get_server_admin_states', backend)
+
+    def get_servers_state(self, backend=None):
+        return self._call_first('get_servers_state', backend)
+
+    def set_server_status(self, backend, server_name, state):
+        """Set the state on all sockets.
+        Returns the reply of the first socket.
+        """
+        return self._call_all(
+            'set_server_status', backend, server_name, state)[0]
+
+    def set_server_statuses(self, changes):
+        return self._call_all('set_server_statuses', changes)[0]
+
+    def get_server_sessions(self, backend, server_name):
+        """Return the sessions of a server summed over all processes.
+        """
+        return sum(self._call_all(
+            'get_server_sessions', backend, server_name))
+
+    def wait_until_drained(self, backend, server_name, timeout=None,
+                           interval=0.5):
+        return wait_until_drained(self, backend, server_name, timeout,
+                                  interval)
+
+    def set_server_weight(self, backend, server_name, weight):
+        return self._call_all(
+            'set_server_weight', backend, server_name, weight)[0]
+
+    def command(self, cmd):
+        return self._call_all('command', cmd)[0]
+
+    def commands(self, cmds):
+        return self._call_all('commands', cmds)[0]
+
+    def batch(self, cmds):
+        return self._call_all('batch', cmds)[0]
+
+    def set_servers(self, states=(), weights=()):
+        return self._call_all('set_servers', states, weights)[0]
+
+    def close(self):
+        for control in self.controls:
+            control.close()
+
+    @contextmanager
+    def deadline(self, seconds):
+        """Limit the total time of the communication with all haproxy
+        processes within the block. ``None`` means no limit.
+        """
+        previous = getattr(self._local, 'deadline', None)
+        if seconds is not None:
+            self._local.deadline = time.time() + seconds
+            if previous is not None:
+                self._local.deadline = min(previous, self._local.deadline)
         try:
-            yield sock
+            yield
         finally:
-            sock.close()
+            self._local.deadline = previous
+
+    def _remaining(self):
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return None
+        return deadline - time.time()
+
+    def _call_all(self, name, *args):
+        """Call the method on all controls in parallel and return the
+        results. The first error is raised after all calls have finished.
+        """
+        remaining = self._remaining()
+
+        def call(control):
+            with control.deadline(remaining):
+                return getattr(control, name)(*args)
+
+        results, errors = call_parallel(
+            [partial(call, control) for control in self.controls])
+        for exc in errors:
+            if exc is not None:
+                raise exc
+        return results
+
+    def _call_first(self, name, *args):
+        """Call the method on the controls one after another and return the
+        first result. The last error is raised when all calls failed.
+        """
+        error = None
+        for control in self.controls:
+            try:
+                with control.deadline(self._remaining()):
+                    return getattr(control, name)(*args)
+            except (HaProxyConnectionRefused, HaProxyTimeout,
+                    socket.error), exc:
+                error = exc
+        raise error
+
+
+def create_control(haproxy_socket, **options):
+    """Create a HaProxyControl, or a MultiHaProxyControl for multiple
+    comma-separated sockets of a multi-process haproxy.
+    """
+    if ',' in haproxy_socket:
+        return MultiHaProxyControl(haproxy_socket.split(','), **options)
+    return HaProxyControl(haproxy_socket, **options)
@@ -0,0 +1,80 @@
+from collections import deque
+import threading
+
+
+class LogWriter(threading.Thread):
+    """Writes lines to a stream in a background thread, so that writing
+    log messages never blocks, e.g. when supervisor reads the stderr of the
+    event listener slowly.
+
+    At most ``max_pending`` lines are buffered; further lines are dropped
+    and a warning with the number of dropped lines is written later.
+    ``flush`` waits until all buffered lines are written.
+    """
+
+    def __init__(self, stream, max_pending=10000):
+        super(LogWriter, self).__init__(name='supervisor-haproxy-log')
+        self.daemon = True
+        self.stream = stream
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.dropped = 0
+        self.busy = False
+        self.running = True
+        # Reentrant, since log messages are also written by signal handlers.
+        self.condition = threading.Condition(threading.RLock())
+
+    def start(self):
+        super(LogWriter, self).start()
+        return self
+
+    def write(self, line):
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self.pending.append(line)
+            self.condition.notify_all()
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                lines = list(self.pending)
+                self.pending.clear()
+                if self.dropped:
+                    lines.append('WARNING: log buffer full, dropped {}'
+                                 ' messages.\n'.format(self.dropped))
+                    self.dropped = 0
+                stream = self.stream
+                self.busy = True
+
+            try:
+                stream.write(''.join(lines))
+                stream.flush()
+            except Exception:
+                # There is nowhere to report the failure.
+                pass
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def flush(self):
+        """Wait until all buffered lines are written.
+        """
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+
+    def stop(self):
+        """Write the buffered lines and stop the writer.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join()
@@ -0,0 +1,135 @@
+import fnmatch
+import re
+import threading
+
+
+class ProgramMapping(object):
+    """Maps supervisor process names to haproxy backends and servers.
+
+    The mapping consists of programs (dicts with ``supervisor_program``,
+    ``haproxy_backend`` and ``haproxy_server``) and rules, which can be read
+    from a mapping file with one rule per line:
+
+        # exact program name
+        zeoclient plone04/plone0400
+        # glob pattern, "{name}" is replaced with the process name
+        glob:worker* plone05/{name}
+        # regular expression, groups are substituted
+        re:instance(\\d+) plone04/plone04\\1
+
+    Exact names are looked up in a dict, patterns are tried in the order of
+    the file; the first match wins. The result of each lookup is cached per
+    process name, so that each name is matched only once.
+
+    ``update`` replaces the rules atomically, lookups running in other
+    threads use either the old or the new rules.
+    """
+
+    def __init__(self, programs=(), rules=()):
+        self.programs = list(programs)
+        # Reentrant, since the rules are reloaded by a signal handler, which
+        # may interrupt a lookup holding the lock.
+        self._lock = threading.RLock()
+        self.update(rules)
+
+    @classmethod
+    def from_file(cls, path, programs=()):
+        mapping = cls(programs)
+        mapping.load(path)
+        return mapping
+
+    def load(self, path):
+        """Replace the rules with the rules of the mapping file.
+        """
+        with open(path) as mapping_file:
+            self.update(parse_rules(mapping_file.read(), path))
+
+    def update(self, rules):
+        exact = {program['supervisor_program']: program
+                 for program in self.programs}
+        patterns = []
+        for pattern, backend, server in rules:
+            if pattern.startswith('re:'):
+                # The whole name must match, with all alternatives.
+                patterns.append((re.compile('(?:' + pattern[3:] + r')\Z'),
+                                 backend, server))
+            elif pattern.startswith('glob:'):
+                patterns.append((re.compile(fnmatch.translate(pattern[5:])),
+                                 backend, server))
+            else:
+                exact.setdefault(pattern, make_program(pattern, backend,
+                                                       server))
+
+        servers = frozenset((program['haproxy_backend'],
+                             program['haproxy_server'])
+                            for program in exact.values())
+        # The rules, the cache and the servers are replaced at once.
+        with self._lock:
+            self._state = (exact, patterns, {}, servers)
+
+    @property
+    def servers(self):
+        """The (backend, server) tuples of all known programs.
+        Programs matched by patterns are known after their first lookup.
+        """
+        return self._state[3]
+
+    def get(self, name, default=None):
+        exact, patterns, cache, servers = self._state
+        if name in cache:
+            return cache[name] or default
+
+        program = exact.get(name)
+        if program is None:
+            for regex, backend, server in patterns:
+                match = regex.match(name)
+                if match:
+                    program = make_program(name, match.expand(backend),
+                                           match.expand(server))
+                    break
+
+        cache[name] = program
+        if program is not None:
+            key = (program['haproxy_backend'], program['haproxy_server'])
+            with self._lock:
+                state = self._state
+                if state[2] is cache and key not in state[3]:
+                    self._state = state[:3] + (state[3] | set([key]),)
+        return program or default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+
+def make_program(name, backend, server):
+    return {'supervisor_program': name,
+            'haproxy_backend': backend.replace('{name}', name),
+            'haproxy_server': server.replace('{name}', name)}
+
+
+def parse_rules(text, filename='<mapping>'):
+    """Parse the rules of a mapping file as list of
+    (pattern, backend, server) tuples.
+    """
+    rules = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        match = re.match(r'^(\S+)\s+([^/\s]+)/(\S+)$', line)
+        if not match:
+            raise ValueError(
+                '{}, line {}: invalid rule {!r}, must be of form'
+                ' "PATTERN BACKEND/SERVER"'.format(filename, lineno, line))
+
+        pattern = match.group(1)
+        if pattern.startswith('re:'):
+            try:
+                re.compile(pattern[3:])
+            except re.error, exc:
+                raise ValueError('{}, line {}: invalid regular expression'
+                                 ' {!r}: {}'.format(filename, lineno,
+                                                    pattern[3:], exc))
+        rules.append(match.groups())
+    return rules
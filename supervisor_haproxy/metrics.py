@@ -0,0 +1,169 @@
+from contextlib import contextmanager
+import os
+import tempfile
+import threading
+import time
+
+
+PREFIX = 'supervisor_haproxy_'
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+DESCRIPTIONS = {
+    'events_received_total': 'Events received from supervisor.',
+    'events_ignored_total': 'Events ignored (unsupported or unwatched).',
+    'commands_sent_total': 'State changes sent to haproxy.',
+    'commands_skipped_total': 'State changes skipped, already applied.',
+    'commands_rejected_total': 'State changes rejected by haproxy.',
+    'verification_failures_total': 'State changes not confirmed by haproxy.',
+    'weight_changes_total': 'Weight changes sent to haproxy.',
+    'changes_coalesced_total': 'State changes replaced by a newer change.',
+    'failures_total': 'Failed state changes.',
+    'connections_refused_total': 'Refused connections to haproxy.',
+    'queue_length': 'State changes waiting in the background queue.',
+    'retry_queue_length': 'Servers with changes waiting for a retry.',
+    'event_duration_seconds': 'Time for handling an event.',
+    'haproxy_connect_seconds': 'Time for connecting to haproxy.',
+    'haproxy_send_seconds': 'Time for sending to haproxy.',
+    'haproxy_receive_seconds': 'Time for receiving from haproxy.',
+}
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Metrics(object):
+    """Counters, gauges and latency histograms of the event listener, which
+    can be rendered in the Prometheus text format.
+
+        >>> metrics = Metrics()
+        >>> metrics.inc('events_received_total')
+        >>> with metrics.timer('event_duration_seconds'):
+        ...     handle_event()
+        >>> metrics.write_textfile('/var/lib/node_exporter/haproxy.prom')
+    """
+
+    def __init__(self):
+        # The metrics are rendered by the SIGUSR1 handler, which may
+        # interrupt the main thread while it holds the lock.
+        self.lock = threading.RLock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def get(self, name):
+        with self.lock:
+            return self.values.get(name, 0)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.values.items()):
+                metric_type = 'counter' if name.endswith('_total') else 'gauge'
+                lines.extend(self._header(name, metric_type))
+                lines.append('{}{} {}'.format(PREFIX, name, value))
+
+            for name, histogram in sorted(self.histograms.items()):
+                lines.extend(self._header(name, 'histogram'))
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append('{}{}_bucket{{le="{}"}} {}'.format(
+                        PREFIX, name, bound, cumulative))
+                lines.append('{}{}_bucket{{le="+Inf"}} {}'.format(
+                    PREFIX, name, histogram.count))
+                lines.append('{}{}_sum {!r}'.format(
+                    PREFIX, name, histogram.sum))
+                lines.append('{}{}_count {}'.format(
+                    PREFIX, name, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name, metric_type):
+        if name in DESCRIPTIONS:
+            yield '# HELP {}{} {}'.format(PREFIX, name, DESCRIPTIONS[name])
+        yield '# TYPE {}{} {}'.format(PREFIX, name, metric_type)
+
+    def write_textfile(self, path):
+        """Write the metrics to a file atomically, e.g. for the textfile
+        collector of the Prometheus node exporter.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-',
+                                        suffix='.prom')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(self.render())
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+
+class MetricsExporter(threading.Thread):
+    """Rewrites the metrics textfile periodically in the background.
+    """
+
+    def __init__(self, metrics, path, interval=15, update=None, log=None):
+        super(MetricsExporter, self).__init__(
+            name='supervisor-haproxy-metrics')
+        self.daemon = True
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.update = update or (lambda: None)
+        self.log = log or (lambda msg: None)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.export()
+            self.stopped.wait(self.interval)
+
+    def export(self):
+        try:
+            self.update()
+            self.metrics.write_textfile(self.path)
+        except Exception, exc:
+            self.log('ERROR: writing metrics failed: {!r}'.format(exc))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
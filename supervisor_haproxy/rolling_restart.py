@@ -0,0 +1,232 @@
+from datetime import datetime
+from supervisor.xmlrpc import SupervisorTransport
+from supervisor_haproxy.command import program_info
+from supervisor_haproxy.command import socket
+from supervisor_haproxy.exceptions import RollingRestartError
+from supervisor_haproxy.haproxy_control import create_control
+from supervisor_haproxy.haproxy_control import STATUS_DRAIN
+from supervisor_haproxy.haproxy_control import STATUS_NO_CHECK
+from supervisor_haproxy.haproxy_control import STATUS_READY
+from supervisor_haproxy.haproxy_control import STATUS_UP
+import argparse
+import sys
+import time
+import xmlrpclib
+
+
+class RollingRestart(object):
+    """Restarts supervisor programs backend by backend in batches, without
+    dropping below ``min_ready`` servers which are UP in each backend.
+
+    For each batch the servers are set to DRAIN, the restart waits until
+    they have no sessions anymore (at most ``drain_timeout`` seconds), the
+    programs are restarted through supervisor's XML-RPC API and the restart
+    waits until haproxy reports the servers UP again (at most ``up_timeout``
+    seconds) before the next batch.
+
+    Setting the servers to MAINT and READY while the programs restart is up
+    to the event listener. Servers without health check ("no check") count
+    as UP.
+
+    When supervisor fails to stop or start a program, the servers of the
+    programs which were not stopped are set back to READY and the restart
+    is aborted.
+    """
+
+    def __init__(self, haproxy_control, rpc, programs, batch_size=1,
+                 min_ready=1, drain_timeout=60, up_timeout=120, interval=0.5,
+                 log=None):
+        self.haproxy_control = haproxy_control
+        self.rpc = rpc
+        self.programs = programs
+        self.batch_size = batch_size
+        self.min_ready = min_ready
+        self.drain_timeout = drain_timeout
+        self.up_timeout = up_timeout
+        self.interval = interval
+        self.log = log or (lambda msg: None)
+
+    def run(self):
+        backends = {}
+        for program in self.programs:
+            backends.setdefault(program['haproxy_backend'], []).append(program)
+
+        for backend, programs in sorted(backends.items()):
+            self.restart_backend(backend, programs)
+
+    def restart_backend(self, backend, programs):
+        pending = list(programs)
+        while pending:
+            size = min(self.batch_size, len(pending),
+                       self.wait_for_capacity(backend))
+            batch, pending = pending[:size], pending[size:]
+            self.restart_batch(backend, batch)
+
+    def wait_for_capacity(self, backend):
+        """Return the number of servers which may be restarted at once
+        without dropping below ``min_ready`` servers.
+        """
+        deadline = time.time() + self.up_timeout
+        while True:
+            capacity = len(self.get_up_servers(backend)) - self.min_ready
+            if capacity > 0:
+                return capacity
+            if time.time() >= deadline:
+                raise RollingRestartError(
+                    'Not enough servers UP in backend {}, at least {} must'
+                    ' stay UP.'.format(backend, self.min_ready))
+            time.sleep(self.interval)
+
+    def get_up_servers(self, backend):
+        return set(key for key, stat
+                   in self.haproxy_control.get_stat_index(proxy=backend).items()
+                   if stat.status in (STATUS_UP, STATUS_NO_CHECK))
+
+    def restart_batch(self, backend, batch):
+        names = ', '.join(program['supervisor_program'] for program in batch)
+        self.log('{date} Restarting {names} of backend {backend}.'.format(
+            date=datetime.now().isoformat(), names=names, backend=backend))
+
+        self.haproxy_control.set_server_statuses([
+            (backend, program['haproxy_server'], STATUS_DRAIN)
+            for program in batch])
+        deadline = time.time() + self.drain_timeout
+        for program in batch:
+            if not self.haproxy_control.wait_until_drained(
+                    backend, program['haproxy_server'],
+                    timeout=max(0, deadline - time.time()),
+                    interval=self.interval):
+                self.log('WARNING: {}/{} is not drained after {} seconds,'
+                         ' restarting anyway.'.format(
+                             backend, program['haproxy_server'],
+                             self.drain_timeout))
+
+        stopped = []
+        started = []
+        try:
+            for program in batch:
+                action = 'Stopping'
+                self.rpc.supervisor.stopProcess(program['supervisor_program'])
+                stopped.append(program)
+            for program in batch:
+                action = 'Starting'
+                self.rpc.supervisor.startProcess(program['supervisor_program'])
+                started.append(program)
+        except xmlrpclib.Fault, exc:
+            self.abort_batch(backend, batch, stopped, started, '{} {} failed:'
+                             ' {}'.format(action, program['supervisor_program'],
+                                          exc.faultString))
+
+        servers = set((backend, program['haproxy_server'])
+                      for program in batch)
+        deadline = time.time() + self.up_timeout
+        while not servers <= self.get_up_servers(backend):
+            if time.time() >= deadline:
+                raise RollingRestartError(
+                    '{} not UP after {} seconds, aborting.'.format(
+                        ', '.join('{}/{}'.format(*key) for key in sorted(
+                            servers - self.get_up_servers(backend))),
+                        self.up_timeout))
+            time.sleep(self.interval)
+
+    def abort_batch(self, backend, batch, stopped, started, reason):
+        """Set the servers of the programs which were not stopped back to
+        READY and raise a ``RollingRestartError`` naming the programs which
+        are stopped.
+        """
+        running = [program for program in batch if program not in stopped]
+        if running:
+            self.haproxy_control.set_server_statuses([
+                (backend, program['haproxy_server'], STATUS_READY)
+                for program in running])
+
+        message = '{}, aborting.'.format(reason)
+        down = [program['supervisor_program'] for program in stopped
+                if program not in started]
+        if down:
+            message += ' Not started again: {}.'.format(', '.join(down))
+        raise RollingRestartError(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=('Restart supervisor programs in batches, while keeping'
+                     ' enough haproxy servers of each backend UP.'),
+        epilog=('>> %(prog)s --min-ready 2 tcp://localhost:8800'
+                ' instance1:plone04/plone0401 instance2:plone04/plone0402'
+                ' instance3:plone04/plone0403'))
+
+    parser.add_argument(
+        'haproxy_socket',
+        metavar='SOCKET',
+        type=socket,
+        help=(u'The haproxy stats socket, e.g. tcp://localhost:8800 or'
+              u' unix:///run/haproxy/admin.sock.'))
+
+    parser.add_argument(
+        'programs',
+        type=program_info,
+        metavar='PROGRAMS',
+        nargs='+',
+        help=(u'The programs to restart, mapped to the haproxy backend and'
+              u' server, in the same form as for the event listener, e.g.'
+              u' "instance2:plone04/plone0402".'))
+
+    parser.add_argument(
+        '--supervisor-url',
+        default='http://localhost:9001',
+        metavar='URL',
+        help=(u'The URL of supervisor\'s XML-RPC interface, e.g.'
+              u' unix:///var/run/supervisor.sock (default: %(default)s).'))
+
+    parser.add_argument('--username', help=u'The supervisor username.')
+    parser.add_argument('--password', help=u'The supervisor password.')
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help=(u'The number of programs of a backend restarted at once'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--min-ready',
+        type=int,
+        default=1,
+        metavar='NUM',
+        help=(u'The minimum number of servers which stay UP in each backend'
+              u' (default: %(default)s).'))
+
+    parser.add_argument(
+        '--drain-timeout',
+        type=float,
+        default=60,
+        metavar='SECONDS',
+        help=(u'The maximum time to wait for the sessions of a draining'
+              u' server to finish (default: %(default)s).'))
+
+    parser.add_argument(
+        '--up-timeout',
+        type=float,
+        default=120,
+        metavar='SECONDS',
+        help=(u'Abort when a restarted server is not UP in haproxy after'
+              u' that many seconds (default: %(default)s).'))
+
+    args = parser.parse_args()
+    rpc = xmlrpclib.ServerProxy(
+        'http://127.0.0.1',
+        transport=SupervisorTransport(args.username, args.password,
+                                      args.supervisor_url))
+    restart = RollingRestart(
+        create_control(args.haproxy_socket, timeout=10), rpc, args.programs,
+        batch_size=args.batch_size,
+        min_ready=args.min_ready,
+        drain_timeout=args.drain_timeout,
+        up_timeout=args.up_timeout,
+        log=lambda msg: sys.stderr.write(msg + '\n'))
+    try:
+        restart.run()
+    except RollingRestartError, exc:
+        sys.stderr.write('ERROR: {}\n'.format(exc))
+        sys.exit(1)
@@ -0,0 +1,125 @@
+import heapq
+import threading
+import time
+
+
+class SlowStart(threading.Thread):
+    """Raises the weight of servers which just became READY step by step,
+    so that a freshly started instance with cold caches does not get its
+    full share of traffic at once.
+
+    ``begin`` sets the initial weight (percent of the configured weight)
+    and schedules the steps up to 100% within ``duration`` seconds.
+    ``set_weight(key, percent)`` is called for each step and must return
+    whether the weight was set; the last step is retried until it succeeds,
+    so that a server is not left with a low weight.
+
+    ``cancel`` stops the ramp of a server, e.g. when the program is no longer
+    running. Each ``begin`` and ``cancel`` increments the generation of the
+    server; steps scheduled by an older generation are discarded.
+    """
+
+    def __init__(self, set_weight, duration, initial_weight=10, steps=10,
+                 log=None):
+        super(SlowStart, self).__init__(name='supervisor-haproxy-slow-start')
+        self.daemon = True
+        self.set_weight = set_weight
+        self.duration = duration
+        self.initial_weight = initial_weight
+        self.steps = steps
+        self.log = log or (lambda msg: None)
+        self.generations = {}
+        # Heap of (due, generation, key, weight) entries.
+        self.schedule = []
+        self.condition = threading.Condition()
+        self.busy = False
+        self.running = True
+
+    @property
+    def interval(self):
+        return float(self.duration) / self.steps
+
+    def begin(self, key):
+        """Set the initial weight of the server and schedule the ramp.
+        """
+        with self.condition:
+            generation = self._next_generation(key)
+            now = time.time()
+            for step in range(1, self.steps + 1):
+                weight = self.initial_weight + int(
+                    (100 - self.initial_weight) * step / self.steps)
+                heapq.heappush(self.schedule, (
+                    now + step * self.interval, generation, key, weight))
+            self.condition.notify_all()
+
+        self.set_weight(key, self.initial_weight)
+
+    def cancel(self, key):
+        """Discard the scheduled steps of the server.
+        """
+        with self.condition:
+            if key in self.generations:
+                self._next_generation(key)
+                # Wake up the thread, so that it discards the steps instead
+                # of sleeping until the next one is due.
+                self.condition.notify_all()
+
+    def ramping(self):
+        """Return the keys of the servers with scheduled steps.
+        """
+        with self.condition:
+            return set(key for due, generation, key, weight in self.schedule
+                       if self.generations.get(key) == generation)
+
+    def _next_generation(self, key):
+        self.generations[key] = self.generations.get(key, 0) + 1
+        return self.generations[key]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.schedule:
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+                due, generation, key, weight = self.schedule[0]
+                if self.generations.get(key) != generation:
+                    heapq.heappop(self.schedule)
+                    self.condition.notify_all()
+                    continue
+
+                delay = due - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                heapq.heappop(self.schedule)
+                self.busy = True
+
+            try:
+                applied = self.set_weight(key, weight)
+            except Exception, exc:
+                self.log('ERROR: {!r}'.format(exc))
+                applied = False
+
+            with self.condition:
+                self.busy = False
+                if not applied and weight == 100 \
+                   and self.generations.get(key) == generation:
+                    heapq.heappush(self.schedule, (
+                        time.time() + self.interval, generation, key, weight))
+                self.condition.notify_all()
+
+    def join_schedule(self):
+        """Wait until all scheduled steps are done.
+        """
+        with self.condition:
+            while self.schedule or self.busy:
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join()
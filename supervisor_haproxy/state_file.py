@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from supervisor_haproxy.haproxy_control import ADMIN_FDRAIN
+from supervisor_haproxy.haproxy_control import ADMIN_FMAINT
+from supervisor_haproxy.haproxy_control import STATUS_DRAIN
+from supervisor_haproxy.haproxy_control import STATUS_MAINT
+import os
+import tempfile
+import threading
+
+
+# The version of the "show servers state" format, the first line of the
+# reply and of the file.
+STATE_FILE_VERSION = '1'
+
+
+class ServerStateFile(object):
+    """Keeps a haproxy ``server-state-file`` up to date, so that haproxy
+    starts with the states set by the event listener after a reload:
+
+        global
+            server-state-file /var/lib/haproxy/server-state
+        defaults
+            load-server-state-from-file global
+
+    The file has the format of "show servers state". It is built from a
+    snapshot of haproxy (``sync``) and the states and weights set afterwards
+    are applied to the snapshot (``update``, ``set_weight``). The file is
+    replaced atomically, but only when its content changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # The rows of "show servers state" by (backend, server).
+        self.rows = OrderedDict()
+        self.fieldnames = None
+        self.written = None
+
+    @property
+    def loaded(self):
+        return self.fieldnames is not None
+
+    def sync(self, rows):
+        """Replace the snapshot with the rows of "show servers state", as
+        returned by ``HaProxyControl.get_servers_state``.
+        """
+        with self.lock:
+            self.rows = OrderedDict(
+                ((row['be_name'], row['srv_name']), OrderedDict(row))
+                for row in rows)
+            self.fieldnames = rows[0].keys() if rows else []
+            return self.write()
+
+    def update(self, changes):
+        """Apply the admin states of the changes, a list of
+        ``(backend, server, state)``, to the snapshot.
+        Servers which are not in the snapshot are ignored.
+        """
+        with self.lock:
+            if not self.loaded:
+                return False
+            for backend, server, state in changes:
+                row = self.rows.get((backend, server))
+                if row is None:
+                    continue
+                admin_state = int(row['srv_admin_state']) \
+                    & ~(ADMIN_FMAINT | ADMIN_FDRAIN)
+                if state == STATUS_MAINT:
+                    admin_state |= ADMIN_FMAINT
+                elif state == STATUS_DRAIN:
+                    admin_state |= ADMIN_FDRAIN
+                row['srv_admin_state'] = str(admin_state)
+            return self.write()
+
+    def set_weight(self, changes):
+        """Apply the weights of the changes, a list of
+        ``((backend, server), percent)``, to the snapshot. The weight is a
+        percentage of the configured weight, as for "set weight".
+        """
+        with self.lock:
+            if not self.loaded:
+                return False
+            for key, percent in changes:
+                row = self.rows.get(key)
+                if row is None:
+                    continue
+                row['srv_uweight'] = str(
+                    int(row['srv_iweight']) * int(percent) // 100)
+            return self.write()
+
+    def render(self):
+        lines = [STATE_FILE_VERSION, '# ' + ' '.join(self.fieldnames or [])]
+        lines.extend(' '.join(row.values()) for row in self.rows.values())
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Write the file atomically, when it changed.
+        Returns ``True`` when the file was written.
+        """
+        content = self.render()
+        if content == self.written:
+            return False
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-',
+                                        suffix='.state')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(content)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        self.written = content
+        return True
@@ -0,0 +1,447 @@
+from datetime import datetime
+from supervisor_haproxy.circuit_breaker import CircuitBreaker
+from supervisor_haproxy.exceptions import HaProxyCommandError
+from supervisor_haproxy.exceptions import HaProxyConnectionRefused
+from supervisor_haproxy.exceptions import HaProxyTimeout
+from supervisor_haproxy.haproxy_control import STATUS_DRAIN
+from supervisor_haproxy.haproxy_control import STATUS_MAINT
+from supervisor_haproxy.haproxy_control import STATUS_READY
+import threading
+import time
+
+
+MAX_CONSECUTIVE_CONNECTION_REFUSED = 4
+
+
+class HaProxyTarget(object):
+    """A haproxy load balancer, which is kept up to date by the event
+    listener.
+
+    Each target has its own connection (``haproxy_control``), circuit
+    breaker and cache of applied states, so that a failing or slow load
+    balancer does not affect the others.
+    """
+
+    def __init__(self, haproxy_control, programs, metrics, log,
+                 event_timeout=None, state_cache_ttl=None, retry_min_delay=1,
+                 retry_max_delay=60, retry_queue_size=1000,
+                 weight_controller=None, state_file=None, verify=False,
+                 tracer=None):
+        self.haproxy_control = haproxy_control
+        # The watched programs, a ``ProgramMapping``.
+        self.programs = programs
+        self.metrics = metrics
+        self.log = log
+        # The maximum time spent communicating with haproxy per event.
+        self.event_timeout = event_timeout
+        # After too many failures, the circuit breaker queues the changes
+        # and retries with an exponentially growing delay.
+        self.breaker = CircuitBreaker(
+            threshold=MAX_CONSECUTIVE_CONNECTION_REFUSED,
+            min_delay=retry_min_delay,
+            max_delay=retry_max_delay,
+            queue_size=retry_queue_size)
+        self.lock = threading.RLock()
+        # The states applied to haproxy, by (backend, server), are cached
+        # in order to skip redundant commands. The cache is synchronized
+        # with haproxy after state_cache_ttl seconds, so that changes made
+        # by others are corrected.
+        self.state_cache_ttl = state_cache_ttl
+        self.applied_states = {}
+        self.applied_states_synced_at = None
+        # Adjusts the weights of the servers to their load, each target
+        # has its own, since the load differs between load balancers.
+        self.weight_controller = weight_controller
+        # Keeps haproxy's server-state-file up to date (``ServerStateFile``),
+        # so that the states survive a reload of haproxy.
+        self.state_file = state_file
+        # Verification checks the replies of haproxy for errors and
+        # confirms the applied states with a stats snapshot.
+        self.verify = verify
+        # Writes a trace record for each applied change (``Tracer``).
+        self.tracer = tracer
+
+    @property
+    def servers(self):
+        """The (backend, server) tuples of the watched programs.
+        """
+        return self.programs.servers
+
+    def tick(self):
+        """Retry the queued changes when the circuit breaker allows it.
+        """
+        with self.lock:
+            if self.breaker.queue and self.breaker.allow_request():
+                self.recover()
+            if self.state_file is not None and not self.breaker.queue \
+               and self.breaker.allow_request() \
+               and not self.breaker.half_open:
+                self.sync_state_file()
+
+    def enqueue(self, key, action):
+        with self.lock:
+            self.breaker.enqueue(key, action)
+
+    def process_change(self, key, action, can_fail=True):
+        """Apply a change unless the circuit breaker is open, in which case
+        the change is queued for retrying.
+        Returns ``False`` when the change failed and was not queued.
+        """
+        return self.process_changes([(key, action)], can_fail)
+
+    def process_changes(self, changes, can_fail=True):
+        """Apply a list of ``(key, action)`` changes in one batch, like
+        ``process_change``.
+        """
+        with self.lock:
+            if not self.breaker.allow_request():
+                for key, action in changes:
+                    self.breaker.enqueue(key, action)
+                self.log('WARNING: HaProxy is not reachable, queueing the'
+                         ' change and retrying in {:.1f} seconds.'.format(
+                             self.breaker.retry_in))
+                return True
+
+            if self.breaker.half_open:
+                for key, action in changes:
+                    self.breaker.enqueue(key, action)
+                self.recover()
+                return True
+
+            # The changes replace older queued changes of the same servers,
+            # which must not be sent afterwards.
+            for key, action in changes:
+                self.breaker.queue.pop(key, None)
+
+            try:
+                self.apply_batch(changes)
+
+            except (HaProxyConnectionRefused, HaProxyTimeout,
+                    EnvironmentError), exc:
+                # The connection failed, e.g. it was reset while haproxy
+                # reloads; the change can be retried.
+                self.metrics.inc('failures_total')
+                if isinstance(exc, HaProxyConnectionRefused):
+                    self.metrics.inc('connections_refused_total')
+                    self.log('ERROR: connection to HaProxy stats socket'
+                             ' refused')
+                elif isinstance(exc, HaProxyTimeout):
+                    self.log('ERROR: HaProxy stats socket timed out:'
+                             ' {!r}'.format(exc))
+                else:
+                    self.log('ERROR: {!r}'.format(exc))
+
+                opened = self.breaker.failure()
+                if opened:
+                    self.log('WARNING: too many connections failed,'
+                             ' therefore this and all future changes are'
+                             ' queued and retried in {:.1f} seconds.'.format(
+                                 self.breaker.retry_in))
+                if opened or not can_fail:
+                    for key, action in changes:
+                        self.breaker.enqueue(key, action)
+                    return True
+                return False
+
+            except Exception, exc:
+                self.metrics.inc('failures_total')
+                self.log('ERROR: {!r}'.format(exc))
+                return False
+
+            self.breaker.success()
+            if self.breaker.queue:
+                self.recover()
+            return True
+
+    def set_weight(self, key, weight):
+        """Set the weight (percent of the configured weight) of a server.
+        Returns ``False`` when haproxy is not reachable.
+        """
+        with self.lock:
+            if not self.breaker.allow_request() or self.breaker.half_open:
+                return False
+
+            try:
+                with self.haproxy_control.deadline(self.event_timeout):
+                    self.haproxy_control.set_server_weight(
+                        key[0], key[1], '{}%'.format(weight))
+            except Exception, exc:
+                self.metrics.inc('failures_total')
+                self.log('ERROR: setting the weight of {}/{} failed:'
+                         ' {!r}'.format(key[0], key[1], exc))
+                return False
+
+            self.metrics.inc('weight_changes_total')
+            self.update_state_file(weights=[(key, weight)])
+            return True
+
+    def adjust_weights(self, exclude=()):
+        """Take a snapshot of the stats and adjust the weights of the
+        servers with the weight controller, except for the servers in
+        ``exclude``.
+        """
+        with self.lock:
+            if not self.breaker.allow_request() or self.breaker.half_open:
+                return False
+
+            changes = []
+            try:
+                with self.haproxy_control.deadline(self.event_timeout):
+                    servers = self.servers
+                    backends = set(backend for backend, server in servers)
+                    index = self.haproxy_control.get_stat_index(
+                        proxy=tuple(backends)[0] if len(backends) == 1 else -1)
+                    changes = self.weight_controller.update(
+                        index, servers, exclude)
+                    for (backend, server), weight in changes:
+                        self.haproxy_control.set_server_weight(
+                            backend, server, '{}%'.format(weight))
+            except Exception, exc:
+                self.metrics.inc('failures_total')
+                self.log('ERROR: adjusting the weights failed: {!r}'.format(
+                    exc))
+                return False
+
+            if changes:
+                self.weight_controller.commit(changes)
+                self.metrics.inc('weight_changes_total', len(changes))
+                self.update_state_file(weights=changes)
+                self.log('{date} Adjusted weights: {changes}.'.format(
+                    date=datetime.now().isoformat(),
+                    changes=', '.join(
+                        '{}% for {}/{}'.format(weight, *key)
+                        for key, weight in changes)))
+            return True
+
+    def recover(self):
+        """Probe haproxy and send all queued changes in one batch when it is
+        reachable again.
+        """
+        with self.lock:
+            changes = [key + (action,) for key, action in self.breaker.drain()]
+            try:
+                with self.haproxy_control.deadline(self.event_timeout):
+                    self.haproxy_control.ping()
+                    if changes:
+                        self.haproxy_control.set_server_statuses(changes)
+
+            except Exception, exc:
+                # Any error, e.g. haproxy resetting the connection while it
+                # reloads, keeps the changes queued for the next retry.
+                self.metrics.inc('failures_total')
+                if isinstance(exc, HaProxyConnectionRefused):
+                    self.metrics.inc('connections_refused_total')
+                for backend, server, action in changes:
+                    if (backend, server) not in self.breaker.queue:
+                        self.breaker.enqueue((backend, server), action)
+                self.breaker.failure()
+                self.log('WARNING: HaProxy is still not reachable ({!r}),'
+                         ' retrying in {:.1f} seconds.'.format(
+                             exc, self.breaker.retry_in))
+                return False
+
+            self.breaker.success()
+            self.metrics.inc('commands_sent_total', len(changes))
+            self.update_state_file(changes)
+            if self.state_cache_ttl is not None:
+                self.applied_states.update(
+                    ((backend, server), action)
+                    for backend, server, action in changes)
+            self.log('{date} HaProxy is reachable, sent {num} queued'
+                     ' changes.'.format(date=datetime.now().isoformat(),
+                                        num=len(changes)))
+            return True
+
+    def apply(self, key, action):
+        self.apply_batch([(key, action)])
+
+    def apply_batch(self, changes):
+        """Send a list of ``(key, action)`` changes to haproxy, a single
+        change as one command and multiple changes as one batch.
+        """
+        with self.haproxy_control.deadline(self.event_timeout):
+            if self.state_cache_ttl is not None:
+                self.sync_applied_states()
+                pending = []
+                for key, action in changes:
+                    if self.applied_states.get(key) == action:
+                        self.log('Skipping {} for {}/{}, already'
+                                 ' applied.'.format(action, *key))
+                        self.metrics.inc('commands_skipped_total')
+                    else:
+                        pending.append((key, action))
+                changes = pending
+
+            if not changes:
+                return
+
+            for key, action in changes:
+                self.applied_states.pop(key, None)
+            changes = [key + (action,) for key, action in changes]
+            sent = time.time()
+            replied = verified = None
+            try:
+                if len(changes) == 1:
+                    replies = [self.haproxy_control.set_server_status(
+                        *changes[0])]
+                else:
+                    replies = self.haproxy_control.set_server_statuses(changes)
+                replied = time.time()
+                self.metrics.inc('commands_sent_total', len(changes))
+                if self.verify:
+                    self.check_replies(changes, replies)
+                    failed = self.verify_states(changes)
+                    verified = time.time()
+                else:
+                    failed = ()
+            except Exception, exc:
+                self.trace(changes, sent, replied, error=exc)
+                raise
+
+            self.trace(changes, sent, replied, verified, failed)
+            # Changes which were not confirmed are sent again next time.
+            changes = [(backend, server, action)
+                       for backend, server, action in changes
+                       if (backend, server) not in failed]
+            if self.state_cache_ttl is not None:
+                self.applied_states.update(
+                    ((backend, server), action)
+                    for backend, server, action in changes)
+            self.update_state_file(changes)
+
+    def check_replies(self, changes, replies):
+        """Raise ``HaProxyCommandError`` when haproxy rejected a change.
+        The "set server" command replies with an empty line on success.
+        """
+        for (backend, server, action), reply in zip(changes, replies):
+            if reply and reply.strip():
+                self.metrics.inc('commands_rejected_total')
+                raise HaProxyCommandError(
+                    'set server {}/{} state {}'.format(
+                        backend, server, action.lower()),
+                    reply.strip())
+
+    def verify_states(self, changes):
+        """Confirm the applied states with a stats snapshot.
+        Returns the keys of the servers which are not in the expected state.
+        """
+        statuses = self.haproxy_control.get_server_statuses(
+            [(backend, server) for backend, server, action in changes])
+        failed = set()
+        for backend, server, action in changes:
+            status = statuses.get((backend, server))
+            if action == STATUS_READY:
+                confirmed = status not in (None, STATUS_MAINT, STATUS_DRAIN)
+            else:
+                confirmed = status == action
+            if not confirmed:
+                failed.add((backend, server))
+                self.metrics.inc('verification_failures_total')
+                self.log('WARNING: {}/{} is {} after sending {}.'.format(
+                    backend, server, status, action))
+        return failed
+
+    def trace(self, changes, sent, replied, verified=None, failed=(),
+              error=None):
+        if self.tracer is None:
+            return
+        for backend, server, action in changes:
+            self.tracer.trace((backend, server), action,
+                              self.haproxy_control.haproxy_socket,
+                              sent, replied, verified,
+                              ok=(backend, server) not in failed,
+                              error=error)
+
+    def reconcile(self, desired, on_ready=None):
+        """Apply the differences between the desired states, a dict mapping
+        (backend, server) to the state, and the server states in haproxy in
+        one batch.
+        ``on_ready`` is called with the keys of the servers which were set
+        READY, e.g. for beginning the slow start.
+        """
+        with self.lock:
+            try:
+                with self.haproxy_control.deadline(self.event_timeout):
+                    self.sync_applied_states(force=True)
+                    changes = [key + (action,)
+                               for key, action in sorted(desired.items())
+                               if self.applied_states.get(key) != action]
+                    if changes:
+                        self.haproxy_control.set_server_statuses(changes)
+                        self.metrics.inc('commands_sent_total', len(changes))
+
+            except Exception, exc:
+                self.metrics.inc('failures_total')
+                self.applied_states_synced_at = None
+                self.log('ERROR: reconciliation failed: {!r}'.format(exc))
+                return False
+
+            self.applied_states.update(desired)
+            self.update_state_file(changes)
+            self.log('{date} Reconciled {num} programs with haproxy,'
+                     ' sent {changes}.'.format(
+                         date=datetime.now().isoformat(),
+                         num=len(desired),
+                         changes=', '.join(
+                             '{2} for {0}/{1}'.format(*change)
+                             for change in changes) or 'nothing'))
+            ready = [(backend, server) for backend, server, action in changes
+                     if action == STATUS_READY]
+
+        # Outside of the lock, since the slow start sets the weight on all
+        # targets.
+        if on_ready is not None and ready:
+            on_ready(ready)
+        return True
+
+    def sync_state_file(self):
+        """Replace the snapshot of the server state file with the states in
+        haproxy, e.g. in order to include changes made by others.
+        """
+        with self.lock:
+            try:
+                with self.haproxy_control.deadline(self.event_timeout):
+                    rows = self.haproxy_control.get_servers_state()
+                self.state_file.sync(rows)
+            except Exception, exc:
+                self.log('ERROR: updating the server state file failed:'
+                         ' {!r}'.format(exc))
+                return False
+            return True
+
+    def update_state_file(self, changes=(), weights=()):
+        """Apply the changes, a list of ``(backend, server, state)``, and the
+        weights, a list of ``((backend, server), percent)``, which were sent
+        to haproxy, to the server state file.
+        Failures are logged, the changes were applied to haproxy anyway.
+        """
+        if self.state_file is None or not (changes or weights):
+            return
+        if not self.state_file.loaded:
+            # The snapshot includes the changes.
+            self.sync_state_file()
+            return
+
+        try:
+            self.state_file.update(changes)
+            self.state_file.set_weight(weights)
+        except Exception, exc:
+            self.log('ERROR: updating the server state file failed:'
+                     ' {!r}'.format(exc))
+
+    def sync_applied_states(self, force=False):
+        """Replace the cached applied states with the states in haproxy,
+        when the cache is expired.
+        """
+        if not force and self.applied_states_synced_at is not None \
+           and time.time() - self.applied_states_synced_at \
+           < self.state_cache_ttl:
+            return
+
+        servers = self.servers
+        backends = set(backend for backend, server in servers)
+        states = self.haproxy_control.get_server_admin_states(
+            tuple(backends)[0] if len(backends) == 1 else None)
+        self.applied_states = {key: state for key, state in states.items()
+                               if key in servers}
+        self.applied_states_synced_at = time.time()
@@ -0,0 +1,263 @@
+"""Benchmarks for the communication with haproxy and the event handling.
+
+Compare the connection modes against a haproxy stats socket (e.g. the one
+started by tox):
+
+    $ python -m supervisor_haproxy.tests.benchmark connections \
+        tcp://127.0.0.1:9902 A/A1
+
+Replay synthetic supervisor events through the event listener into a fake
+haproxy and report the events per second and the latency from delivering an
+event until the change is applied in haproxy:
+
+    $ python -m supervisor_haproxy.tests.benchmark events \
+        --scenario crash-loop --programs 50 --latency 0.002 --background
+
+"""
+from StringIO import StringIO
+from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+import argparse
+import bisect
+import time
+
+
+BACKEND = 'plone'
+
+
+def benchmark_connection_modes(haproxy_socket, backend, server,
+                               iterations=1000):
+    """Compare connecting for each command with a persistent connection
+    and with pipelining all commands on one connection.
+    Returns a dict of the mode name mapped to the commands per second.
+    """
+    cmd = 'set server {}/{} state ready'.format(backend, server)
+    results = {}
+
+    control = HaProxyControl(haproxy_socket)
+    results['connect-per-command'] = measure(
+        lambda: [control.command(cmd) for _ in range(iterations)],
+        iterations)
+
+    control = HaProxyControl(haproxy_socket, persistent=True)
+    results['persistent'] = measure(
+        lambda: [control.command(cmd) for _ in range(iterations)],
+        iterations)
+
+    results['pipelined'] = measure(
+        lambda: control.commands([cmd] * iterations),
+        iterations)
+    control.close()
+    return results
+
+
+def measure(func, iterations):
+    start = time.time()
+    func()
+    return iterations / (time.time() - start)
+
+
+def rolling_restart(processnames):
+    """Restart the programs one after another.
+    """
+    for name in processnames:
+        yield 'PROCESS_STATE_STOPPING', name, 'RUNNING'
+        yield 'PROCESS_STATE_STOPPED', name, 'STOPPING'
+        yield 'PROCESS_STATE_STARTING', name, 'STOPPED'
+        yield 'PROCESS_STATE_RUNNING', name, 'STARTING'
+
+
+def mass_restart(processnames):
+    """Restart all programs at once, e.g. "supervisorctl restart all".
+    """
+    for eventname, from_state in (('PROCESS_STATE_STOPPING', 'RUNNING'),
+                                  ('PROCESS_STATE_STOPPED', 'STOPPING'),
+                                  ('PROCESS_STATE_STARTING', 'STOPPED'),
+                                  ('PROCESS_STATE_RUNNING', 'STARTING')):
+        for name in processnames:
+            yield eventname, name, from_state
+
+
+def crash_loop(processnames, cycles=5):
+    """All programs crash while starting until supervisor gives up.
+    """
+    for cycle in range(cycles):
+        for name in processnames:
+            yield ('PROCESS_STATE_STARTING', name,
+                   'BACKOFF' if cycle else 'STOPPED')
+            yield 'PROCESS_STATE_BACKOFF', name, 'STARTING'
+    for name in processnames:
+        yield 'PROCESS_STATE_FATAL', name, 'BACKOFF'
+
+
+SCENARIOS = {
+    'rolling-restart': rolling_restart,
+    'mass-restart': mass_restart,
+    'crash-loop': crash_loop,
+}
+
+
+def encode_event(serial, eventname, processname, from_state):
+    """Encode an event in the supervisor event listener protocol.
+    """
+    payload = 'processname:{0} groupname:{0} from_state:{1} pid:{2}'.format(
+        processname, from_state, 1000 + serial)
+    header = ('ver:3.0 server:supervisor serial:{0} pool:haproxy'
+              ' poolserial:{0} eventname:{1} len:{2}\n').format(
+                  serial, eventname, len(payload))
+    return header + payload
+
+
+class EndOfEvents(Exception):
+    """All events of the stream have been delivered.
+    """
+
+
+class EventStream(object):
+    """A stdin for the event listener, which delivers one event each time
+    the listener reads the next header and records when it was delivered.
+    """
+
+    def __init__(self, events):
+        self.events = [encode_event(serial, *event)
+                       for serial, event in enumerate(events, 1)]
+        self.delivered = []
+        self._payload = ''
+
+    def readline(self):
+        if len(self.delivered) == len(self.events):
+            raise EndOfEvents()
+
+        header, self._payload = self.events[len(self.delivered)].split('\n', 1)
+        self.delivered.append(time.time())
+        return header + '\n'
+
+    def read(self, size):
+        data, self._payload = self._payload[:size], self._payload[size:]
+        return data
+
+
+def benchmark_events(events, latency=0, **listener_options):
+    """Replay the events, given as (eventname, processname, from_state)
+    tuples, through the event listener into a fake haproxy.
+    The programs are mapped to servers with the same name in the backend
+    "plone".
+    """
+    events = list(events)
+    processnames = sorted(set(name for _, name, _ in events))
+    programs = [{'supervisor_program': name,
+                 'haproxy_backend': BACKEND,
+                 'haproxy_server': name} for name in processnames]
+
+    haproxy = FakeHaProxy({BACKEND: processnames}, latency=latency).start()
+    try:
+        listener = HaProxyEventListener(
+            programs, haproxy_socket=haproxy.socket, **listener_options)
+        stream = listener.stdin = EventStream(events)
+        listener.stdout = StringIO()
+        listener.stderr = StringIO()
+
+        start = time.time()
+        try:
+            listener.runforever()
+        except EndOfEvents:
+            pass
+        if listener.worker is not None:
+            listener.worker.join_queue()
+        duration = time.time() - start
+        listener.stop()
+    finally:
+        haproxy.stop()
+
+    latencies = event_latencies(events, stream.delivered, haproxy.commands)
+    return {'events': len(events),
+            'commands': len(haproxy.commands),
+            'applied': len(latencies),
+            'duration': duration,
+            'events_per_second': len(events) / duration,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'states': {name: server.status for name, server
+                       in haproxy.backends[BACKEND].items()}}
+
+
+def event_latencies(events, delivered, commands):
+    """The latency of an event is the time from delivering the event until
+    the next command for its server is executed by haproxy.
+    Events without a command afterwards are not applied.
+    """
+    timestamps = {}
+    for timestamp, cmd in commands:
+        if cmd.startswith('set server {}/'.format(BACKEND)):
+            server = cmd.split()[2].split('/', 1)[1]
+            timestamps.setdefault(server, []).append(timestamp)
+
+    latencies = []
+    for (eventname, processname, from_state), delivered_at in zip(
+            events, delivered):
+        applied = timestamps.get(processname, [])
+        index = bisect.bisect_left(applied, delivered_at)
+        if index < len(applied):
+            latencies.append(applied[index] - delivered_at)
+    return latencies
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the communication with haproxy.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    connections = subparsers.add_parser(
+        'connections', help='Compare the connection modes.')
+    connections.add_argument('haproxy_socket', metavar='SOCKET')
+    connections.add_argument('server', metavar='BACKEND/SERVER')
+    connections.add_argument('-n', '--iterations', type=int, default=1000)
+
+    events = subparsers.add_parser(
+        'events', help='Replay supervisor events into a fake haproxy.')
+    events.add_argument('--scenario', choices=sorted(SCENARIOS),
+                        default='rolling-restart')
+    events.add_argument('--programs', type=int, default=20)
+    events.add_argument('--latency', type=float, default=0,
+                        help='Latency of haproxy per command in seconds.')
+    events.add_argument('--persistent', action='store_true')
+    events.add_argument('--background', action='store_true')
+    events.add_argument('--coalesce-window', type=float, default=0)
+    events.add_argument('--state-cache-ttl', type=float)
+    args = parser.parse_args()
+
+    if args.benchmark == 'connections':
+        backend, server = args.server.split('/')
+        results = benchmark_connection_modes(
+            args.haproxy_socket, backend, server, args.iterations)
+        for mode, rate in sorted(results.items(), key=lambda item: item[1]):
+            print '{:<24} {:>10.0f} commands/s'.format(mode, rate)
+        return
+
+    processnames = ['instance{}'.format(num)
+                    for num in range(1, args.programs + 1)]
+    report = benchmark_events(
+        SCENARIOS[args.scenario](processnames),
+        latency=args.latency,
+        persistent=args.persistent,
+        background=args.background,
+        coalesce_window=args.coalesce_window,
+        state_cache_ttl=args.state_cache_ttl)
+    print ('{events} events, {commands} commands, {applied} events applied'
+           ' in {duration:.3f}s: {events_per_second:.0f} events/s,'
+           ' latency p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms').format(
+               p50_ms=(report['p50'] or 0) * 1000,
+               p99_ms=(report['p99'] or 0) * 1000,
+               **report)
+
+
+if __name__ == '__main__':
+    main()
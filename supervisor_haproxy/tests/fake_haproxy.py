@@ -0,0 +1,363 @@
+from collections import OrderedDict
+import os
+import socket
+import threading
+import time
+
+
+STAT_FIELDS = (
+    'pxname', 'svname', 'qcur', 'qmax', 'scur', 'smax', 'slim', 'stot', 'bin',
+    'bout', 'dreq', 'dresp', 'ereq', 'econ', 'eresp', 'wretr', 'wredis',
+    'status', 'weight', 'act', 'bck', 'chkfail', 'chkdown', 'lastchg',
+    'downtime', 'qlimit', 'pid', 'iid', 'sid', 'throttle', 'lbtot', 'tracked',
+    'type', 'rate', 'rate_lim', 'rate_max', 'check_status', 'check_code',
+    'check_duration', 'hrsp_1xx', 'hrsp_2xx', 'hrsp_3xx', 'hrsp_4xx',
+    'hrsp_5xx', 'hrsp_other', 'hanafail', 'req_rate', 'req_rate_max',
+    'req_tot', 'cli_abrt', 'srv_abrt', 'comp_in', 'comp_out', 'comp_byp',
+    'comp_rsp', 'lastsess', 'last_chk', 'last_agt', 'qtime', 'ctime', 'rtime',
+    'ttime')
+
+SERVERS_STATE_FIELDS = (
+    'be_id', 'be_name', 'srv_id', 'srv_name', 'srv_addr', 'srv_op_state',
+    'srv_admin_state', 'srv_uweight', 'srv_iweight',
+    'srv_time_since_last_change', 'srv_check_status', 'srv_check_result',
+    'srv_check_health', 'srv_check_state', 'srv_agent_state',
+    'bk_f_forced_id', 'srv_f_forced_id')
+
+ADMIN_FMAINT = 0x01
+ADMIN_FDRAIN = 0x08
+
+
+class FakeServer(object):
+
+    def __init__(self, sid, name, weight=1, scur=0, qcur=0, rtime=0, ttime=0):
+        self.sid = sid
+        self.name = name
+        self.admin_state = 0
+        self.weight = weight
+        self.initial_weight = weight
+        self.scur = scur
+        self.qcur = qcur
+        self.rtime = rtime
+        self.ttime = ttime
+        self.up = True
+        # Servers without health check are "no check" instead of "UP".
+        self.check = True
+
+    @property
+    def status(self):
+        if self.admin_state & ADMIN_FMAINT:
+            return 'MAINT'
+        elif self.admin_state & ADMIN_FDRAIN:
+            return 'DRAIN'
+        elif self.up:
+            return 'UP' if self.check else 'no check'
+        else:
+            return 'DOWN'
+
+
+class FakeHaProxy(object):
+    """An in-process stand-in for the HaProxy runtime API (stats socket).
+
+    It speaks enough of the protocol for testing and benchmarking the
+    HaProxyControl and the event listener: non-interactive and interactive
+    ("prompt") mode, ";"-separated commands, "show stat" with filters by id,
+    "show servers state", "show info", "set server" and "set weight".
+
+    Latency (seconds per command), stalls (connections are accepted but
+    not answered), refused connections and the "stats timeout" can be
+    simulated. The executed commands are recorded with a timestamp.
+
+        >>> haproxy = FakeHaProxy({'plone01': ['plone0101', 'plone0102']})
+        >>> haproxy.start()
+        >>> haproxy.socket
+        'tcp://127.0.0.1:38211'
+        >>> haproxy.latency = 0.01
+        >>> haproxy.refuse = True
+        >>> haproxy.stop()
+    """
+
+    def __init__(self, backends=None, address='tcp://127.0.0.1:0',
+                 latency=0, stats_timeout=None):
+        self.address = address
+        self.latency = latency
+        self.stats_timeout = stats_timeout
+        self.backends = OrderedDict()
+        self.commands = []
+        self.connections = 0
+        self._refuse = False
+        self._listener = None
+        self._running = False
+        self._lock = threading.RLock()
+        self._unstalled = threading.Event()
+        self._unstalled.set()
+        for backend, servers in (backends or {}).items():
+            self.add_backend(backend, servers)
+
+    def add_backend(self, name, servers):
+        with self._lock:
+            self.backends[name] = OrderedDict(
+                (server, FakeServer(sid, server))
+                for sid, server in enumerate(servers, 1))
+
+    def get_server(self, backend, server):
+        return self.backends[backend][server]
+
+    @property
+    def socket(self):
+        if self.address.startswith('unix://'):
+            return self.address
+        host, port = self._listener.getsockname()
+        return 'tcp://{}:{}'.format(host, port)
+
+    def start(self):
+        self._running = True
+        self._listen()
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._unstalled.set()
+        self._thread.join()
+        self._close_listener()
+        if self.address.startswith('unix://') \
+           and os.path.exists(self.address[len('unix://'):]):
+            os.unlink(self.address[len('unix://'):])
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def refuse(self):
+        return self._refuse
+
+    @refuse.setter
+    def refuse(self, value):
+        with self._lock:
+            if value and self._listener is not None:
+                self.address = self.socket
+                self._close_listener()
+            elif not value and self._listener is None:
+                self._listen()
+            self._refuse = value
+
+    @property
+    def stall(self):
+        return not self._unstalled.is_set()
+
+    @stall.setter
+    def stall(self, value):
+        if value:
+            self._unstalled.clear()
+        else:
+            self._unstalled.set()
+
+    def popcommands(self):
+        with self._lock:
+            commands = [cmd for timestamp, cmd in self.commands]
+            self.commands[:] = []
+        return commands
+
+    def _listen(self):
+        if self.address.startswith('unix://'):
+            path = self.address[len('unix://'):]
+            if os.path.exists(path):
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+        else:
+            host, port = self.address[len('tcp://'):].split(':')
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, int(port)))
+        listener.listen(128)
+        listener.settimeout(0.05)
+        self._listener = listener
+
+    def _close_listener(self):
+        if self._listener is not None:
+            # Shutting down stops listening immediately, even while the
+            # accept loop still holds a reference to the socket.
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._listener.close()
+            self._listener = None
+
+    def _accept_loop(self):
+        while self._running:
+            listener = self._listener
+            if listener is None:
+                time.sleep(0.01)
+                continue
+            try:
+                conn, _ = listener.accept()
+            except (socket.timeout, socket.error):
+                continue
+            conn.settimeout(None)
+            with self._lock:
+                self.connections += 1
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        try:
+            self._unstalled.wait()
+            if not self._running:
+                return
+            conn.settimeout(self.stats_timeout)
+            interactive = False
+            buf = ''
+            while self._running:
+                while '\n' not in buf:
+                    try:
+                        chunk = conn.recv(4096)
+                    except socket.timeout:
+                        return
+                    if not chunk:
+                        return
+                    buf += chunk
+                line, buf = buf.split('\n', 1)
+                line = line.strip()
+                if not line:
+                    if not interactive:
+                        return
+                    conn.sendall('\n> ')
+                    continue
+
+                for cmd in line.split(';'):
+                    cmd = cmd.strip()
+                    if cmd == 'quit':
+                        return
+                    if cmd == 'prompt':
+                        interactive = not interactive
+                        output = ''
+                    else:
+                        output = self.execute(cmd)
+                    conn.sendall(output)
+                    self._unstalled.wait()
+                    conn.sendall('\n> ' if interactive else '\n')
+
+                if not interactive:
+                    return
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def execute(self, cmd):
+        if self.latency:
+            time.sleep(self.latency)
+
+        args = cmd.split()
+        with self._lock:
+            self.commands.append((time.time(), cmd))
+            if args[:2] == ['show', 'stat']:
+                return self._show_stat(*args[2:5])
+            elif args[:3] == ['show', 'servers', 'state']:
+                return self._show_servers_state(*args[3:4])
+            elif args[:2] == ['show', 'info']:
+                return 'Name: HAProxy\nVersion: 1.6.fake\nPid: {}\n'.format(
+                    os.getpid())
+            elif args[:2] == ['set', 'server'] and len(args) == 5 \
+                 and args[3] == 'state':
+                return self._set_server_state(args[2], args[4])
+            elif args[:2] == ['set', 'weight'] and len(args) == 4:
+                return self._set_weight(args[2], args[3])
+            else:
+                return 'Unknown command.\n'
+
+    def _lookup(self, name):
+        if '/' not in name:
+            return None, "Require 'backend/server'.\n"
+        backend, server = name.split('/', 1)
+        if backend not in self.backends:
+            return None, 'No such backend.\n'
+        if server not in self.backends[backend]:
+            return None, 'No such server.\n'
+        return self.backends[backend][server], None
+
+    def _set_server_state(self, name, state):
+        server, error = self._lookup(name)
+        if error:
+            return error
+        if state == 'ready':
+            server.admin_state = 0
+        elif state == 'drain':
+            server.admin_state = ADMIN_FDRAIN
+        elif state == 'maint':
+            server.admin_state = ADMIN_FMAINT
+        else:
+            return ("'set server <srv> state' expects 'ready', 'drain'"
+                    " and 'maint'.\n")
+        return ''
+
+    def _set_weight(self, name, weight):
+        server, error = self._lookup(name)
+        if error:
+            return error
+        if weight.endswith('%'):
+            value = server.initial_weight * int(weight[:-1]) // 100
+        else:
+            value = int(weight)
+        if not 0 <= value <= 256:
+            return 'Absolute weight can only be between 0 and 256 inclusive.\n'
+        server.weight = value
+        return ''
+
+    def _show_stat(self, iid='-1', type_='-1', sid='-1'):
+        # Like haproxy 1.6, proxy names are not supported, they are parsed
+        # as id 0, which matches nothing.
+        iid = int(iid) if iid.lstrip('-').isdigit() else 0
+        type_, sid = int(type_), int(sid)
+        lines = ['# ' + ','.join(STAT_FIELDS) + ',']
+        for be_id, (backend, servers) in enumerate(self.backends.items(), 1):
+            if iid not in (-1, be_id):
+                continue
+            rows = []
+            if type_ & 1:
+                rows.append({'svname': 'FRONTEND', 'status': 'OPEN',
+                             'type': '0', 'sid': '0'})
+            if type_ & 4:
+                for server in servers.values():
+                    if sid not in (-1, server.sid):
+                        continue
+                    rows.append({'svname': server.name,
+                                 'status': server.status,
+                                 'weight': str(server.weight),
+                                 'qcur': str(server.qcur),
+                                 'scur': str(server.scur),
+                                 'rtime': str(server.rtime),
+                                 'ttime': str(server.ttime),
+                                 'type': '2',
+                                 'sid': str(server.sid)})
+            if type_ & 2:
+                rows.append({'svname': 'BACKEND', 'status': 'UP',
+                             'type': '1', 'sid': '0',
+                             'weight': str(sum(server.weight for server
+                                               in servers.values()))})
+            for row in rows:
+                row.update(pxname=backend, iid=str(be_id), pid='1')
+                lines.append(','.join(row.get(field, '')
+                                      for field in STAT_FIELDS) + ',')
+        return '\n'.join(lines) + '\n'
+
+    def _show_servers_state(self, backend=None):
+        lines = ['1', '# ' + ' '.join(SERVERS_STATE_FIELDS)]
+        for be_id, (name, servers) in enumerate(self.backends.items(), 1):
+            if backend is not None and backend != name:
+                continue
+            for server in servers.values():
+                lines.append(' '.join(map(str, (
+                    be_id, name, server.sid, server.name, '127.0.0.1',
+                    2 if server.up else 0, server.admin_state, server.weight,
+                    server.initial_weight, 0, 6, 3, 4, 6, 0, 0, 0))))
+        return '\n'.join(lines) + '\n'
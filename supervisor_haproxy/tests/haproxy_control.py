@@ -1,34 +1,95 @@
 from supervisor_haproxy.exceptions import HaProxyConnectionRefused
+from supervisor_haproxy.exceptions import HaProxyReceiveTimeout
 from supervisor_haproxy.haproxy_control import STATUS_DRAIN
 from supervisor_haproxy.haproxy_control import STATUS_MAINT
 from supervisor_haproxy.haproxy_control import STATUS_READY
+from contextlib import contextmanager
 import errno
 import socket
+import threading
 
 
 class HaProxyControlMock(object):
 
-    def __init__(self):
+    def __init__(self, haproxy_socket='tcp://127.0.0.1:9902'):
+        self.haproxy_socket = haproxy_socket
         self.calls = []
         self.refuse_connection = False
+        self.time_out = False
+        self.admin_states = {}
+        # The statuses in "show stat", by (backend, server_name).
+        self.statuses = {}
+        self.deadlines = []
+        # Clear in order to make calls block until it is set again.
+        self.responding = threading.Event()
+        self.responding.set()
+
+    def close(self):
+        pass
 
     def popcalls(self):
         calls = self.calls[:]
         self.calls[:] = []
         return calls
 
+    @contextmanager
+    def deadline(self, seconds):
+        self.deadlines.append(seconds)
+        yield
+
+    def ping(self):
+        if self.refuse_connection:
+            raise HaProxyConnectionRefused(
+                socket.error(errno.ECONNREFUSED, 'Connection refused'))
+
+        self.calls.append(('ping',))
+
     def get_server_status(self, backend, server_name):
         raise NotImplementedError()
 
+    def get_server_statuses(self, servers):
+        self.calls.append(('get_server_statuses', list(servers)))
+        return {key: self.statuses.get(key) for key in servers}
+
+    def get_server_admin_states(self, backend=None):
+        if self.refuse_connection:
+            raise HaProxyConnectionRefused(
+                socket.error(errno.ECONNREFUSED, 'Connection refused'))
+
+        self.calls.append(('get_server_admin_states', backend))
+        return dict(self.admin_states)
+
     def set_server_status(self, backend, server_name, state):
+        self.responding.wait()
         if self.refuse_connection:
             raise HaProxyConnectionRefused(
                 socket.error(errno.ECONNREFUSED, 'Connection refused'))
+        if self.time_out:
+            raise HaProxyReceiveTimeout('timed out')
 
         valid_states = (STATUS_READY, STATUS_DRAIN, STATUS_MAINT)
         if state not in valid_states:
             raise ValueError('State must be one of {!r}, got {!r}'.format(
                 valid_states, state))
 
+        self.admin_states[backend, server_name] = state
         return self.calls.append(
             ('set_server_status', backend, server_name, state))
+
+    def set_server_weight(self, backend, server_name, weight):
+        if self.refuse_connection:
+            raise HaProxyConnectionRefused(
+                socket.error(errno.ECONNREFUSED, 'Connection refused'))
+
+        self.calls.append(('set_server_weight', backend, server_name, weight))
+        return '\n'
+
+    def set_server_statuses(self, changes):
+        if self.refuse_connection:
+            raise HaProxyConnectionRefused(
+                socket.error(errno.ECONNREFUSED, 'Connection refused'))
+
+        for backend, server_name, state in changes:
+            self.admin_states[backend, server_name] = state
+        self.calls.append(('set_server_statuses', list(changes)))
+        return ['\n'] * len(changes)
@@ -0,0 +1,112 @@
+from StringIO import StringIO
+from supervisor_haproxy.agent import AgentServer
+from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.tests.haproxy_control import HaProxyControlMock
+from unittest2 import TestCase
+import socket
+
+
+INSTANCE1 = {'supervisor_program': 'instance1',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0401'}
+
+
+def agent_check(address, send='plone04/plone0401\n'):
+    """Connect like haproxy's agent check and return the reply.
+    """
+    sock = socket.create_connection(address, timeout=5)
+    try:
+        sock.sendall(send)
+        reply = ''
+        while True:
+            chunk = sock.recv(1024)
+            if not chunk:
+                return reply
+            reply += chunk
+    finally:
+        sock.close()
+
+
+class TestAgentServer(TestCase):
+
+    def setUp(self):
+        self.agent = AgentServer(('127.0.0.1', 0), read_timeout=0.1).start()
+        self.address = self.agent.server_address
+
+    def tearDown(self):
+        self.agent.stop()
+
+    def test_replies_with_state(self):
+        self.agent.set_state(('plone04', 'plone0401'), 'READY')
+        self.assertEqual('ready\n', agent_check(self.address))
+        self.agent.set_state(('plone04', 'plone0401'), 'DRAIN')
+        self.assertEqual('drain\n', agent_check(self.address))
+        self.agent.set_state(('plone04', 'plone0401'), 'MAINT')
+        self.assertEqual('maint\n', agent_check(self.address))
+
+    def test_replies_with_weight_when_ready(self):
+        self.agent.set_state(('plone04', 'plone0401'), 'READY')
+        self.agent.set_weight(('plone04', 'plone0401'), 30)
+        self.assertEqual('ready 30%\n', agent_check(self.address))
+
+    def test_weight_is_reset_when_not_ready(self):
+        self.agent.set_weight(('plone04', 'plone0401'), 30)
+        self.agent.set_state(('plone04', 'plone0401'), 'MAINT')
+        self.agent.set_state(('plone04', 'plone0401'), 'READY')
+        self.assertEqual('ready\n', agent_check(self.address))
+
+    def test_unknown_server_gets_empty_reply(self):
+        self.agent.set_state(('plone04', 'plone0401'), 'READY')
+        self.assertEqual('', agent_check(self.address, 'plone04/plone0402\n'))
+        self.assertEqual('', agent_check(self.address, ''))
+
+    def test_agent_send_without_newline(self):
+        self.agent.set_state(('plone04', 'plone0401'), 'DRAIN')
+        self.assertEqual('drain\n',
+                         agent_check(self.address, 'plone04/plone0401'))
+
+
+class TestEventListenerAgent(TestCase):
+
+    def setUp(self):
+        self.listener = None
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def send(self, eventname, **kwargs):
+        if self.listener is None:
+            self.listener = HaProxyEventListener(
+                [INSTANCE1], agent_host='127.0.0.1', agent_port=0, **kwargs)
+        body = 'processname:instance1 groupname:bar pid:1'
+        self.listener.stdin = StringIO('eventname:{} len:{}\n{}'.format(
+            eventname, len(body), body))
+        self.listener.stdout = StringIO()
+        self.listener.stderr = StringIO()
+        self.listener.runforever(test=True)
+        return self.listener.stdout.getvalue()
+
+    def test_agent_without_stats_socket(self):
+        self.assertEqual('READY\nRESULT 2\nOK',
+                         self.send('PROCESS_STATE_RUNNING'))
+        self.assertIsNone(self.listener.haproxy_control)
+        self.assertEqual('ready\n',
+                         agent_check(self.listener.agent.server_address))
+        self.send('PROCESS_STATE_STOPPING')
+        self.assertEqual('drain\n',
+                         agent_check(self.listener.agent.server_address))
+
+    def test_agent_and_stats_socket(self):
+        haproxy_control = HaProxyControlMock()
+        self.send('PROCESS_STATE_STOPPED', haproxy_control=haproxy_control)
+        self.assertEqual('maint\n',
+                         agent_check(self.listener.agent.server_address))
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'MAINT')],
+            haproxy_control.popcalls())
+
+    def test_stats_socket_or_agent_is_required(self):
+        self.listener = HaProxyEventListener(
+            [INSTANCE1], agent_host='127.0.0.1', agent_port=0)
+        with self.assertRaises(ValueError):
+            HaProxyEventListener([INSTANCE1])
@@ -0,0 +1,95 @@
+from supervisor_haproxy.exceptions import HaProxyConnectionRefused
+from supervisor_haproxy.exceptions import HaProxyReceiveTimeout
+from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.tests.benchmark import benchmark_events
+from supervisor_haproxy.tests.benchmark import crash_loop
+from supervisor_haproxy.tests.benchmark import mass_restart
+from supervisor_haproxy.tests.benchmark import rolling_restart
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+import unittest
+
+
+PROGRAMS = ['instance{}'.format(num) for num in range(1, 11)]
+
+# A loose upper bound for the p99 event-to-applied latency (seconds), which
+# only catches severe regressions in the hot path, not slow test machines.
+MAX_P99 = 0.5
+
+
+class TestFakeHaProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy({'A': ['A1']}).start()
+        self.control = HaProxyControl(self.haproxy.socket, timeout=1)
+
+    def tearDown(self):
+        self.haproxy.stop()
+
+    def test_set_server_state(self):
+        self.assertEqual('UP', self.control.get_server_status('A', 'A1'))
+        self.control.set_server_status('A', 'A1', 'MAINT')
+        self.assertEqual('MAINT', self.control.get_server_status('A', 'A1'))
+        self.assertEqual('MAINT', self.haproxy.get_server('A', 'A1').status)
+
+    def test_records_commands(self):
+        self.control.set_server_status('A', 'A1', 'DRAIN')
+        self.assertEqual(['set server A/A1 state drain'],
+                         self.haproxy.popcommands())
+        self.assertEqual([], self.haproxy.popcommands())
+
+    def test_refuse_connections(self):
+        self.haproxy.refuse = True
+        with self.assertRaises(HaProxyConnectionRefused):
+            self.control.ping()
+        self.haproxy.refuse = False
+        self.control.ping()
+
+    def test_stall(self):
+        self.haproxy.stall = True
+        control = HaProxyControl(self.haproxy.socket, timeout=0.1)
+        with self.assertRaises(HaProxyReceiveTimeout):
+            control.ping()
+
+
+class TestEventBenchmark(unittest.TestCase):
+    """Replays synthetic supervisor events through the event listener into a
+    fake haproxy, so that regressions in the hot path are caught.
+    """
+
+    def test_rolling_restart(self):
+        report = benchmark_events(rolling_restart(PROGRAMS))
+        self.assertEqual(40, report['events'])
+        self.assertEqual(40, report['commands'])
+        self.assertEqual(40, report['applied'])
+        self.assertLess(report['p99'], MAX_P99)
+        self.assertEqual({name: 'UP' for name in PROGRAMS}, report['states'])
+
+    def test_mass_restart_in_background(self):
+        report = benchmark_events(mass_restart(PROGRAMS),
+                                  persistent=True, background=True)
+        self.assertEqual(40, report['applied'])
+        self.assertLess(report['p99'], MAX_P99)
+        self.assertEqual({name: 'UP' for name in PROGRAMS}, report['states'])
+
+    def test_crash_loop(self):
+        report = benchmark_events(crash_loop(PROGRAMS), persistent=True)
+        self.assertEqual(110, report['events'])
+        self.assertEqual(110, report['applied'])
+        self.assertLess(report['p99'], MAX_P99)
+        self.assertEqual({name: 'MAINT' for name in PROGRAMS},
+                         report['states'])
+
+    def test_coalescing_reduces_commands_of_crash_loop(self):
+        report = benchmark_events(crash_loop(PROGRAMS), persistent=True,
+                                  background=True, coalesce_window=0.2)
+        self.assertLess(report['commands'], report['events'] / 2)
+        self.assertLess(report['p99'], MAX_P99 + 0.2)
+        self.assertEqual({name: 'MAINT' for name in PROGRAMS},
+                         report['states'])
+
+    def test_state_cache_skips_repeated_changes_of_crash_loop(self):
+        report = benchmark_events(crash_loop(PROGRAMS), persistent=True,
+                                  state_cache_ttl=60)
+        self.assertLess(report['commands'], report['events'] / 2)
+        self.assertEqual({name: 'MAINT' for name in PROGRAMS},
+                         report['states'])
@@ -0,0 +1,62 @@
+from datetime import timedelta
+from freezegun import freeze_time
+from supervisor_haproxy.circuit_breaker import CircuitBreaker
+from unittest2 import TestCase
+
+
+class TestCircuitBreaker(TestCase):
+
+    @freeze_time('2016-01-01 01:00:00')
+    def test_opens_after_threshold_is_exceeded(self):
+        breaker = CircuitBreaker(threshold=2, jitter=0)
+        self.assertFalse(breaker.failure())
+        self.assertFalse(breaker.failure())
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.failure())
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(1, breaker.retry_in)
+
+    def test_delay_grows_exponentially_up_to_max_delay(self):
+        breaker = CircuitBreaker(threshold=0, min_delay=1, max_delay=10,
+                                 jitter=0)
+        delays = []
+        with freeze_time('2016-01-01 01:00:00') as frozen:
+            for _ in range(6):
+                breaker.failure()
+                delays.append(breaker.retry_in)
+                frozen.tick(delta=timedelta(seconds=breaker.retry_in))
+                self.assertTrue(breaker.allow_request())
+                self.assertTrue(breaker.half_open)
+
+        self.assertEqual([1, 2, 4, 8, 10, 10], delays)
+
+    @freeze_time('2016-01-01 01:00:00')
+    def test_jitter_shortens_delay(self):
+        breaker = CircuitBreaker(threshold=0, min_delay=10, jitter=0.5)
+        breaker.failure()
+        self.assertGreater(breaker.retry_in, 5)
+        self.assertLessEqual(breaker.retry_in, 10)
+
+    def test_success_closes_circuit(self):
+        breaker = CircuitBreaker(threshold=0, jitter=0)
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(0, breaker.failures)
+        self.assertEqual(0, breaker.retries)
+
+    def test_queue_keeps_latest_change_per_key(self):
+        breaker = CircuitBreaker(queue_size=2)
+        breaker.enqueue('a', 1)
+        breaker.enqueue('b', 2)
+        breaker.enqueue('a', 3)
+        self.assertEqual([('b', 2), ('a', 3)], breaker.drain())
+        self.assertEqual([], breaker.drain())
+
+    def test_queue_drops_oldest_change_when_full(self):
+        breaker = CircuitBreaker(queue_size=2)
+        breaker.enqueue('a', 1)
+        breaker.enqueue('b', 2)
+        breaker.enqueue('c', 3)
+        self.assertEqual([('b', 2), ('c', 3)], breaker.drain())
@@ -1,9 +1,22 @@
 from supervisor_haproxy.exceptions import HaProxyConnectionRefused
+from supervisor_haproxy.exceptions import HaProxyDeadlineExceeded
+from supervisor_haproxy.exceptions import HaProxyReceiveTimeout
+from supervisor_haproxy.haproxy_control import batch_lines
 from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.haproxy_control import MultiHaProxyControl
 from supervisor_haproxy.haproxy_control import STATUS_DRAIN
 from supervisor_haproxy.haproxy_control import STATUS_MAINT
 from supervisor_haproxy.haproxy_control import STATUS_READY
+from supervisor_haproxy.haproxy_control import split_replies
 from supervisor_haproxy.haproxy_control import STATUS_UP
+from supervisor_haproxy.haproxy_control import TYPE_SERVER
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -40,6 +53,83 @@ class TestHaProxyControl(unittest.TestCase):
         self.control.set_server_status('A', 'A1', STATUS_READY)
         self.assertEqual(STATUS_UP, self.control.get_server_status('A', 'A1'))
 
+    def test_reply_is_read_completely(self):
+        reply = self.control.command('show stat')
+        self.assertTrue(reply.startswith('# pxname,svname,'), reply)
+        self.assertTrue(reply.endswith('\n\n'), reply)
+        self.assertEqual(reply, ''.join(self.control.iter_command('show stat')))
+
+    def test_stat_rows(self):
+        rows = self.control.get_stat()
+        self.assertEqual(rows, list(self.control.iter_stat()))
+        self.assertIn(('A', 'A1'), [(row['pxname'], row['svname'])
+                                    for row in rows])
+
+    def test_stat_is_filtered_by_haproxy(self):
+        self.assertEqual(
+            [('A', 'A1')],
+            [(row['pxname'], row['svname'])
+             for row in self.control.iter_stat(-1, TYPE_SERVER)])
+
+    def test_stat_index_of_proxy_name(self):
+        index = self.control.get_stat_index(proxy='A')
+        self.assertEqual([('A', 'A1')], index.keys())
+        self.assertEqual({}, self.control.get_stat_index(proxy='B'))
+
+    def test_stat_index(self):
+        index = self.control.get_stat_index()
+        self.assertEqual('UP', index['A', 'A1'].status)
+        self.assertEqual('A1', index['A', 'A1'].svname)
+        self.assertIsInstance(index['A', 'A1'].weight, int)
+        self.assertNotIn(('A', 'BACKEND'), index)
+
+    def test_get_server_statuses(self):
+        self.control.set_server_status('A', 'A1', STATUS_DRAIN)
+        self.assertEqual(
+            {('A', 'A1'): STATUS_DRAIN, ('A', 'A2'): None},
+            self.control.get_server_statuses([('A', 'A1'), ('A', 'A2')]))
+
+    def test_snapshot_is_reused_within_ttl(self):
+        fetches = []
+        iter_stat = self.control.iter_stat
+        self.control.iter_stat = lambda *args: fetches.append(args) \
+            or iter_stat(*args)
+        self.control.stat_ttl = 60
+
+        self.control.get_server_status('A', 'A1')
+        self.control.get_server_statuses([('A', 'A1'), ('A', 'A2')])
+        self.assertEqual(1, len(fetches))
+
+        # Changing a status invalidates the snapshot.
+        self.control.set_server_status('A', 'A1', STATUS_DRAIN)
+        self.assertEqual(STATUS_DRAIN, self.control.get_server_status('A', 'A1'))
+        self.assertEqual(2, len(fetches))
+
+    def test_get_server_admin_states(self):
+        self.assertEqual(STATUS_READY,
+                         self.control.get_server_admin_states()['A', 'A1'])
+        self.control.set_server_status('A', 'A1', STATUS_DRAIN)
+        self.assertEqual({('A', 'A1'): STATUS_DRAIN},
+                         self.control.get_server_admin_states('A'))
+        self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertEqual({('A', 'A1'): STATUS_MAINT},
+                         self.control.get_server_admin_states('A'))
+
+    def test_set_server_statuses(self):
+        self.assertEqual(['\n', '\n'], self.control.set_server_statuses(
+            [('A', 'A1', STATUS_MAINT), ('A', 'A1', STATUS_DRAIN)]))
+        self.assertEqual(STATUS_DRAIN, self.control.get_server_status('A', 'A1'))
+
+    def test_set_servers_in_one_batch(self):
+        self.assertEqual(
+            ['\n', '\n', 'No such server.\n\n', '\n'],
+            self.control.set_servers(
+                states=[('A', 'A1', STATUS_MAINT),
+                        ('A', 'A1', STATUS_DRAIN),
+                        ('A', 'A9', STATUS_MAINT)],
+                weights=[('A', 'A1', '100%')]))
+        self.assertEqual(STATUS_DRAIN, self.control.get_server_status('A', 'A1'))
+
     def test_connection_error_is_wrapped(self):
         # no haproxy running at port 9903
         control = HaProxyControl('tcp://127.0.0.1:9903')
@@ -50,5 +140,253 @@ class TestHaProxyControl(unittest.TestCase):
                           cm.exception.args[1])
 
 
+class TestPersistentHaProxyControl(TestHaProxyControl):
+    """Runs the same tests with a persistent connection in interactive mode.
+    """
+
+    def setUp(self):
+        self.control = HaProxyControl('tcp://127.0.0.1:9902', persistent=True)
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+        self.control.close()
+
+    def test_connection_is_reused(self):
+        self.control.get_server_status('A', 'A1')
+        sock = self.control._sock
+        self.assertIsNotNone(sock)
+        self.control.set_server_status('A', 'A1', STATUS_DRAIN)
+        self.assertIs(sock, self.control._sock)
+
+    def test_pipelined_commands(self):
+        self.assertEqual(
+            ['\n', '\n'],
+            self.control.commands(['set server A/A1 state maint',
+                                   'set server A/A1 state drain']))
+        self.assertEqual(STATUS_DRAIN, self.control.get_server_status('A', 'A1'))
+
+    def test_partially_consumed_reply_does_not_break_connection(self):
+        rows = self.control.iter_stat()
+        next(rows)
+        rows.close()
+        self.assertEqual(STATUS_UP, self.control.get_server_status('A', 'A1'))
+
+    def test_reconnects_when_connection_was_closed(self):
+        self.control.get_server_status('A', 'A1')
+        # Simulate haproxy closing the connection, e.g. on "stats timeout".
+        self.control._sock.shutdown(socket.SHUT_RDWR)
+        self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertEqual(STATUS_MAINT, self.control.get_server_status('A', 'A1'))
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy({'A': ['A{}'.format(num)
+                                          for num in range(1, 21)]}).start()
+
+    def tearDown(self):
+        self.haproxy.stop()
+
+    def test_batch_is_one_round_trip(self):
+        control = HaProxyControl(self.haproxy.socket)
+        control.set_server_statuses([('A', 'A{}'.format(num), STATUS_DRAIN)
+                                     for num in range(1, 21)])
+        self.assertEqual(1, self.haproxy.connections)
+        self.assertEqual(20, len(self.haproxy.popcommands()))
+        self.assertEqual(
+            [STATUS_DRAIN] * 20,
+            [status for key, status in sorted(control.get_server_statuses(
+                [('A', 'A{}'.format(num)) for num in range(1, 21)]).items())])
+
+    def test_long_batches_are_split_into_lines(self):
+        control = HaProxyControl(self.haproxy.socket)
+        cmds = ['set weight A/A{} 1'.format(num) for num in range(1, 21)]
+        self.assertEqual(['\n'] * 600, control.batch(cmds * 30))
+        self.assertEqual(600, len(self.haproxy.popcommands()))
+        # The lines are pipelined on one interactive connection.
+        self.assertEqual(1, self.haproxy.connections)
+
+    def test_batch_lines(self):
+        self.assertEqual(['a;bb', 'ccc', 'dddd'],
+                         batch_lines(['a', 'bb', 'ccc', 'dddd'], max_length=4))
+        with self.assertRaises(ValueError):
+            batch_lines(['show info;show stat'])
+
+    def test_split_replies(self):
+        self.assertEqual(['\n', 'No such server.\n\n', '\n'],
+                         split_replies('\nNo such server.\n\n\n', 3))
+        with self.assertRaises(socket.error):
+            split_replies('\n', 2)
+
+
+class TestUnixSocketHaProxyControl(TestHaProxyControl):
+    """Runs the same tests through a UNIX socket of the fake haproxy.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.haproxy = FakeHaProxy(
+            {'A': ['A1']},
+            address='unix://' + os.path.join(self.tempdir, 'admin.sock'))
+        self.haproxy.start()
+        self.control = HaProxyControl(self.haproxy.socket)
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+        self.haproxy.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_missing_socket_is_refused(self):
+        control = HaProxyControl(
+            'unix://' + os.path.join(self.tempdir, 'missing.sock'))
+        with self.assertRaises(HaProxyConnectionRefused):
+            control.ping()
+
+
+class TestMultiHaProxyControl(unittest.TestCase):
+    """Multiple haproxy processes, each with its own stats socket.
+    """
+
+    def setUp(self):
+        self.haproxies = [FakeHaProxy({'A': ['A1']}).start(),
+                          FakeHaProxy({'A': ['A1']}).start()]
+        self.control = MultiHaProxyControl(
+            [haproxy.socket for haproxy in self.haproxies], persistent=True)
+
+    def tearDown(self):
+        self.control.close()
+        for haproxy in self.haproxies:
+            haproxy.stop()
+
+    def statuses(self):
+        return [haproxy.get_server('A', 'A1').status
+                for haproxy in self.haproxies]
+
+    def test_changes_are_sent_to_all_sockets(self):
+        self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertEqual(['MAINT', 'MAINT'], self.statuses())
+        self.control.set_server_statuses([('A', 'A1', STATUS_DRAIN)])
+        self.assertEqual(['DRAIN', 'DRAIN'], self.statuses())
+
+    def test_failing_socket_does_not_affect_others(self):
+        self.haproxies[0].refuse = True
+        with self.assertRaises(HaProxyConnectionRefused):
+            self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertEqual(['UP', 'MAINT'], self.statuses())
+
+    def test_sockets_are_used_in_parallel(self):
+        for haproxy in self.haproxies:
+            haproxy.latency = 0.2
+        start = time.time()
+        self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_deadline_applies_to_all_sockets(self):
+        self.haproxies[1].stall = True
+        with self.assertRaises(HaProxyReceiveTimeout):
+            with self.control.deadline(0.1):
+                self.control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertEqual(['MAINT', 'UP'], self.statuses())
+        self.haproxies[1].stall = False
+
+    def test_reads_fall_back_to_next_socket(self):
+        self.haproxies[1].get_server('A', 'A1').admin_state = 0x01
+        self.haproxies[0].refuse = True
+        self.assertEqual(STATUS_MAINT,
+                         self.control.get_server_status('A', 'A1'))
+        self.assertEqual({('A', 'A1'): STATUS_MAINT},
+                         self.control.get_server_admin_states())
+
+
+class TestHaProxyControlTimeouts(unittest.TestCase):
+    """A socket which accepts connections but never replies simulates a
+    stalling haproxy.
+    """
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.haproxy_socket = 'tcp://127.0.0.1:{}'.format(
+            self.server.getsockname()[1])
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_receive_timeout(self):
+        control = HaProxyControl(self.haproxy_socket, timeout=0.1)
+        with self.assertRaises(HaProxyReceiveTimeout):
+            control.set_server_status('A', 'A1', STATUS_MAINT)
+
+    def test_receive_timeout_in_persistent_mode(self):
+        control = HaProxyControl(self.haproxy_socket, persistent=True,
+                                 timeout=0.1)
+        with self.assertRaises(HaProxyReceiveTimeout):
+            control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertIsNone(control._sock)
+
+    def test_deadline_limits_total_time(self):
+        control = HaProxyControl(self.haproxy_socket, timeout=10)
+        start = time.time()
+        with self.assertRaises(HaProxyReceiveTimeout):
+            with control.deadline(0.2):
+                control.set_server_status('A', 'A1', STATUS_MAINT)
+        self.assertLess(time.time() - start, 1)
+
+    def test_deadline_exceeded(self):
+        control = HaProxyControl(self.haproxy_socket)
+        with self.assertRaises(HaProxyDeadlineExceeded):
+            with control.deadline(0):
+                control.set_server_status('A', 'A1', STATUS_MAINT)
+
+
 if __name__ == '__main__':
     unittest.main()
+
+
+class TestWaitUntilDrained(unittest.TestCase):
+
+    def setUp(self):
+        self.haproxies = [FakeHaProxy({'A': ['A1']}).start(),
+                          FakeHaProxy({'A': ['A1']}).start()]
+        self.control = HaProxyControl(self.haproxies[0].socket)
+
+    def tearDown(self):
+        for haproxy in self.haproxies:
+            haproxy.stop()
+
+    def test_drained_server(self):
+        self.assertEqual(0, self.control.get_server_sessions('A', 'A1'))
+        self.assertTrue(self.control.wait_until_drained('A', 'A1', timeout=0))
+
+    def test_timeout(self):
+        self.haproxies[0].get_server('A', 'A1').scur = 2
+        self.haproxies[0].get_server('A', 'A1').qcur = 1
+        self.assertEqual(3, self.control.get_server_sessions('A', 'A1'))
+        start = time.time()
+        self.assertFalse(self.control.wait_until_drained(
+            'A', 'A1', timeout=0.2, interval=0.05))
+        self.assertLess(time.time() - start, 1)
+
+    def test_waits_until_sessions_are_finished(self):
+        fake_server = self.haproxies[0].get_server('A', 'A1')
+        fake_server.scur = 1
+        timer = threading.Timer(0.2, setattr, (fake_server, 'scur', 0))
+        timer.start()
+        self.assertTrue(self.control.wait_until_drained(
+            'A', 'A1', timeout=5, interval=0.05))
+        timer.join()
+
+    def test_unknown_server(self):
+        with self.assertRaises(KeyError):
+            self.control.get_server_sessions('A', 'A2')
+
+    def test_sessions_of_all_processes(self):
+        control = MultiHaProxyControl(
+            [haproxy.socket for haproxy in self.haproxies])
+        self.haproxies[1].get_server('A', 'A1').scur = 2
+        self.assertEqual(2, control.get_server_sessions('A', 'A1'))
+        self.assertFalse(control.wait_until_drained('A', 'A1', timeout=0))
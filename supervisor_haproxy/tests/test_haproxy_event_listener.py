@@ -1,8 +1,15 @@
 from freezegun import freeze_time
 from StringIO import StringIO
 from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
 from supervisor_haproxy.tests.haproxy_control import HaProxyControlMock
 from unittest2 import TestCase
+import errno
+import os
+import shutil
+import signal
+import socket
+import tempfile
 
 
 INSTANCE1 = {'supervisor_program': 'instance1',
@@ -14,12 +21,23 @@ INSTANCE2 = {'supervisor_program': 'instance2',
              'haproxy_server': 'plone0402'}
 
 
+class SupervisorRPCMock(object):
+
+    def __init__(self, process_infos):
+        self.supervisor = self
+        self.process_infos = process_infos
+
+    def getAllProcessInfo(self):
+        return self.process_infos
+
+
 class TestHaProxyEventListener(TestCase):
 
     def setUp(self):
         self.haproxy_control = HaProxyControlMock()
         self.event_listener = None
         self.maxDiff = None
+        self.addCleanup(self.stop_listener)
 
     @freeze_time('2016-09-14 10:45:30')
     def test_receive_PROCESS_STATE_EXITED(self):
@@ -110,7 +128,25 @@ class TestHaProxyEventListener(TestCase):
                 programs=[INSTANCE1, INSTANCE2]))
         self.assertEqual([], self.haproxy_control.calls)
 
-    def test_retry_on_failure_then_skip_events(self):
+    @freeze_time('2016-09-14 11:20:30')
+    def test_fail_when_haproxy_times_out(self):
+        self.haproxy_control.time_out = True
+        self.assertEqual(
+            {'stdout': 'RESULT 4\nFAIL',
+             'stderr': ('2016-09-14T11:20:30'
+                        ' Received PROCESS_STATE_EXITED (from RUNNING)'
+                        ' for instance2,'
+                        ' sending MAINT for plone04/plone0402.\n'
+                        "ERROR: HaProxy stats socket timed out:"
+                        " HaProxyReceiveTimeout('timed out',)\n")},
+            self.run_listener(
+                'eventname:PROCESS_STATE_EXITED',
+                'expected:1 processname:instance2 groupname:bar'
+                ' from_state:RUNNING pid:1',
+                programs=[INSTANCE1, INSTANCE2], event_timeout=2.5))
+        self.assertEqual([2.5], self.haproxy_control.deadlines)
+
+    def test_retry_on_failure_then_queue_changes(self):
         # When HaProxy is not reachable, events would stack up and generate
         # high load because the events are never resolved.
         # But it could happen that a single connection cannot be established,
@@ -119,45 +155,57 @@ class TestHaProxyEventListener(TestCase):
         # In order to avoid high load the event listener returns FAIL for the
         # first few failing events, so that the main supervisor process will
         # requeue them.
-        # If all events are failing, the event listener is set into skpping
-        # state for some time, where it always returns OK and drops all events,
-        # in order to protect from high load.
+        # If all events are failing, the circuit breaker opens: the events
+        # are acknowledged and the latest state of each server is queued.
+        # HaProxy is probed with an exponentially growing delay and the
+        # queued changes are sent in one batch when it is reachable again.
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1, INSTANCE2], haproxy_control=self.haproxy_control)
+        self.event_listener.breaker.jitter = 0
         self.haproxy_control.refuse_connection = True
 
-        log_receive = (' Received PROCESS_STATE_EXITED (from RUNNING)'
-                       ' for instance2,'
-                       ' sending MAINT for plone04/plone0402.\n')
+        def log_receive(processname, server):
+            return (' Received PROCESS_STATE_EXITED (from RUNNING)'
+                    ' for {}, sending MAINT for plone04/{}.\n'.format(
+                        processname, server))
 
         failure = {
             'stdout': 'RESULT 4\nFAIL',
-            'stderr': (log_receive +
+            'stderr': (log_receive('instance2', 'plone0402') +
                        'ERROR: connection to HaProxy stats socket refused\n')}
 
-        skip_start = {
+        circuit_open = {
             'stdout': 'RESULT 2\nOK',
-            'stderr': (log_receive +
-                       'WARNING: too many connections were refused, therefore'
-                       ' this and all future events will be skipped unhandled'
-                       ' for the next 60 seconds.\n')}
+            'stderr': (log_receive('instance2', 'plone0402') +
+                       'ERROR: connection to HaProxy stats socket refused\n'
+                       'WARNING: too many connections failed, therefore this'
+                       ' and all future changes are queued and retried in'
+                       ' 1.0 seconds.\n')}
 
-        skip_continue = {
+        queued = {
             'stdout': 'RESULT 2\nOK',
-            'stderr': (log_receive +
-                       'WARNING: skipping event handling because too many'
-                       ' connections were refused previously.\n')}
+            'stderr': (log_receive('instance2', 'plone0402') +
+                       'WARNING: HaProxy is not reachable, queueing the change'
+                       ' and retrying in 1.0 seconds.\n')}
 
-        failure_resume = {
-            'stdout': 'RESULT 4\nFAIL',
-            'stderr': (log_receive +
-                       'WARNING: resuming event handling.\n'
-                       'ERROR: connection to HaProxy stats socket refused\n')}
+        probe_failed = {
+            'stdout': 'RESULT 2\nOK',
+            'stderr': (log_receive('instance2', 'plone0402') +
+                       "WARNING: HaProxy is still not reachable"
+                       " (HaProxyConnectionRefused(111, 'Connection refused')),"
+                       " retrying in 2.0 seconds.\n")}
+
+        recovered = {
+            'stdout': 'RESULT 2\nOK',
+            'stderr': (log_receive('instance1', 'plone0401') +
+                       '2016-01-01T01:00:04 HaProxy is reachable,'
+                       ' sent 2 queued changes.\n')}
 
-        def run_listener():
+        def run_listener(processname='instance2'):
             result = self.run_listener(
                 'eventname:PROCESS_STATE_EXITED',
-                'expected:1 processname:instance2 groupname:bar'
-                ' from_state:RUNNING pid:1',
-                programs=[INSTANCE1, INSTANCE2])
+                'expected:1 processname:{} groupname:bar'
+                ' from_state:RUNNING pid:1'.format(processname))
             # remove timestamp so that assertions get easier
             result['stderr'] = result['stderr'][19:]
             return result
@@ -167,18 +215,157 @@ class TestHaProxyEventListener(TestCase):
             self.assertEqual(failure, run_listener())
             self.assertEqual(failure, run_listener())
             self.assertEqual(failure, run_listener())
-            # after 4 failures skip events for one minute ..
-            self.assertEqual(skip_start, run_listener())
-            self.assertEqual(skip_continue, run_listener())
+            # after 4 failures the circuit is opened for one second ..
+            self.assertEqual(circuit_open, run_listener())
+            self.assertEqual(queued, run_listener())
+
+        # .. then haproxy is probed and the delay is doubled ..
+        with freeze_time('2016-01-01 01:00:01'):
+            self.assertEqual(probe_failed, run_listener())
+            self.assertEqual([], self.haproxy_control.popcalls())
+
+        # .. until haproxy is reachable again.
+        self.haproxy_control.refuse_connection = False
+        with freeze_time('2016-01-01 01:00:04'):
+            self.assertEqual(recovered, run_listener('instance1'))
+            self.assertEqual(
+                [('ping',),
+                 ('set_server_statuses',
+                  [('plone04', 'plone0402', 'MAINT'),
+                   ('plone04', 'plone0401', 'MAINT')])],
+                self.haproxy_control.popcalls())
+
+            self.assertEqual('RESULT 2\nOK', run_listener()['stdout'])
+            self.assertEqual(
+                [('set_server_status', 'plone04', 'plone0402', 'MAINT')],
+                self.haproxy_control.popcalls())
+
+    def test_TICK_event_retries_queued_changes(self):
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1], haproxy_control=self.haproxy_control,
+            background=True)
+        self.event_listener.breaker.jitter = 0
+        self.haproxy_control.refuse_connection = True
 
-        # .. then start trying to connect again
-        with freeze_time('2016-01-01 01:01:01'):
-            self.assertEqual(failure_resume, run_listener())
-            self.assertEqual(failure, run_listener())
-            self.assertEqual(failure, run_listener())
-            self.assertEqual(failure, run_listener())
-            self.assertEqual(skip_start, run_listener())
-            self.assertEqual(skip_continue, run_listener())
+        with freeze_time('2016-01-01 01:00:00'):
+            # In background mode, failed changes are always queued, since
+            # supervisor cannot resend the event.
+            self.run_listener(
+                'eventname:PROCESS_STATE_RUNNING',
+                'expected:1 processname:instance1 groupname:bar pid:1')
+            self.event_listener.worker.join_queue()
+            self.assertEqual({('plone04', 'plone0401'): 'READY'},
+                             dict(self.event_listener.breaker.queue))
+
+        self.haproxy_control.refuse_connection = False
+        with freeze_time('2016-01-01 01:00:05'):
+            self.assertEqual(
+                'RESULT 2\nOK',
+                self.run_listener('eventname:TICK_5',
+                                  'when:1201063880')['stdout'])
+            # In background mode, the tick runs in its own thread.
+            self.event_listener.tick_thread.join()
+        self.event_listener.log_writer.flush()
+        self.assertEqual('2016-01-01T01:00:05 HaProxy is reachable,'
+                         ' sent 1 queued changes.\n',
+                         self.event_listener.stderr.getvalue())
+
+        self.assertEqual(
+            [('ping',),
+             ('set_server_statuses', [('plone04', 'plone0401', 'READY')])],
+            self.haproxy_control.popcalls())
+
+    def test_change_is_queued_when_connection_is_reset(self):
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1], haproxy_control=self.haproxy_control,
+            background=True)
+
+        def reset(backend, server_name, state):
+            raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+
+        self.haproxy_control.set_server_status = reset
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPED',
+            'expected:1 processname:instance1 groupname:bar pid:1')
+        self.event_listener.worker.join_queue()
+        self.assertEqual({('plone04', 'plone0401'): 'MAINT'},
+                         dict(self.event_listener.breaker.queue))
+        self.assertEqual(1, self.event_listener.breaker.failures)
+
+    def test_applied_change_replaces_queued_change(self):
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1], haproxy_control=self.haproxy_control,
+            background=True)
+        self.haproxy_control.refuse_connection = True
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPED',
+            'expected:1 processname:instance1 groupname:bar pid:1')
+        self.event_listener.worker.join_queue()
+        self.assertEqual({('plone04', 'plone0401'): 'MAINT'},
+                         dict(self.event_listener.breaker.queue))
+
+        self.haproxy_control.refuse_connection = False
+        self.run_listener(
+            'eventname:PROCESS_STATE_RUNNING',
+            'expected:1 processname:instance1 groupname:bar pid:1')
+        self.event_listener.worker.join_queue()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'READY')],
+            self.haproxy_control.popcalls())
+        self.assertEqual({}, dict(self.event_listener.breaker.queue))
+
+    def test_changes_stay_queued_when_recovery_fails(self):
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1], haproxy_control=self.haproxy_control,
+            background=True)
+        self.event_listener.breaker.jitter = 0
+        self.haproxy_control.refuse_connection = True
+
+        with freeze_time('2016-01-01 01:00:00'):
+            self.run_listener(
+                'eventname:PROCESS_STATE_RUNNING',
+                'expected:1 processname:instance1 groupname:bar pid:1')
+            self.event_listener.worker.join_queue()
+
+        def reset(changes):
+            raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+
+        self.haproxy_control.refuse_connection = False
+        self.haproxy_control.set_server_statuses = reset
+        with freeze_time('2016-01-01 01:00:05'):
+            result = self.run_listener('eventname:TICK_5', 'when:1201063880')
+            self.event_listener.tick_thread.join()
+
+        self.assertEqual('RESULT 2\nOK', result['stdout'])
+        self.event_listener.log_writer.flush()
+        self.assertIn('WARNING: HaProxy is still not reachable',
+                      self.event_listener.stderr.getvalue())
+        self.assertEqual({('plone04', 'plone0401'): 'READY'},
+                         dict(self.event_listener.breaker.queue))
+        self.assertFalse(self.event_listener.breaker.half_open)
+
+    def test_TICK_event_does_not_wait_for_the_worker(self):
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1], haproxy_control=self.haproxy_control,
+            background=True)
+        target = self.event_listener.targets[0]
+        target.enqueue(('plone04', 'plone0401'), 'READY')
+        # The worker applies a change meanwhile.
+        with target.lock:
+            self.assertEqual('RESULT 2\nOK', self.run_listener(
+                'eventname:TICK_5', 'when:1201063880')['stdout'])
+            self.assertEqual([], self.haproxy_control.popcalls())
+        self.event_listener.tick_thread.join()
+        self.assertEqual(
+            [('ping',),
+             ('set_server_statuses', [('plone04', 'plone0401', 'READY')])],
+            self.haproxy_control.popcalls())
+
+    def test_ignore_event_without_eventname(self):
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK', 'stderr': ''},
+            self.run_listener('ver:3.0', 'processname:instance1'))
+        self.assertEqual([], self.haproxy_control.popcalls())
 
     def test_ignore_TICK_60_event(self):
         self.assertEqual(
@@ -189,11 +376,543 @@ class TestHaProxyEventListener(TestCase):
                 'when:1201063880'))
         self.assertEqual([], self.haproxy_control.calls)
 
-    def run_listener(self, header, body, programs=None):
+    def test_background_mode_acknowledges_before_haproxy_responds(self):
+        self.haproxy_control.responding.clear()
+        for eventname in ('PROCESS_STATE_STOPPING',
+                          'PROCESS_STATE_STOPPED',
+                          'PROCESS_STATE_STARTING'):
+            self.assertEqual(
+                'RESULT 2\nOK',
+                self.run_listener(
+                    'eventname:{}'.format(eventname),
+                    'expected:1 processname:instance1 groupname:bar pid:1',
+                    programs=[INSTANCE1], background=True)['stdout'])
+
+        self.assertEqual([], self.haproxy_control.calls)
+        self.haproxy_control.responding.set()
+        self.event_listener.worker.join_queue()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN'),
+             ('set_server_status', 'plone04', 'plone0401', 'MAINT'),
+             ('set_server_status', 'plone04', 'plone0401', 'MAINT')],
+            self.haproxy_control.calls)
+
+    def test_stop_applies_queued_changes_and_stops_threads(self):
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPED',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            programs=[INSTANCE1], background=True, slow_start=10)
+        self.event_listener.stop()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'MAINT')],
+            self.haproxy_control.calls)
+        self.assertFalse(self.event_listener.worker.is_alive())
+        self.assertFalse(self.event_listener.slow_start.is_alive())
+        self.assertFalse(self.event_listener.log_writer.is_alive())
+
+    def test_background_mode_fails_events_when_queue_is_full(self):
+        self.haproxy_control.responding.clear()
+
+        def trigger(processname):
+            return self.run_listener(
+                'eventname:PROCESS_STATE_STOPPED',
+                'expected:1 processname:{} groupname:bar pid:1'.format(
+                    processname),
+                programs=[INSTANCE1, INSTANCE2],
+                background=True, queue_size=1)
+
+        self.assertEqual('RESULT 2\nOK', trigger('instance1')['stdout'])
+        # Wait until the worker is busy with the first change.
+        with self.event_listener.worker.condition:
+            while self.event_listener.worker.queue:
+                self.event_listener.worker.condition.wait()
+
+        self.assertEqual('RESULT 2\nOK', trigger('instance2')['stdout'])
+        result = trigger('instance1')
+        self.assertEqual('RESULT 4\nFAIL', result['stdout'])
+        self.assertIn('ERROR: queue is full, rejecting event.',
+                      result['stderr'])
+
+        self.haproxy_control.responding.set()
+        self.event_listener.worker.join_queue()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'MAINT'),
+             ('set_server_status', 'plone04', 'plone0402', 'MAINT')],
+            self.haproxy_control.calls)
+
+    def test_background_mode_drops_oldest_change_when_queue_is_full(self):
+        self.haproxy_control.responding.clear()
+
+        def trigger(eventname):
+            return self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1],
+                background=True, queue_size=1, queue_overflow='drop')
+
+        trigger('PROCESS_STATE_STOPPING')
+        with self.event_listener.worker.condition:
+            while self.event_listener.worker.queue:
+                self.event_listener.worker.condition.wait()
+
+        trigger('PROCESS_STATE_STOPPED')
+        self.assertEqual('RESULT 2\nOK',
+                         trigger('PROCESS_STATE_STARTING')['stdout'])
+
+        self.haproxy_control.responding.set()
+        self.event_listener.worker.join_queue()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN'),
+             ('set_server_status', 'plone04', 'plone0401', 'MAINT')],
+            self.haproxy_control.calls)
+
+    def test_coalesce_flapping_state_changes(self):
+        def trigger(processname, eventname):
+            result = self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:{} groupname:bar pid:1'.format(
+                    processname),
+                programs=[INSTANCE1, INSTANCE2], coalesce_window=0.5)
+            self.assertEqual('RESULT 2\nOK', result['stdout'])
+
+        trigger('instance1', 'PROCESS_STATE_STARTING')
+        trigger('instance2', 'PROCESS_STATE_STOPPING')
+        trigger('instance1', 'PROCESS_STATE_BACKOFF')
+        trigger('instance1', 'PROCESS_STATE_STARTING')
+        trigger('instance2', 'PROCESS_STATE_STOPPED')
+        trigger('instance1', 'PROCESS_STATE_RUNNING')
+
+        self.event_listener.worker.join_queue()
+        self.assertEqual(
+            [('set_server_statuses', [('plone04', 'plone0401', 'READY'),
+                                      ('plone04', 'plone0402', 'MAINT')])],
+            self.haproxy_control.calls)
+        self.assertEqual(6, self.event_listener.worker.queued)
+        self.assertEqual(4, self.event_listener.worker.coalesced)
+
+    def test_skip_commands_already_applied(self):
+        def trigger(eventname):
+            result = self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1], state_cache_ttl=60)
+            self.assertEqual('RESULT 2\nOK', result['stdout'])
+            return result['stderr']
+
+        with freeze_time('2016-09-14 10:45:30'):
+            trigger('PROCESS_STATE_STARTING')
+            self.assertEqual(
+                [('get_server_admin_states', 'plone04'),
+                 ('set_server_status', 'plone04', 'plone0401', 'MAINT')],
+                self.haproxy_control.popcalls())
+
+            self.assertIn('Skipping MAINT for plone04/plone0401,'
+                          ' already applied.',
+                          trigger('PROCESS_STATE_BACKOFF'))
+            self.assertEqual([], self.haproxy_control.popcalls())
+
+            trigger('PROCESS_STATE_STARTING')
+            trigger('PROCESS_STATE_RUNNING')
+            self.assertEqual(
+                [('set_server_status', 'plone04', 'plone0401', 'READY')],
+                self.haproxy_control.popcalls())
+
+        # Someone else changes the state in haproxy.
+        self.haproxy_control.admin_states['plone04', 'plone0401'] = 'MAINT'
+        with freeze_time('2016-09-14 10:46:00'):
+            trigger('PROCESS_STATE_RUNNING')
+            self.assertEqual([], self.haproxy_control.popcalls())
+
+        # After the TTL, the states are synchronized with haproxy.
+        with freeze_time('2016-09-14 10:46:31'):
+            trigger('PROCESS_STATE_RUNNING')
+            self.assertEqual(
+                [('get_server_admin_states', 'plone04'),
+                 ('set_server_status', 'plone04', 'plone0401', 'READY')],
+                self.haproxy_control.popcalls())
+
+    @freeze_time('2016-09-14 10:45:30')
+    def test_reconcile_at_startup(self):
+        rpc = SupervisorRPCMock([
+            {'name': 'instance1', 'statename': 'RUNNING'},
+            {'name': 'instance2', 'statename': 'STOPPED'},
+            {'name': 'zeo', 'statename': 'RUNNING'}])
+        self.haproxy_control.admin_states.update({
+            ('plone04', 'plone0401'): 'MAINT',
+            ('plone04', 'plone0402'): 'MAINT',
+            ('plone05', 'plone0501'): 'READY'})
+
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK',
+             'stderr': ('2016-09-14T10:45:30 Reconciled 2 programs with'
+                        ' haproxy, sent READY for plone04/plone0401.\n')},
+            self.run_listener('eventname:TICK_60', 'when:1201063880',
+                              programs=[INSTANCE1, INSTANCE2],
+                              reconcile=True, rpc=rpc))
+        self.assertEqual(
+            [('get_server_admin_states', 'plone04'),
+             ('set_server_statuses',
+              [('plone04', 'plone0401', 'READY')])],
+            self.haproxy_control.popcalls())
+
+        # The TICK event is ignored, since reconcile_on_tick is not enabled
+        # and reconciliation happens only once at startup.
+        self.run_listener('eventname:TICK_60', 'when:1201063880')
+        self.assertEqual([], self.haproxy_control.popcalls())
+
+    @freeze_time('2016-09-14 10:45:30')
+    def test_reconcile_on_tick(self):
+        rpc = SupervisorRPCMock([
+            {'name': 'instance1', 'statename': 'RUNNING'},
+            {'name': 'instance2', 'statename': 'RUNNING'}])
+        self.haproxy_control.admin_states.update({
+            ('plone04', 'plone0401'): 'READY',
+            ('plone04', 'plone0402'): 'READY'})
+
+        def tick():
+            return self.run_listener('eventname:TICK_60', 'when:1201063880',
+                                     programs=[INSTANCE1, INSTANCE2],
+                                     reconcile_on_tick=True, rpc=rpc)
+
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK',
+             'stderr': ('2016-09-14T10:45:30 Reconciled 2 programs with'
+                        ' haproxy, sent nothing.\n')},
+            tick())
+        self.assertEqual([('get_server_admin_states', 'plone04')],
+                         self.haproxy_control.popcalls())
+
+        rpc.process_infos[1]['statename'] = 'FATAL'
+        tick()
+        self.assertEqual(
+            [('get_server_admin_states', 'plone04'),
+             ('set_server_statuses',
+              [('plone04', 'plone0402', 'MAINT')])],
+            self.haproxy_control.popcalls())
+
+    def test_reconcile_begins_slow_start(self):
+        rpc = SupervisorRPCMock([
+            {'name': 'instance1', 'statename': 'RUNNING'},
+            {'name': 'instance2', 'statename': 'RUNNING'}])
+        self.haproxy_control.admin_states.update({
+            ('plone04', 'plone0401'): 'MAINT',
+            ('plone04', 'plone0402'): 'READY'})
+
+        self.run_listener('eventname:TICK_60', 'when:1201063880',
+                          programs=[INSTANCE1, INSTANCE2],
+                          reconcile_on_tick=True, rpc=rpc, slow_start=60)
+        self.assertEqual(
+            [('get_server_admin_states', 'plone04'),
+             ('set_server_statuses', [('plone04', 'plone0401', 'READY')]),
+             ('set_server_weight', 'plone04', 'plone0401', '10%')],
+            self.haproxy_control.popcalls())
+        self.assertEqual(set([('plone04', 'plone0401')]),
+                         self.event_listener.slow_start.ramping())
+
+    def test_reconcile_leaves_warming_up_programs_alone(self):
+        rpc = SupervisorRPCMock([{'name': 'instance1',
+                                  'statename': 'RUNNING'}])
+        self.haproxy_control.admin_states.update({
+            ('plone04', 'plone0401'): 'MAINT'})
+
+        def trigger(eventname):
+            self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1], rpc=rpc,
+                warmup_urls=[('instance1', 'http://127.0.0.1:9903/Plone')],
+                warmup_time_limit=5)
+
+        trigger('PROCESS_STATE_RUNNING')
+        self.assertTrue(self.event_listener.reconcile())
+        self.assertEqual([('get_server_admin_states', 'plone04')],
+                         self.haproxy_control.popcalls())
+
+        trigger('PROCESS_STATE_STOPPING')
+        self.event_listener.warmup.join()
+        self.haproxy_control.popcalls()
+
+    def test_failing_reconciliation_is_logged(self):
+        self.haproxy_control.refuse_connection = True
+        rpc = SupervisorRPCMock([{'name': 'instance1', 'statename': 'RUNNING'}])
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK',
+             'stderr': ("ERROR: reconciliation failed:"
+                        " HaProxyConnectionRefused(111, 'Connection refused')\n")},
+            self.run_listener('eventname:TICK_60', 'when:1201063880',
+                              programs=[INSTANCE1],
+                              reconcile_on_tick=True, rpc=rpc))
+
+    def test_metrics(self):
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            programs=[INSTANCE1])
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:zeo groupname:bar pid:1')
+        self.haproxy_control.refuse_connection = True
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPED',
+            'expected:1 processname:instance1 groupname:bar pid:1')
+
+        metrics = self.event_listener.metrics
+        self.assertEqual(3, metrics.get('events_received_total'))
+        self.assertEqual(1, metrics.get('events_ignored_total'))
+        self.assertEqual(1, metrics.get('commands_sent_total'))
+        self.assertEqual(1, metrics.get('failures_total'))
+        self.assertEqual(1, metrics.get('connections_refused_total'))
+        self.assertEqual(
+            3, metrics.histograms['event_duration_seconds'].count)
+
+    def test_dump_metrics_on_SIGUSR1(self):
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            programs=[INSTANCE1])
+        self.event_listener.stderr = StringIO()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.event_listener.log_writer.flush()
+        self.assertIn('supervisor_haproxy_commands_sent_total 1\n',
+                      self.event_listener.stderr.getvalue())
+        self.assertIn('supervisor_haproxy_retry_queue_length 0\n',
+                      self.event_listener.stderr.getvalue())
+
+    def test_multiple_sockets(self):
+        listener = HaProxyEventListener(
+            [INSTANCE1],
+            haproxy_socket=('unix:///run/haproxy/admin1.sock,'
+                            'unix:///run/haproxy/admin2.sock'),
+            persistent=True)
+        self.addCleanup(listener.stop)
+        controls = [target.haproxy_control for target in listener.targets]
+        self.assertEqual(
+            ['/run/haproxy/admin1.sock', '/run/haproxy/admin2.sock'],
+            [control.sock_address for control in controls])
+        self.assertTrue(all(control.persistent for control in controls))
+
+    def test_failing_socket_does_not_open_the_breaker_of_others(self):
+        haproxies = [FakeHaProxy({'plone04': ['plone0401']}).start(),
+                     FakeHaProxy({'plone04': ['plone0401']}).start()]
+        for haproxy in haproxies:
+            self.addCleanup(haproxy.stop)
+        self.event_listener = HaProxyEventListener(
+            [INSTANCE1],
+            haproxy_socket=','.join(haproxy.socket for haproxy in haproxies))
+        haproxies[0].refuse = True
+
+        for num in range(6):
+            self.run_listener(
+                'eventname:PROCESS_STATE_STOPPED',
+                'expected:1 processname:instance1 groupname:bar pid:1')
+
+        self.assertFalse(self.event_listener.targets[0].breaker.allow_request())
+        self.assertTrue(self.event_listener.targets[1].breaker.allow_request())
+        self.assertEqual('MAINT',
+                         haproxies[1].get_server('plone04', 'plone0401').status)
+
+    @freeze_time('2016-09-14 10:45:30')
+    def test_multiple_load_balancers(self):
+        standby = HaProxyControlMock('tcp://10.0.0.2:9902')
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK',
+             'stderr': ('2016-09-14T10:45:30'
+                        ' Received PROCESS_STATE_STOPPING (from RUNNING)'
+                        ' for instance1,'
+                        ' sending DRAIN for plone04/plone0401.\n')},
+            self.run_listener(
+                'eventname:PROCESS_STATE_STOPPING',
+                'expected:1 processname:instance1 groupname:bar'
+                ' from_state:RUNNING pid:1',
+                programs=[INSTANCE1], targets=[standby]))
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN')],
+            self.haproxy_control.popcalls())
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN')],
+            standby.popcalls())
+
+    def test_event_fails_without_quorum(self):
+        standby = HaProxyControlMock('tcp://10.0.0.2:9902')
+        standby.refuse_connection = True
+        result = self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            programs=[INSTANCE1], targets=[standby])
+        self.assertEqual('RESULT 4\nFAIL', result['stdout'])
+        self.assertIn('[tcp://10.0.0.2:9902] ERROR: connection to HaProxy'
+                      ' stats socket refused\n', result['stderr'])
+        self.assertIn('ERROR: change handled by 1 of 2 load balancers,'
+                      ' quorum is 2.\n', result['stderr'])
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+    def test_failed_targets_retry_when_quorum_is_reached(self):
+        standby = HaProxyControlMock('tcp://10.0.0.2:9902')
+        standby.refuse_connection = True
+        self.assertEqual('RESULT 2\nOK', self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            programs=[INSTANCE1], targets=[standby], quorum=1)['stdout'])
+        self.assertEqual({('plone04', 'plone0401'): 'DRAIN'},
+                         dict(self.event_listener.targets[1].breaker.queue))
+        self.assertEqual({}, dict(self.event_listener.targets[0].breaker.queue))
+
+        standby.refuse_connection = False
+        self.run_listener('eventname:TICK_5', 'when:1201063880')
+        self.assertEqual(
+            [('ping',),
+             ('set_server_statuses', [('plone04', 'plone0401', 'DRAIN')])],
+            standby.popcalls())
+
+    def test_invalid_quorum(self):
+        with self.assertRaises(ValueError):
+            HaProxyEventListener([INSTANCE1],
+                                 haproxy_control=self.haproxy_control,
+                                 quorum=2)
+
+    def test_slow_start(self):
+        def trigger(eventname):
+            self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1], slow_start=0.1, slow_start_weight=10,
+                slow_start_steps=2)
+
+        trigger('PROCESS_STATE_RUNNING')
+        self.event_listener.slow_start.join_schedule()
+        self.assertEqual(
+            [('set_server_weight', 'plone04', 'plone0401', '10%'),
+             ('set_server_status', 'plone04', 'plone0401', 'READY'),
+             ('set_server_weight', 'plone04', 'plone0401', '55%'),
+             ('set_server_weight', 'plone04', 'plone0401', '100%')],
+            self.haproxy_control.popcalls())
+        self.assertEqual(
+            3, self.event_listener.metrics.get('weight_changes_total'))
+
+    def test_slow_start_is_cancelled_when_program_stops(self):
+        def trigger(eventname):
+            self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1], slow_start=60)
+
+        trigger('PROCESS_STATE_RUNNING')
+        trigger('PROCESS_STATE_STOPPING')
+        self.event_listener.slow_start.join_schedule()
+        self.assertEqual(
+            [('set_server_weight', 'plone04', 'plone0401', '10%'),
+             ('set_server_status', 'plone04', 'plone0401', 'READY'),
+             ('set_server_status', 'plone04', 'plone0401', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+    @freeze_time('2016-09-14 10:45:30')
+    def test_warmup_before_ready(self):
+        # Nothing listens on port 9903, the warm-up does not pass and the
+        # server is set READY after the time limit, as configured.
+        self.assertEqual(
+            {'stdout': 'RESULT 2\nOK',
+             'stderr': ('2016-09-14T10:45:30'
+                        ' Received PROCESS_STATE_RUNNING (from STARTING)'
+                        ' for instance1,'
+                        ' sending READY for plone04/plone0401.\n'
+                        'Warming up instance1 before sending READY.\n')},
+            self.run_listener(
+                'eventname:PROCESS_STATE_RUNNING',
+                'expected:1 processname:instance1 groupname:bar'
+                ' from_state:STARTING pid:1',
+                programs=[INSTANCE1],
+                warmup_urls=[('instance1', 'http://127.0.0.1:9903/Plone')],
+                warmup_time_limit=0.2, warmup_ready_on_timeout=True))
+        self.assertEqual([], self.haproxy_control.popcalls())
+
+        self.event_listener.warmup.join()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'READY')],
+            self.haproxy_control.popcalls())
+
+    def test_warmup_is_cancelled_when_program_stops(self):
+        def trigger(eventname):
+            self.run_listener(
+                'eventname:{}'.format(eventname),
+                'expected:1 processname:instance1 groupname:bar pid:1',
+                programs=[INSTANCE1],
+                warmup_urls=[('instance1', 'http://127.0.0.1:9903/Plone')],
+                warmup_time_limit=5)
+
+        trigger('PROCESS_STATE_RUNNING')
+        trigger('PROCESS_STATE_STOPPING')
+        self.event_listener.warmup.join()
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+    def test_mapping_file_is_reloaded_on_SIGHUP(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'mapping.txt')
+        with open(path, 'w') as mapping_file:
+            mapping_file.write('re:instance(\\d+) plone04/plone040\\1\n')
+
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance2 groupname:bar pid:1',
+            mapping_file=path)
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0402', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+        with open(path, 'w') as mapping_file:
+            mapping_file.write('re:instance(\\d+) plone05/plone050\\1\n')
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.event_listener.log_writer.flush()
+        self.assertIn('Reloaded {}.'.format(path),
+                      self.event_listener.stderr.getvalue())
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance2 groupname:bar pid:1')
+        self.assertEqual(
+            [('set_server_status', 'plone05', 'plone0502', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+    def test_invalid_mapping_file_keeps_old_rules(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'mapping.txt')
+        with open(path, 'w') as mapping_file:
+            mapping_file.write('glob:instance* plone04/{name}\n')
+
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1',
+            mapping_file=path)
+        self.haproxy_control.popcalls()
+
+        with open(path, 'w') as mapping_file:
+            mapping_file.write('instance1 plone04\n')
+        self.assertFalse(self.event_listener.reload_mapping())
+        self.event_listener.log_writer.flush()
+        self.assertIn('ERROR: reloading {} failed, keeping the old rules:'
+                      ' {}, line 1: invalid rule'.format(path, path),
+                      self.event_listener.stderr.getvalue())
+        self.run_listener(
+            'eventname:PROCESS_STATE_STOPPING',
+            'expected:1 processname:instance1 groupname:bar pid:1')
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'instance1', 'DRAIN')],
+            self.haproxy_control.popcalls())
+
+    def stop_listener(self):
+        if self.event_listener is not None:
+            self.event_listener.stop()
+
+    def run_listener(self, header, body, programs=None, **kwargs):
         if self.event_listener is None:
             self.event_listener = HaProxyEventListener(
                 programs or [],
-                haproxy_control=self.haproxy_control)
+                haproxy_control=self.haproxy_control,
+                **kwargs)
 
         header = '{} len:{}\n'.format(header, len(body))
         self.event_listener.stdin = StringIO(header + body)
@@ -0,0 +1,142 @@
+from supervisor_haproxy.mapping import parse_rules
+from supervisor_haproxy.mapping import ProgramMapping
+from unittest2 import TestCase
+import os
+import shutil
+import tempfile
+
+
+INSTANCE1 = {'supervisor_program': 'instance1',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0401'}
+
+RULES = '''
+# Comments and empty lines are ignored.
+zeoclient plone03/plone0300
+re:instance(\\d+) plone04/plone04\\1  # regular expression
+glob:worker* plone05/{name}
+'''
+
+
+class TestParseRules(TestCase):
+
+    def test_parse_rules(self):
+        self.assertEqual(
+            [('zeoclient', 'plone03', 'plone0300'),
+             ('re:instance(\\d+)', 'plone04', 'plone04\\1'),
+             ('glob:worker*', 'plone05', '{name}')],
+            parse_rules(RULES))
+
+    def test_invalid_rule(self):
+        with self.assertRaises(ValueError) as cm:
+            parse_rules('instance1 plone04/plone0401\ninstance2 plone04\n',
+                        'mapping.txt')
+        self.assertEqual(
+            'mapping.txt, line 2: invalid rule \'instance2 plone04\', must be'
+            ' of form "PATTERN BACKEND/SERVER"', str(cm.exception))
+
+    def test_invalid_regular_expression(self):
+        with self.assertRaises(ValueError) as cm:
+            parse_rules('re:instance(\\d+ plone04/plone04\\1')
+        self.assertTrue(str(cm.exception).startswith(
+            '<mapping>, line 1: invalid regular expression'))
+
+
+class TestProgramMapping(TestCase):
+
+    def setUp(self):
+        self.mapping = ProgramMapping([INSTANCE1], parse_rules(RULES))
+
+    def test_programs_take_precedence(self):
+        self.assertEqual(INSTANCE1, self.mapping.get('instance1'))
+
+    def test_exact_name(self):
+        self.assertEqual({'supervisor_program': 'zeoclient',
+                          'haproxy_backend': 'plone03',
+                          'haproxy_server': 'plone0300'},
+                         self.mapping.get('zeoclient'))
+
+    def test_regular_expression_groups_are_substituted(self):
+        self.assertEqual({'supervisor_program': 'instance12',
+                          'haproxy_backend': 'plone04',
+                          'haproxy_server': 'plone0412'},
+                         self.mapping.get('instance12'))
+        self.assertIsNone(self.mapping.get('instance12a'))
+
+    def test_regular_expression_matches_the_whole_name(self):
+        mapping = ProgramMapping(
+            [], [('re:zeo|instance1', 'plone06', 'plone0601')])
+        self.assertIsNotNone(mapping.get('zeo'))
+        self.assertIsNotNone(mapping.get('instance1'))
+        self.assertIsNone(mapping.get('zeoclient'))
+        self.assertIsNone(mapping.get('instance1\n'))
+
+    def test_glob_name_is_substituted(self):
+        self.assertEqual({'supervisor_program': 'worker-a',
+                          'haproxy_backend': 'plone05',
+                          'haproxy_server': 'worker-a'},
+                         self.mapping.get('worker-a'))
+
+    def test_unknown_program(self):
+        self.assertIsNone(self.mapping.get('zeo'))
+        self.assertEqual('default', self.mapping.get('zeo', 'default'))
+        self.assertNotIn('zeo', self.mapping)
+        self.assertIn('instance3', self.mapping)
+
+    def test_lookups_are_cached(self):
+        self.assertIs(self.mapping.get('instance3'),
+                      self.mapping.get('instance3'))
+
+    def test_servers_contain_looked_up_programs(self):
+        self.assertEqual(set([('plone04', 'plone0401'),
+                              ('plone03', 'plone0300')]),
+                         self.mapping.servers)
+        self.mapping.get('instance3')
+        self.mapping.get('zeo')
+        self.assertEqual(set([('plone04', 'plone0401'),
+                              ('plone03', 'plone0300'),
+                              ('plone04', 'plone043')]),
+                         self.mapping.servers)
+
+    def test_update_replaces_rules_and_cache(self):
+        self.mapping.get('instance3')
+        self.mapping.update([('re:instance(\\d+)', 'plone06', 'plone06\\1')])
+        self.assertEqual('plone06', self.mapping.get('instance3')[
+            'haproxy_backend'])
+        self.assertIsNone(self.mapping.get('zeoclient'))
+        self.assertEqual(set([('plone04', 'plone0401'),
+                              ('plone06', 'plone063')]),
+                         self.mapping.servers)
+
+    def test_update_during_lookup(self):
+        # SIGHUP reloads the rules in the main thread, possibly while a
+        # lookup holds the lock.
+        with self.mapping._lock:
+            self.mapping.update([('glob:zeo', 'plone06', 'plone0600')])
+        self.assertEqual('plone06', self.mapping.get('zeo')[
+            'haproxy_backend'])
+
+
+class TestMappingFile(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'mapping.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_from_file(self):
+        with open(self.path, 'w') as mapping_file:
+            mapping_file.write(RULES)
+        mapping = ProgramMapping.from_file(self.path)
+        self.assertEqual('plone042',
+                         mapping.get('instance2')['haproxy_server'])
+
+    def test_invalid_file_keeps_rules(self):
+        mapping = ProgramMapping(rules=parse_rules(RULES))
+        with open(self.path, 'w') as mapping_file:
+            mapping_file.write('instance1\n')
+        with self.assertRaises(ValueError):
+            mapping.load(self.path)
+        self.assertIn('instance2', mapping)
@@ -0,0 +1,83 @@
+from supervisor_haproxy.metrics import Metrics
+from unittest2 import TestCase
+import os
+import shutil
+import tempfile
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_counters_and_gauges(self):
+        metrics = Metrics()
+        metrics.inc('events_received_total')
+        metrics.inc('events_received_total', 2)
+        metrics.set('queue_length', 5)
+        self.assertEqual(3, metrics.get('events_received_total'))
+        self.assertEqual(
+            '# HELP supervisor_haproxy_events_received_total'
+            ' Events received from supervisor.\n'
+            '# TYPE supervisor_haproxy_events_received_total counter\n'
+            'supervisor_haproxy_events_received_total 3\n'
+            '# HELP supervisor_haproxy_queue_length'
+            ' State changes waiting in the background queue.\n'
+            '# TYPE supervisor_haproxy_queue_length gauge\n'
+            'supervisor_haproxy_queue_length 5\n',
+            metrics.render())
+
+    def test_render_while_updating(self):
+        # A signal handler rendering the metrics interrupts an update in the
+        # same thread.
+        metrics = Metrics()
+        with metrics.lock:
+            metrics.inc('events_received_total')
+            self.assertIn('supervisor_haproxy_events_received_total 1\n',
+                          metrics.render())
+
+    def test_histogram(self):
+        metrics = Metrics()
+        metrics.observe('event_duration_seconds', 0.003)
+        metrics.observe('event_duration_seconds', 0.02)
+        metrics.observe('event_duration_seconds', 30)
+        lines = metrics.render().splitlines()
+        self.assertIn(
+            '# TYPE supervisor_haproxy_event_duration_seconds histogram',
+            lines)
+        self.assertIn(
+            'supervisor_haproxy_event_duration_seconds_bucket{le="0.0025"} 0',
+            lines)
+        self.assertIn(
+            'supervisor_haproxy_event_duration_seconds_bucket{le="0.005"} 1',
+            lines)
+        self.assertIn(
+            'supervisor_haproxy_event_duration_seconds_bucket{le="10"} 2',
+            lines)
+        self.assertIn(
+            'supervisor_haproxy_event_duration_seconds_bucket{le="+Inf"} 3',
+            lines)
+        self.assertIn('supervisor_haproxy_event_duration_seconds_count 3',
+                      lines)
+
+    def test_timer(self):
+        metrics = Metrics()
+        with metrics.timer('haproxy_connect_seconds'):
+            pass
+        self.assertEqual(1, metrics.histograms['haproxy_connect_seconds'].count)
+
+    def test_write_textfile_replaces_file(self):
+        path = os.path.join(self.tempdir, 'haproxy.prom')
+        metrics = Metrics()
+        metrics.inc('failures_total')
+        metrics.write_textfile(path)
+        metrics.inc('failures_total')
+        metrics.write_textfile(path)
+
+        with open(path) as prom_file:
+            self.assertIn('supervisor_haproxy_failures_total 2\n',
+                          prom_file.read())
+        self.assertEqual(['haproxy.prom'], os.listdir(self.tempdir))
@@ -0,0 +1,153 @@
+from supervisor_haproxy.exceptions import RollingRestartError
+from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.rolling_restart import RollingRestart
+from supervisor_haproxy.tests.fake_haproxy import ADMIN_FMAINT
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+from unittest2 import TestCase
+import xmlrpclib
+
+
+class SupervisorRPCMock(object):
+    """Restarts programs by setting their servers in the fake haproxy to
+    MAINT and back to READY, like the event listener would.
+    """
+
+    def __init__(self, haproxy, programs):
+        self.supervisor = self
+        self.haproxy = haproxy
+        self.programs = {program['supervisor_program']: program
+                         for program in programs}
+        self.calls = []
+        self.broken = set()
+        # The faults raised by supervisor, by (action, name).
+        self.faults = {}
+
+    def get_server(self, name):
+        program = self.programs[name]
+        return self.haproxy.get_server(program['haproxy_backend'],
+                                       program['haproxy_server'])
+
+    def stopProcess(self, name):
+        self.calls.append(('stop', name, self.up_servers()))
+        if ('stop', name) in self.faults:
+            raise self.faults['stop', name]
+        self.get_server(name).admin_state = ADMIN_FMAINT
+
+    def startProcess(self, name):
+        self.calls.append(('start', name, self.up_servers()))
+        if ('start', name) in self.faults:
+            raise self.faults['start', name]
+        if name not in self.broken:
+            self.get_server(name).admin_state = 0
+
+    def up_servers(self):
+        return sorted(name for name in self.programs
+                      if self.get_server(name).status == 'UP')
+
+
+def programs(backend, *names):
+    return [{'supervisor_program': name,
+             'haproxy_backend': backend,
+             'haproxy_server': name} for name in names]
+
+
+class TestRollingRestart(TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy({
+            'plone04': ['instance1', 'instance2', 'instance3', 'instance4'],
+            'plone05': ['instance5']}).start()
+        self.programs = (programs('plone04', 'instance1', 'instance2',
+                                  'instance3', 'instance4') +
+                         programs('plone05', 'instance5'))
+        self.rpc = SupervisorRPCMock(self.haproxy, self.programs)
+        self.messages = []
+
+    def tearDown(self):
+        self.haproxy.stop()
+
+    def restart(self, programs, **kwargs):
+        kwargs.setdefault('interval', 0.01)
+        return RollingRestart(HaProxyControl(self.haproxy.socket), self.rpc,
+                              programs, log=self.messages.append, **kwargs)
+
+    def calls(self):
+        return [(action, name) for action, name, ups in self.rpc.calls]
+
+    def test_restarts_in_batches(self):
+        self.restart(self.programs[:4], batch_size=2, min_ready=1).run()
+        self.assertEqual(
+            [('stop', 'instance1'), ('stop', 'instance2'),
+             ('start', 'instance1'), ('start', 'instance2'),
+             ('stop', 'instance3'), ('stop', 'instance4'),
+             ('start', 'instance3'), ('start', 'instance4')],
+            self.calls())
+        self.assertEqual(['instance3', 'instance4', 'instance5'],
+                         self.rpc.calls[0][2])
+        self.assertEqual(['instance1', 'instance2', 'instance3',
+                          'instance4', 'instance5'], self.rpc.up_servers())
+
+    def test_batches_keep_min_ready_servers(self):
+        self.restart(self.programs[:4], batch_size=4, min_ready=3).run()
+        self.assertEqual(
+            [('stop', 'instance1'), ('start', 'instance1'),
+             ('stop', 'instance2'), ('start', 'instance2'),
+             ('stop', 'instance3'), ('start', 'instance3'),
+             ('stop', 'instance4'), ('start', 'instance4')],
+            self.calls())
+
+    def test_aborts_when_server_does_not_come_up(self):
+        self.rpc.broken.add('instance1')
+        with self.assertRaises(RollingRestartError) as cm:
+            self.restart(self.programs[:4], up_timeout=0.1).run()
+        self.assertEqual('plone04/instance1 not UP after 0.1 seconds,'
+                         ' aborting.', str(cm.exception))
+        self.assertEqual([('stop', 'instance1'), ('start', 'instance1')],
+                         self.calls())
+
+    def test_aborts_when_backend_has_not_enough_servers(self):
+        with self.assertRaises(RollingRestartError) as cm:
+            self.restart(self.programs[4:], up_timeout=0.1).run()
+        self.assertEqual('Not enough servers UP in backend plone05, at least'
+                         ' 1 must stay UP.', str(cm.exception))
+        self.assertEqual([], self.calls())
+
+    def test_waits_until_drained(self):
+        self.haproxy.get_server('plone04', 'instance1').scur = 1
+        self.restart(self.programs[:1], drain_timeout=0.1).run()
+        self.assertEqual('WARNING: plone04/instance1 is not drained after'
+                         ' 0.1 seconds, restarting anyway.', self.messages[1])
+        self.assertEqual([('stop', 'instance1'), ('start', 'instance1')],
+                         self.calls())
+
+    def test_servers_without_health_check_count_as_up(self):
+        for name in ('instance1', 'instance2'):
+            self.haproxy.get_server('plone04', name).check = False
+        self.restart(self.programs[:2], min_ready=1).run()
+        self.assertEqual(
+            [('stop', 'instance1'), ('start', 'instance1'),
+             ('stop', 'instance2'), ('start', 'instance2')],
+            self.calls())
+
+    def test_fault_when_stopping_sets_running_servers_back(self):
+        self.rpc.faults['stop', 'instance2'] = xmlrpclib.Fault(
+            70, 'NOT_RUNNING')
+        with self.assertRaises(RollingRestartError) as cm:
+            self.restart(self.programs[:4], batch_size=2).run()
+        self.assertEqual('Stopping instance2 failed: NOT_RUNNING, aborting.'
+                         ' Not started again: instance1.', str(cm.exception))
+        self.assertEqual([('stop', 'instance1'), ('stop', 'instance2')],
+                         self.calls())
+        self.assertEqual('UP', self.haproxy.get_server(
+            'plone04', 'instance2').status)
+
+    def test_fault_when_starting_aborts(self):
+        self.rpc.faults['start', 'instance1'] = xmlrpclib.Fault(
+            50, 'SPAWN_ERROR: instance1')
+        with self.assertRaises(RollingRestartError) as cm:
+            self.restart(self.programs[:4]).run()
+        self.assertEqual('Starting instance1 failed: SPAWN_ERROR: instance1,'
+                         ' aborting. Not started again: instance1.',
+                         str(cm.exception))
+        self.assertEqual([('stop', 'instance1'), ('start', 'instance1')],
+                         self.calls())
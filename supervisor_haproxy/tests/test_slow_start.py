@@ -0,0 +1,85 @@
+from supervisor_haproxy.slow_start import SlowStart
+from unittest2 import TestCase
+import threading
+import time
+
+
+KEY = ('plone04', 'plone0401')
+
+
+class TestSlowStart(TestCase):
+
+    def setUp(self):
+        self.weights = []
+        self.slow_start = None
+
+    def tearDown(self):
+        if self.slow_start is not None:
+            self.slow_start.stop()
+
+    def set_weight(self, key, weight):
+        self.weights.append((key, weight))
+        return True
+
+    def start(self, **kwargs):
+        self.slow_start = SlowStart(self.set_weight, **kwargs)
+        self.slow_start.start()
+        return self.slow_start
+
+    def test_raises_weight_step_by_step(self):
+        slow_start = self.start(duration=0.2, initial_weight=10, steps=3)
+        slow_start.begin(KEY)
+        self.assertEqual([(KEY, 10)], self.weights)
+        slow_start.join_schedule()
+        self.assertEqual([(KEY, 10), (KEY, 40), (KEY, 70), (KEY, 100)],
+                         self.weights)
+
+    def test_ramping(self):
+        slow_start = self.start(duration=10, initial_weight=10, steps=2)
+        self.assertEqual(set(), slow_start.ramping())
+        slow_start.begin(KEY)
+        self.assertEqual(set([KEY]), slow_start.ramping())
+        slow_start.cancel(KEY)
+        self.assertEqual(set(), slow_start.ramping())
+
+    def test_cancel_discards_scheduled_steps(self):
+        slow_start = self.start(duration=10, initial_weight=10, steps=2)
+        slow_start.begin(KEY)
+        slow_start.cancel(KEY)
+        slow_start.join_schedule()
+        self.assertEqual([(KEY, 10)], self.weights)
+
+    def test_cancel_does_not_wait_for_the_next_step(self):
+        slow_start = self.start(duration=10, initial_weight=10, steps=2)
+        slow_start.begin(KEY)
+        start = time.time()
+        slow_start.cancel(KEY)
+        slow_start.join_schedule()
+        self.assertLess(time.time() - start, 1)
+
+    def test_begin_restarts_the_ramp(self):
+        slow_start = self.start(duration=0.2, initial_weight=20, steps=2)
+        slow_start.begin(KEY)
+        slow_start.begin(KEY)
+        slow_start.join_schedule()
+        self.assertEqual([(KEY, 20), (KEY, 20), (KEY, 60), (KEY, 100)],
+                         self.weights)
+
+    def test_last_step_is_retried_until_it_succeeds(self):
+        retried = threading.Event()
+
+        def set_weight(key, weight):
+            self.weights.append((key, weight))
+            if self.weights.count((KEY, 100)) == 3:
+                retried.set()
+                return True
+            return False
+
+        self.slow_start = SlowStart(set_weight, duration=0.1,
+                                    initial_weight=50, steps=1)
+        self.slow_start.start()
+        self.slow_start.begin(KEY)
+        self.assertTrue(retried.wait(5))
+        self.slow_start.join_schedule()
+        self.assertEqual([(KEY, 50), (KEY, 100), (KEY, 100), (KEY, 100)],
+                         self.weights)
@@ -0,0 +1,146 @@
+from StringIO import StringIO
+from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.haproxy_control import HaProxyControl
+from supervisor_haproxy.state_file import ServerStateFile
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+from unittest2 import TestCase
+import os
+import shutil
+import tempfile
+
+
+INSTANCE1 = {'supervisor_program': 'instance1',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0401'}
+
+INSTANCE2 = {'supervisor_program': 'instance2',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0402'}
+
+HEADER = ('1\n'
+          '# be_id be_name srv_id srv_name srv_addr srv_op_state'
+          ' srv_admin_state srv_uweight srv_iweight srv_time_since_last_change'
+          ' srv_check_status srv_check_result srv_check_health'
+          ' srv_check_state srv_agent_state bk_f_forced_id srv_f_forced_id\n')
+
+
+class TestServerStateFile(TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy(
+            {'plone04': ['plone0401', 'plone0402']}).start()
+        self.control = HaProxyControl(self.haproxy.socket)
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'server-state')
+        self.state_file = ServerStateFile(self.path)
+
+    def tearDown(self):
+        self.haproxy.stop()
+        shutil.rmtree(self.tempdir)
+
+    def read(self):
+        with open(self.path) as state_file:
+            return state_file.read()
+
+    def test_sync_writes_show_servers_state(self):
+        self.haproxy.get_server('plone04', 'plone0402').admin_state = 1
+        self.assertTrue(self.state_file.sync(self.control.get_servers_state()))
+        self.assertEqual(
+            HEADER +
+            '1 plone04 1 plone0401 127.0.0.1 2 0 1 1 0 6 3 4 6 0 0 0\n'
+            '1 plone04 2 plone0402 127.0.0.1 2 1 1 1 0 6 3 4 6 0 0 0\n',
+            self.read())
+        self.assertEqual(self.haproxy.execute('show servers state'),
+                         self.read())
+
+    def test_update_sets_admin_state_flags(self):
+        self.state_file.sync(self.control.get_servers_state())
+        self.state_file.rows['plone04', 'plone0402']['srv_admin_state'] = '2'
+        self.state_file.update([('plone04', 'plone0401', 'DRAIN'),
+                                ('plone04', 'plone0402', 'MAINT'),
+                                ('plone05', 'plone0501', 'MAINT')])
+        self.assertEqual(['8', '3'], [
+            row['srv_admin_state'] for row in self.state_file.rows.values()])
+        self.state_file.update([('plone04', 'plone0401', 'READY'),
+                                ('plone04', 'plone0402', 'READY')])
+        self.assertEqual(['0', '2'], [
+            row['srv_admin_state'] for row in self.state_file.rows.values()])
+
+    def test_set_weight(self):
+        self.haproxy.get_server('plone04', 'plone0401').initial_weight = 50
+        self.state_file.sync(self.control.get_servers_state())
+        self.state_file.set_weight([(('plone04', 'plone0401'), 20)])
+        self.assertEqual('10', self.state_file.rows[
+            'plone04', 'plone0401']['srv_uweight'])
+
+    def test_written_only_when_changed(self):
+        self.assertTrue(self.state_file.sync(self.control.get_servers_state()))
+        self.assertFalse(self.state_file.sync(self.control.get_servers_state()))
+        self.assertFalse(self.state_file.update(
+            [('plone04', 'plone0401', 'READY')]))
+        self.assertTrue(self.state_file.update(
+            [('plone04', 'plone0401', 'MAINT')]))
+        self.assertEqual([], [name for name in os.listdir(self.tempdir)
+                              if name.startswith('.tmp-')])
+
+    def test_changes_are_ignored_before_sync(self):
+        self.assertFalse(self.state_file.update(
+            [('plone04', 'plone0401', 'MAINT')]))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestEventListenerServerStateFile(TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy(
+            {'plone04': ['plone0401', 'plone0402']}).start()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'server-state')
+        self.listener = HaProxyEventListener(
+            [INSTANCE1, INSTANCE2], haproxy_socket=self.haproxy.socket,
+            server_state_file=self.path)
+
+    def tearDown(self):
+        self.listener.stop()
+        self.haproxy.stop()
+        shutil.rmtree(self.tempdir)
+
+    def send(self, header, body):
+        self.listener.stdin = StringIO('{} len:{}\n{}'.format(
+            header, len(body), body))
+        self.listener.stdout = StringIO()
+        self.listener.stderr = StringIO()
+        self.listener.runforever(test=True)
+        return self.listener.stderr.getvalue()
+
+    def admin_states(self):
+        with open(self.path) as state_file:
+            return [line.split()[6] for line in state_file.readlines()[2:]]
+
+    def test_state_file_follows_the_events(self):
+        self.send('eventname:PROCESS_STATE_STOPPING',
+                  'processname:instance1 groupname:bar pid:1')
+        self.assertEqual(['8', '0'], self.admin_states())
+        self.send('eventname:PROCESS_STATE_STOPPED',
+                  'processname:instance1 groupname:bar pid:1')
+        self.assertEqual(['1', '0'], self.admin_states())
+        self.assertNotIn('ERROR', self.listener.stderr.getvalue())
+
+    def test_changes_made_by_others_are_synchronized_on_tick(self):
+        self.send('eventname:PROCESS_STATE_STOPPED',
+                  'processname:instance1 groupname:bar pid:1')
+        self.haproxy.get_server('plone04', 'plone0402').admin_state = 8
+        self.assertEqual(['1', '0'], self.admin_states())
+        self.send('eventname:TICK_5', 'when:1201063880')
+        self.assertEqual(['1', '8'], self.admin_states())
+
+    def test_failures_are_logged(self):
+        self.send('eventname:TICK_5', 'when:1201063880')
+        shutil.rmtree(self.tempdir)
+        self.assertIn(
+            'ERROR: updating the server state file failed',
+            self.send('eventname:PROCESS_STATE_STOPPED',
+                      'processname:instance1 groupname:bar pid:1'))
+        self.assertEqual('MAINT', self.haproxy.get_server(
+            'plone04', 'plone0401').status)
+        os.mkdir(self.tempdir)
@@ -0,0 +1,178 @@
+from StringIO import StringIO
+from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.log_writer import LogWriter
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+from supervisor_haproxy.tests.haproxy_control import HaProxyControlMock
+from unittest2 import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+INSTANCE1 = {'supervisor_program': 'instance1',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0401'}
+
+UNKNOWN = {'supervisor_program': 'instance9',
+           'haproxy_backend': 'plone04',
+           'haproxy_server': 'plone0409'}
+
+
+class BlockingStream(StringIO):
+    """A stream whose writes block until ``unblocked`` is set.
+    """
+
+    def __init__(self):
+        StringIO.__init__(self)
+        self.unblocked = threading.Event()
+
+    def write(self, data):
+        self.unblocked.wait()
+        StringIO.write(self, data)
+
+
+class TestLogWriter(TestCase):
+
+    def test_lines_are_written_in_order(self):
+        writer = LogWriter(StringIO()).start()
+        for num in range(100):
+            writer.write('line {}\n'.format(num))
+        writer.flush()
+        self.assertEqual(''.join('line {}\n'.format(num)
+                                 for num in range(100)),
+                         writer.stream.getvalue())
+
+    def test_write_does_not_block(self):
+        stream = BlockingStream()
+        writer = LogWriter(stream, max_pending=2).start()
+        self.assertTrue(writer.write('first\n'))
+        while not writer.busy:
+            # The writer blocks writing the first line.
+            time.sleep(0.01)
+        self.assertTrue(writer.write('second\n'))
+        self.assertTrue(writer.write('third\n'))
+        self.assertFalse(writer.write('fourth\n'))
+        stream.unblocked.set()
+        writer.flush()
+        writer.write('fifth\n')
+        writer.flush()
+        self.assertEqual('first\nsecond\nthird\n'
+                         'WARNING: log buffer full, dropped 1 messages.\n'
+                         'fifth\n', stream.getvalue())
+
+
+class TestTracing(TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy({'plone04': ['plone0401']}).start()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'trace.json')
+        self.listener = HaProxyEventListener(
+            [INSTANCE1, UNKNOWN], haproxy_socket=self.haproxy.socket,
+            verify=True, trace_file=self.path)
+
+    def tearDown(self):
+        self.listener.stop()
+        self.haproxy.stop()
+        shutil.rmtree(self.tempdir)
+
+    def send(self, eventname, processname):
+        body = 'processname:{} groupname:bar pid:1'.format(processname)
+        self.listener.stdin = StringIO('eventname:{} len:{}\n{}'.format(
+            eventname, len(body), body))
+        self.listener.stdout = StringIO()
+        self.listener.stderr = StringIO()
+        self.listener.runforever(test=True)
+        return self.listener.stdout.getvalue()
+
+    def records(self):
+        self.listener.tracer.writer.flush()
+        with open(self.path) as trace_file:
+            return map(json.loads, trace_file)
+
+    def test_trace_record_of_applied_change(self):
+        self.assertEqual('READY\nRESULT 2\nOK',
+                         self.send('PROCESS_STATE_STOPPED', 'instance1'))
+        record, = self.records()
+        self.assertDictContainsSubset(
+            {'event': 'PROCESS_STATE_STOPPED',
+             'program': 'instance1',
+             'server': 'plone04/plone0401',
+             'action': 'MAINT',
+             'target': self.haproxy.socket,
+             'ok': True,
+             'error': None},
+            record)
+        self.assertLessEqual(record['received'], record['sent'])
+        self.assertLessEqual(record['sent'], record['replied'])
+        self.assertLessEqual(record['replied'], record['verified'])
+        self.assertEqual(round(record['verified'] - record['received'], 6),
+                         record['latency'])
+        self.assertEqual(['set server plone04/plone0401 state maint',
+                          'show stat -1 4 -1'],
+                         [cmd for timestamp, cmd in self.haproxy.commands])
+
+    def test_rejected_command_fails_the_event(self):
+        self.assertEqual('READY\nRESULT 4\nFAIL',
+                         self.send('PROCESS_STATE_STOPPED', 'instance9'))
+        self.assertIn("ERROR: HaProxyCommandError('set server plone04/plone0409"
+                      " state maint', 'No such server.')",
+                      self.listener.stderr.getvalue())
+        self.assertEqual(1, self.listener.metrics.get(
+            'commands_rejected_total'))
+        record, = self.records()
+        self.assertFalse(record['ok'])
+        self.assertIsNone(record['verified'])
+        self.assertEqual("'set server plone04/plone0409 state maint' was"
+                         " rejected: No such server.", record['error'])
+
+
+class TestVerification(TestCase):
+
+    def test_unconfirmed_state_is_logged(self):
+        haproxy_control = HaProxyControlMock()
+        haproxy_control.statuses[('plone04', 'plone0401')] = 'UP'
+        listener = HaProxyEventListener([INSTANCE1],
+                                        haproxy_control=haproxy_control,
+                                        verify=True)
+        self.addCleanup(listener.stop)
+        body = 'processname:instance1 groupname:bar pid:1'
+        listener.stdin = StringIO('eventname:PROCESS_STATE_STOPPING'
+                                  ' len:{}\n{}'.format(len(body), body))
+        listener.stdout = StringIO()
+        listener.stderr = StringIO()
+        listener.runforever(test=True)
+
+        self.assertEqual('READY\nRESULT 2\nOK', listener.stdout.getvalue())
+        self.assertIn('WARNING: plone04/plone0401 is UP after sending DRAIN.',
+                      listener.stderr.getvalue())
+        self.assertEqual(1, listener.metrics.get(
+            'verification_failures_total'))
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN'),
+             ('get_server_statuses', [('plone04', 'plone0401')])],
+            haproxy_control.calls)
+
+    def test_unconfirmed_state_is_not_cached(self):
+        haproxy_control = HaProxyControlMock()
+        haproxy_control.statuses[('plone04', 'plone0401')] = 'UP'
+        listener = HaProxyEventListener([INSTANCE1],
+                                        haproxy_control=haproxy_control,
+                                        verify=True, state_cache_ttl=60)
+        self.addCleanup(listener.stop)
+        body = 'processname:instance1 groupname:bar pid:1'
+        for num in range(2):
+            listener.stdin = StringIO('eventname:PROCESS_STATE_STOPPING'
+                                      ' len:{}\n{}'.format(len(body), body))
+            listener.stdout = StringIO()
+            listener.stderr = StringIO()
+            listener.runforever(test=True)
+
+        self.assertEqual({}, listener.targets[0].applied_states)
+        self.assertEqual(
+            [('set_server_status', 'plone04', 'plone0401', 'DRAIN')] * 2,
+            [call for call in haproxy_control.calls
+             if call[0] == 'set_server_status'])
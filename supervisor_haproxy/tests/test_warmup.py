@@ -0,0 +1,129 @@
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from supervisor_haproxy.warmup import WarmUp
+from unittest2 import TestCase
+import threading
+import time
+
+
+INSTANCE1 = {'supervisor_program': 'instance1',
+             'haproxy_backend': 'plone04',
+             'haproxy_server': 'plone0401'}
+
+
+class InstanceHandler(BaseHTTPRequestHandler):
+    """Responds to /ok, /slow (after the delay of the server) and with an
+    error to all other paths.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/slow':
+            time.sleep(self.server.delay)
+        self.send_response(200 if self.path in ('/ok', '/slow') else 500)
+        self.end_headers()
+        self.wfile.write('Plone')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestWarmUp(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), InstanceHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.ready = []
+        self.messages = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+    def warmup(self, *paths, **kwargs):
+        kwargs.setdefault('interval', 0.05)
+        return WarmUp({'instance1': map(self.url, paths)},
+                      self.ready.append, log=self.messages.append, **kwargs)
+
+    def test_passes_when_all_urls_succeed(self):
+        warmup = self.warmup('/ok', '/slow')
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertEqual([INSTANCE1], self.ready)
+        self.assertItemsEqual(['/ok', '/slow'], self.server.requests)
+        self.assertIn('Warm-up of instance1 passed', self.messages[0])
+
+    def test_min_success(self):
+        warmup = self.warmup('/ok', '/error', min_success=1)
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertEqual([INSTANCE1], self.ready)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_stays_in_maint_after_time_limit(self):
+        warmup = self.warmup('/error', time_limit=0.3)
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertEqual([], self.ready)
+        self.assertEqual(['WARNING: warm-up of instance1 did not pass within'
+                          ' 0.3 seconds, leaving it in MAINT.'],
+                         self.messages)
+
+    def test_sets_ready_anyway_after_time_limit(self):
+        warmup = self.warmup('/error', time_limit=0.3, ready_on_timeout=True)
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertEqual([INSTANCE1], self.ready)
+        self.assertGreater(len(self.server.requests), 1)
+        self.assertEqual(['WARNING: warm-up of instance1 did not pass within'
+                          ' 0.3 seconds, setting it READY anyway.'],
+                         self.messages)
+
+    def test_slow_responses_are_retried(self):
+        self.server.delay = 0.2
+        warmup = self.warmup('/slow', max_latency=0.1, time_limit=5)
+        warmup.begin(INSTANCE1)
+        time.sleep(0.3)
+        self.server.delay = 0
+        warmup.join()
+        self.assertEqual([INSTANCE1], self.ready)
+        self.assertGreater(len(self.server.requests), 1)
+        self.assertIn('Warm-up of instance1 passed', self.messages[0])
+
+    def test_cancel(self):
+        warmup = self.warmup('/error', time_limit=5)
+        warmup.begin(INSTANCE1)
+        warmup.cancel('instance1')
+        warmup.join()
+        self.assertEqual([], self.ready)
+        self.assertEqual(['Warm-up of instance1 cancelled.'], self.messages)
+
+    def test_warming_up(self):
+        warmup = self.warmup('/error', time_limit=5)
+        self.assertFalse(warmup.warming_up('instance1'))
+        warmup.begin(INSTANCE1)
+        self.assertTrue(warmup.warming_up('instance1'))
+        warmup.cancel('instance1')
+        self.assertFalse(warmup.warming_up('instance1'))
+        warmup.join()
+
+        warmup = self.warmup('/ok')
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertFalse(warmup.warming_up('instance1'))
+
+    def test_begin_again(self):
+        warmup = self.warmup('/ok')
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        warmup.begin(INSTANCE1)
+        warmup.join()
+        self.assertEqual([INSTANCE1, INSTANCE1], self.ready)
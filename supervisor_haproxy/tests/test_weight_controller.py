@@ -0,0 +1,163 @@
+from StringIO import StringIO
+from supervisor_haproxy.event_listener import HaProxyEventListener
+from supervisor_haproxy.haproxy_control import ServerStat
+from supervisor_haproxy.tests.fake_haproxy import FakeHaProxy
+from supervisor_haproxy.weight_controller import median
+from supervisor_haproxy.weight_controller import WeightController
+from unittest2 import TestCase
+
+
+SERVERS = [('plone04', 'plone0401'),
+           ('plone04', 'plone0402'),
+           ('plone04', 'plone0403')]
+
+
+def snapshot(*loads, **kwargs):
+    """Create a stats snapshot of SERVERS with the (qcur, rtime) loads.
+    """
+    status = kwargs.get('status', 'UP')
+    return {key: ServerStat(key[0], key[1], status, 1, qcur, 0, rtime, 0)
+            for key, (qcur, rtime) in zip(SERVERS, loads)}
+
+
+class TestWeightController(TestCase):
+
+    def test_median(self):
+        self.assertEqual(2, median([3, 1, 2]))
+        self.assertEqual(2.5, median([4, 1, 3, 2]))
+
+    def test_lowers_weight_of_server_with_long_queue(self):
+        controller = WeightController()
+        self.assertEqual(
+            [(('plone04', 'plone0402'), 50)],
+            controller.update(snapshot((0, 100), (10, 100), (1, 100)),
+                              SERVERS))
+
+    def test_lowers_weight_of_slow_server(self):
+        controller = WeightController()
+        self.assertEqual(
+            [(('plone04', 'plone0403'), 50)],
+            controller.update(snapshot((0, 100), (0, 120), (0, 500)),
+                              SERVERS))
+
+    def test_balanced_servers_are_left_alone(self):
+        controller = WeightController()
+        self.assertEqual(
+            [], controller.update(snapshot((1, 100), (2, 150), (0, 90)),
+                                  SERVERS))
+
+    def test_weight_is_lowered_to_min_and_restored_gradually(self):
+        controller = WeightController(min_weight=20, step=30)
+        overloaded = snapshot((0, 100), (0, 100), (0, 900))
+        recovered = snapshot((0, 100), (0, 100), (0, 100))
+        weights = []
+        for index in [overloaded] * 3 + [recovered] * 3:
+            changes = controller.update(index, SERVERS)
+            controller.commit(changes)
+            weights.append([weight for key, weight in changes])
+
+        self.assertEqual([[50], [25], [20], [50], [80], [100]], weights)
+        self.assertEqual({}, controller.weights)
+
+    def test_uncommitted_changes_are_proposed_again(self):
+        controller = WeightController()
+        overloaded = snapshot((0, 100), (0, 100), (0, 900))
+        self.assertEqual([(('plone04', 'plone0403'), 50)],
+                         controller.update(overloaded, SERVERS))
+        self.assertEqual([(('plone04', 'plone0403'), 50)],
+                         controller.update(overloaded, SERVERS))
+
+    def test_servers_without_health_check(self):
+        controller = WeightController()
+        self.assertEqual(
+            [(('plone04', 'plone0403'), 50)],
+            controller.update(snapshot((0, 100), (0, 100), (0, 900),
+                                       status='no'),
+                              SERVERS))
+
+    def test_servers_which_are_not_up_are_ignored(self):
+        controller = WeightController()
+        self.assertEqual(
+            [], controller.update(snapshot((0, 100), (0, 100), (0, 900),
+                                           status='MAINT'),
+                                  SERVERS))
+
+    def test_excluded_servers_are_left_alone(self):
+        controller = WeightController()
+        controller.weights[('plone04', 'plone0403')] = 50
+        self.assertEqual(
+            [], controller.update(snapshot((0, 100), (0, 100), (0, 900)),
+                                  SERVERS, exclude=[('plone04', 'plone0403')]))
+        self.assertEqual({}, controller.weights)
+
+
+class TestAdaptiveWeights(TestCase):
+
+    def setUp(self):
+        self.haproxy = FakeHaProxy(
+            {'plone04': [server for backend, server in SERVERS]}).start()
+        for backend, server in SERVERS:
+            fake_server = self.haproxy.get_server(backend, server)
+            fake_server.weight = fake_server.initial_weight = 100
+            fake_server.rtime = 100
+
+    def tearDown(self):
+        self.haproxy.stop()
+
+    def tick(self, listener):
+        body = 'when:1201063880'
+        listener.stdin = StringIO('eventname:TICK_5 len:{}\n{}'.format(
+            len(body), body))
+        listener.stdout = StringIO()
+        listener.stderr = StringIO()
+        listener.runforever(test=True)
+        return listener.stderr.getvalue()
+
+    def test_adjusts_weights_on_tick(self):
+        programs = [{'supervisor_program': 'instance{}'.format(num),
+                     'haproxy_backend': backend,
+                     'haproxy_server': server}
+                    for num, (backend, server) in enumerate(SERVERS, 1)]
+        listener = HaProxyEventListener(
+            programs, haproxy_socket=self.haproxy.socket,
+            adaptive_weights=True, adaptive_step=25)
+        self.addCleanup(listener.stop)
+
+        self.haproxy.get_server('plone04', 'plone0402').rtime = 1000
+        self.assertIn('Adjusted weights: 50% for plone04/plone0402.',
+                      self.tick(listener))
+        self.assertEqual(50, self.haproxy.get_server(
+            'plone04', 'plone0402').weight)
+
+        self.haproxy.get_server('plone04', 'plone0402').rtime = 100
+        self.tick(listener)
+        self.assertEqual(75, self.haproxy.get_server(
+            'plone04', 'plone0402').weight)
+        self.tick(listener)
+        self.assertEqual([100, 100, 100], [
+            self.haproxy.get_server(*key).weight for key in SERVERS])
+        self.assertEqual('', self.tick(listener))
+
+    def test_servers_in_slow_start_are_left_alone(self):
+        programs = [{'supervisor_program': 'instance{}'.format(num),
+                     'haproxy_backend': backend,
+                     'haproxy_server': server}
+                    for num, (backend, server) in enumerate(SERVERS, 1)]
+        listener = HaProxyEventListener(
+            programs, haproxy_socket=self.haproxy.socket,
+            adaptive_weights=True, slow_start=60, slow_start_weight=10)
+        self.addCleanup(listener.stop)
+        body = 'processname:instance2 groupname:bar pid:1'
+        listener.stdin = StringIO('eventname:PROCESS_STATE_RUNNING'
+                                  ' len:{}\n{}'.format(len(body), body))
+        listener.stdout = StringIO()
+        listener.stderr = StringIO()
+        listener.runforever(test=True)
+        self.assertEqual(10, self.haproxy.get_server(
+            'plone04', 'plone0402').weight)
+
+        # The new instance is slow, since its caches are cold.
+        self.haproxy.get_server('plone04', 'plone0402').rtime = 1000
+        self.assertEqual('', self.tick(listener))
+        self.assertEqual(10, self.haproxy.get_server(
+            'plone04', 'plone0402').weight)
@@ -0,0 +1,54 @@
+import json
+import threading
+import time
+
+
+class Tracer(object):
+    """Writes a trace record for each change applied to haproxy as a line
+    of JSON, e.g.:
+
+        {"action": "MAINT", "error": null, "event": "PROCESS_STATE_STOPPED",
+         "latency": 0.0031, "ok": true, "program": "instance1",
+         "received": 1475582400.1, "replied": 1475582400.102,
+         "sent": 1475582400.101, "server": "plone04/plone0401",
+         "target": "tcp://localhost:8800", "verified": 1475582400.103}
+
+    The timestamps are seconds since the epoch: ``received`` when the event
+    was received from supervisor, ``sent`` and ``replied`` when the command
+    was sent to haproxy and its reply received and ``verified`` when the
+    state was confirmed with a stats snapshot (with verification only).
+    ``latency`` is the time from receiving the event until the change was
+    confirmed by haproxy.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        # The last received event by (backend, server).
+        self.received = {}
+
+    def receive(self, key, event, program):
+        with self.lock:
+            self.received[key] = {'received': time.time(),
+                                  'event': event,
+                                  'program': program}
+
+    def trace(self, key, action, target, sent, replied=None, verified=None,
+              ok=True, error=None):
+        with self.lock:
+            record = dict(self.received.get(
+                key, {'received': None, 'event': None, 'program': None}))
+
+        done = verified or replied
+        record.update(
+            server='{}/{}'.format(*key),
+            action=action,
+            target=target,
+            sent=sent,
+            replied=replied,
+            verified=verified,
+            ok=ok and error is None,
+            error=str(error) if error is not None else None,
+            latency=(round(done - record['received'], 6)
+                     if done and record['received'] else None))
+        self.writer.write(json.dumps(record, sort_keys=True) + '\n')
@@ -0,0 +1,169 @@
+from datetime import datetime
+import threading
+import time
+import urllib2
+
+
+class WarmUp(object):
+    """Requests warm-up URLs of a program which just started, before its
+    server is set to READY, so that the users do not pay for warming the
+    caches.
+
+    ``urls`` maps the supervisor program names to lists of URLs. The URLs
+    are requested concurrently in rounds, until at least ``min_success``
+    (default: all) of them succeed within ``max_latency`` seconds each.
+    When the warm-up does not pass within ``time_limit`` seconds, the server
+    stays in MAINT, unless ``ready_on_timeout`` is set, in which case it is
+    set to READY anyway.
+
+    The warm-up runs in a thread per program, so that supervisor events keep
+    flowing. ``on_ready(program_info)`` is called when it is done, unless it
+    was cancelled in the meantime, e.g. because the program stopped.
+    """
+
+    def __init__(self, urls, on_ready, min_success=None, max_latency=None,
+                 time_limit=60, interval=1, ready_on_timeout=False,
+                 log=None):
+        self.urls = urls
+        self.on_ready = on_ready
+        self.min_success = min_success
+        self.max_latency = max_latency
+        self.time_limit = time_limit
+        self.interval = interval
+        self.ready_on_timeout = ready_on_timeout
+        self.log = log or (lambda msg: None)
+        self.lock = threading.Lock()
+        self.generations = {}
+        # The generations of the running warm-ups, by program name.
+        self.running = {}
+        self.threads = []
+
+    def __contains__(self, program_name):
+        return program_name in self.urls
+
+    def begin(self, program_info):
+        """Start warming up the program in a thread.
+        """
+        name = program_info['supervisor_program']
+        with self.lock:
+            generation = self._next_generation(name)
+            self.running[name] = generation
+            thread = threading.Thread(
+                target=self.run, args=(program_info, generation),
+                name='supervisor-haproxy-warmup-{}'.format(name))
+            thread.daemon = True
+            self.threads = [running for running in self.threads
+                            if running.is_alive()] + [thread]
+        thread.start()
+
+    def cancel(self, program_name):
+        """Cancel a running warm-up of the program; ``on_ready`` will not be
+        called.
+        """
+        with self.lock:
+            if program_name in self.generations:
+                self._next_generation(program_name)
+
+    def warming_up(self, program_name):
+        """Return whether the program is being warmed up.
+        """
+        with self.lock:
+            generation = self.running.get(program_name)
+            return generation is not None \
+                and self.is_current(program_name, generation)
+
+    def _next_generation(self, program_name):
+        self.generations[program_name] = self.generations.get(
+            program_name, 0) + 1
+        return self.generations[program_name]
+
+    def is_current(self, program_name, generation):
+        return self.generations.get(program_name) == generation
+
+    def run(self, program_info, generation):
+        name = program_info['supervisor_program']
+        start = time.time()
+        passed = self.warm_up(name, generation)
+
+        # on_ready is called with the lock held, so that a cancel waits
+        # until the change is applied (or queued) and its change follows.
+        with self.lock:
+            if self.running.get(name) == generation:
+                del self.running[name]
+            if not self.is_current(name, generation):
+                self.log('Warm-up of {} cancelled.'.format(name))
+                return
+
+            if passed:
+                self.log('{date} Warm-up of {name} passed in {seconds:.1f}'
+                         ' seconds.'.format(date=datetime.now().isoformat(),
+                                            name=name,
+                                            seconds=time.time() - start))
+            elif self.ready_on_timeout:
+                self.log('WARNING: warm-up of {} did not pass within {}'
+                         ' seconds, setting it READY anyway.'.format(
+                             name, self.time_limit))
+            else:
+                self.log('WARNING: warm-up of {} did not pass within {}'
+                         ' seconds, leaving it in MAINT.'.format(
+                             name, self.time_limit))
+                return
+            self.on_ready(program_info)
+
+    def warm_up(self, program_name, generation):
+        """Request the URLs in rounds until enough succeed, the time limit
+        is reached or the warm-up is cancelled.
+        Returns whether the warm-up passed.
+        """
+        urls = self.urls[program_name]
+        min_success = self.min_success or len(urls)
+        deadline = time.time() + self.time_limit
+        while self.is_current(program_name, generation):
+            results = [None] * len(urls)
+            threads = [threading.Thread(target=self._request,
+                                        args=(url, deadline, results, index))
+                       for index, url in enumerate(urls)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            if results.count(True) >= min_success:
+                return True
+            if time.time() + self.interval >= deadline:
+                return False
+            time.sleep(self.interval)
+
+        return False
+
+    def _request(self, url, deadline, results, index):
+        start = time.time()
+        try:
+            response = urllib2.urlopen(url, timeout=max(0.1, deadline - start))
+            try:
+                response.read()
+            finally:
+                response.close()
+        except Exception:
+            results[index] = False
+            return
+
+        latency = time.time() - start
+        results[index] = self.max_latency is None \
+            or latency <= self.max_latency
+
+    def stop(self):
+        """Cancel all warm-ups and wait for their threads.
+        """
+        with self.lock:
+            for program_name in self.generations.keys():
+                self._next_generation(program_name)
+        self.join()
+
+    def join(self):
+        """Wait for all running warm-ups.
+        """
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,84 @@
+from supervisor_haproxy.haproxy_control import STATUS_NO_CHECK
+from supervisor_haproxy.haproxy_control import STATUS_UP
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class WeightController(object):
+    """Lowers the weight of servers which are much slower than the other
+    servers of their backend, e.g. because of garbage collection, and
+    restores it gradually when they recovered.
+
+    ``update`` is called with a "show stat" snapshot once per cycle. A server
+    is overloaded when its queue (``qcur``) or its average response time
+    (``rtime``) is more than ``factor`` times the median of the backend.
+    The weight (percent of the configured weight) of an overloaded server is
+    halved, down to ``min_weight``. Afterwards it is raised by ``step`` per
+    cycle up to ``max_weight``, so that the weights do not oscillate.
+
+    Only servers which are UP (or have no health check) are considered;
+    servers whose weight was never lowered are left alone. Servers in
+    ``exclude``, e.g. those whose weight is raised by the slow start, are
+    neither considered nor changed.
+    """
+
+    def __init__(self, min_weight=10, max_weight=100, factor=2.0, step=10):
+        self.min_weight = min_weight
+        self.max_weight = max_weight
+        self.factor = factor
+        self.step = step
+        # The weights of the servers, which were lowered, by (backend, server).
+        self.weights = {}
+
+    def update(self, index, servers, exclude=()):
+        """Return the weight changes as list of ``((backend, server), weight)``
+        for the watched ``servers``, given a snapshot as returned by
+        ``HaProxyControl.get_stat_index``.
+        The changes must be confirmed with ``commit`` when they are applied.
+        """
+        backends = {}
+        for key in servers:
+            if key in exclude:
+                # The weight is set by someone else, a lowered weight is
+                # overridden.
+                self.weights.pop(key, None)
+                continue
+            stat = index.get(key)
+            if stat is not None \
+               and stat.status in (STATUS_UP, STATUS_NO_CHECK):
+                backends.setdefault(key[0], []).append(stat)
+
+        changes = []
+        for backend, stats in sorted(backends.items()):
+            if len(stats) < 2:
+                continue
+
+            median_qcur = median([stat.qcur for stat in stats])
+            median_rtime = median([stat.rtime for stat in stats])
+            for stat in stats:
+                key = (stat.pxname, stat.svname)
+                current = self.weights.get(key, self.max_weight)
+                overloaded = stat.qcur > self.factor * median_qcur + 1 \
+                    or (median_rtime > 0
+                        and stat.rtime > self.factor * median_rtime)
+                if overloaded:
+                    weight = max(self.min_weight, current // 2)
+                else:
+                    weight = min(self.max_weight, current + self.step)
+                if weight != current:
+                    changes.append((key, weight))
+
+        return sorted(changes)
+
+    def commit(self, changes):
+        for key, weight in changes:
+            if weight >= self.max_weight:
+                self.weights.pop(key, None)
+            else:
+                self.weights[key] = weight
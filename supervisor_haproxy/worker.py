@@ -0,0 +1,143 @@
+from collections import deque
+import threading
+import time
+
+
+# What to do with a new change when the queue is full:
+# reject the event so that supervisor sends it again later,
+OVERFLOW_FAIL = 'fail'
+# drop the oldest queued change,
+OVERFLOW_DROP = 'drop'
+# or wait until there is space in the queue again.
+OVERFLOW_BLOCK = 'block'
+
+OVERFLOW_POLICIES = (OVERFLOW_FAIL, OVERFLOW_DROP, OVERFLOW_BLOCK)
+
+
+class HaProxyWorker(threading.Thread):
+    """The worker applies queued changes to haproxy in a background thread,
+    so that the event listener can acknowledge events immediately.
+
+    The changes are applied in the order they were queued by calling
+    ``apply`` with the arguments passed to ``put``.
+
+    With a ``coalesce_window`` (seconds), changes are held back for that
+    long. When another change with the same key (e.g. the same server)
+    arrives in the meantime, it replaces the pending change, so that only
+    the last one is applied.
+    With ``apply_batch``, all changes queued when the window of the oldest
+    change has passed are applied at once by calling ``apply_batch`` with
+    the list of the arguments.
+    """
+
+    def __init__(self, apply, maxsize=1000, overflow=OVERFLOW_FAIL, log=None,
+                 coalesce_window=0, apply_batch=None):
+        super(HaProxyWorker, self).__init__(name='supervisor-haproxy-worker')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {!r}, got {!r}'.format(
+                OVERFLOW_POLICIES, overflow))
+
+        self.daemon = True
+        self.apply = apply
+        self.apply_batch = apply_batch
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.log = log or (lambda msg: None)
+        self.coalesce_window = coalesce_window
+        # The queue contains [key, args, queued_at] entries, the pending
+        # dict maps the keys to the entries not yet picked up.
+        self.queue = deque()
+        self.pending = {}
+        self.queued = 0
+        self.coalesced = 0
+        self.condition = threading.Condition()
+        self.busy = False
+        self.running = True
+
+    def put(self, key, *args):
+        """Queue a change.
+        Returns ``False`` when the queue is full and the overflow policy
+        rejects the change.
+        """
+        with self.condition:
+            self.queued += 1
+            if self.coalesce_window and key in self.pending:
+                self.pending[key][1] = args
+                self.coalesced += 1
+                return True
+
+            while len(self.queue) >= self.maxsize:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self.condition.wait()
+                elif self.overflow == OVERFLOW_DROP:
+                    dropped_key, dropped_args, _ = self._pop()
+                    self.log('WARNING: queue is full, dropping {!r}.'.format(
+                        dropped_args))
+                else:
+                    self.queued -= 1
+                    return False
+
+            entry = [key, args, time.time()]
+            self.queue.append(entry)
+            self.pending[key] = entry
+            self.condition.notify_all()
+            return True
+
+    def _pop(self):
+        entry = self.queue.popleft()
+        if self.pending.get(entry[0]) is entry:
+            del self.pending[entry[0]]
+        return entry
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+
+                delay = self._coalesce_delay()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                if self.apply_batch is not None and self.coalesce_window:
+                    batch = [self._pop()[1] for _ in range(len(self.queue))]
+                else:
+                    batch = None
+                    key, args, queued_at = self._pop()
+                self.busy = True
+                self.condition.notify_all()
+
+            try:
+                if batch is not None:
+                    self.apply_batch(batch)
+                else:
+                    self.apply(*args)
+            except Exception, exc:
+                self.log('ERROR: {!r}'.format(exc))
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def _coalesce_delay(self):
+        if not self.coalesce_window or not self.running:
+            return 0
+        return self.queue[0][2] + self.coalesce_window - time.time()
+
+    def join_queue(self):
+        """Wait until all queued changes are applied.
+        """
+        with self.condition:
+            while self.queue or self.busy:
+                self.condition.wait()
+
+    def stop(self):
+        """Apply the queued changes and stop the worker.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join()